@@ -0,0 +1,242 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Pairwise alignment of two sequences, e.g. a sequencing read against the designed sequence.
+
+Global (Needleman-Wunsch) and local (Smith-Waterman) alignment with linear gap costs,
+computed with banded dynamic programming: only cells within a band of diagonals are computed.
+The band is found by k-mer diagonal voting: the diagonals (j - i) of k-mers shared by the two
+sequences show where the alignment is, and the band covers those diagonals plus a margin
+(for global alignment also the start and end corners).
+Both time and memory are proportional to len(a) times the band width, instead of len(a) * len(b);
+the traceback uses one byte per computed cell.
+
+Sublime Text's Python does not include NumPy, so the DP is written in plain Python,
+with the rows stored relative to the band so each cell only needs three list lookups.
+
+Settings:
+    'eln_align_scoring'
+    'eln_align_band_margin'
+    'eln_align_line_width'
+    'eln_align_max_unbanded_cells'
+
+"""
+
+from __future__ import print_function, absolute_import
+from collections import Counter
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, rcompl, dna_filter
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SCORING = {"match": 2, "mismatch": -3, "gap": -5}
+# Sequences without shared k-mers are aligned with the full DP matrix, but only up to this many cells (a few seconds):
+DEFAULT_MAX_UNBANDED_CELLS = 4000000
+NEG_INF = float("-inf")
+# Traceback codes:
+TB_STOP, TB_DIAG, TB_UP, TB_LEFT = 0, 1, 2, 3
+
+
+def find_band(a, b, k=11, min_fraction=0.1):
+    """
+    Return (dlo, dhi), the range of diagonals (j - i) supported by k-mers shared between a and b,
+    or None if there are no shared k-mers. Diagonals with fewer votes than min_fraction of the best
+    diagonal are ignored (they are usually repeats).
+    """
+    positions = {}
+    for j in range(len(b) - k + 1):
+        positions.setdefault(b[j:j+k], j)
+    votes = Counter()
+    # Sampling every (k // 2)'th k-mer in a is enough to find all diagonals of any significant length:
+    for i in range(0, len(a) - k + 1, max(k // 2, 1)):
+        j = positions.get(a[i:i+k])
+        if j is not None:
+            votes[j - i] += 1
+    if not votes:
+        return None
+    threshold = max(votes.most_common(1)[0][1] * min_fraction, 1)
+    diagonals = [d for d, count in votes.items() if count >= threshold]
+    return min(diagonals), max(diagonals)
+
+
+def banded_align(a, b, mode="global", match=2, mismatch=-3, gap=-5, dlo=None, dhi=None):
+    """
+    Align a and b with banded dynamic programming, computing only cells with dlo <= j - i <= dhi.
+    mode is "global" or "local".
+    Returns (score, aligned a, aligned b, (start in a, start in b)), where the aligned sequences
+    include '-' for gaps, and the start positions are 0 for global alignments.
+    """
+    local = mode == "local"
+    n, m = len(a), len(b)
+    if dlo is None or dhi is None:
+        dlo, dhi = -n, m
+    if not local:
+        # The global alignment must start at (0, 0) and end at (n, m):
+        dlo, dhi = min(dlo, 0, m - n), max(dhi, 0, m - n)
+    dlo, dhi = max(dlo, -n), min(dhi, m)
+    width = dhi - dlo + 1
+    # Band index k for cell (i, j) is j - i - dlo; cell (i-1, j-1) has the same k in the previous row,
+    # (i-1, j) has k+1, and (i, j-1) has k-1.
+    prev = [NEG_INF] * (width + 1)
+    traceback = [None]  # Row 0 is traced back without a table (left to (0, 0) for global alignments).
+    for k in range(width):
+        j = k + dlo
+        if 0 <= j <= m:
+            prev[k] = 0 if local else gap * j
+    best, best_i, best_k = 0, 0, -dlo
+    for i in range(1, n + 1):
+        ai = a[i-1]
+        cur = [NEG_INF] * (width + 1)
+        tb = bytearray(width)
+        kstart = max(0, -(i + dlo))        # j >= 0
+        kend = min(width, m - i - dlo + 1)  # j <= m
+        left = NEG_INF
+        for k in range(kstart, kend):
+            j = i + dlo + k
+            if j == 0:
+                score, code = (0, TB_STOP) if local else (gap * i, TB_UP)
+            else:
+                score = prev[k] + (match if b[j-1] == ai else mismatch)
+                code = TB_DIAG
+                up = prev[k+1] + gap
+                if up > score:
+                    score, code = up, TB_UP
+                if left + gap > score:
+                    score, code = left + gap, TB_LEFT
+                if local and score <= 0:
+                    score, code = 0, TB_STOP
+            cur[k] = left = score
+            tb[k] = code
+            if local and score > best:
+                best, best_i, best_k = score, i, k
+        prev = cur
+        traceback.append(tb)
+    if local:
+        i, k = best_i, best_k
+        score = best
+    else:
+        i, k = n, m - n - dlo
+        score = prev[k]
+    # Trace back from the end cell:
+    out_a, out_b = [], []
+    while True:
+        j = i + dlo + k
+        code = traceback[i][k] if i > 0 else (TB_LEFT if j > 0 and not local else TB_STOP)
+        if code == TB_STOP:
+            break
+        if code == TB_DIAG:
+            out_a.append(a[i-1])
+            out_b.append(b[j-1])
+            i -= 1
+        elif code == TB_UP:
+            out_a.append(a[i-1])
+            out_b.append("-")
+            i, k = i - 1, k + 1
+        else:
+            out_a.append("-")
+            out_b.append(b[j-1])
+            k -= 1
+    return score, "".join(reversed(out_a)), "".join(reversed(out_b)), (i, i + dlo + k)
+
+
+def align(a, b, mode="global", scoring=None, band_margin=16, k=11, max_unbanded_cells=DEFAULT_MAX_UNBANDED_CELLS):
+    """
+    Align sequences a and b (in upper case DNA letters), using a band found by k-mer voting
+    (or the full DP matrix if the sequences share no k-mers).
+    Raises ValueError if the full DP matrix would have more than max_unbanded_cells cells.
+    Returns (score, aligned a, aligned b, (start in a, start in b)).
+    """
+    scoring = dict(DEFAULT_SCORING, **(scoring or {}))
+    band = find_band(a, b, k=k)
+    if band is None:
+        if max_unbanded_cells is not None and len(a) * len(b) > max_unbanded_cells:
+            raise ValueError("The sequences share no {}-mers, and a full alignment of {} x {} bases is too large "
+                             "(limit: {} cells, 'eln_align_max_unbanded_cells').".format(
+                                 k, len(a), len(b), max_unbanded_cells))
+        logger.info("No shared %s-mers, aligning without band.", k)
+        dlo = dhi = None
+    else:
+        dlo, dhi = band[0] - band_margin, band[1] + band_margin
+    return banded_align(a, b, mode=mode, dlo=dlo, dhi=dhi, **scoring)
+
+
+def format_alignment(aligned_a, aligned_b, start_a=0, start_b=0, name_a="seq1", name_b="seq2", line_width=60):
+    """ Return alignment as text, in blocks of line_width columns with position numbers and match bars. """
+    pad = max(len(name_a), len(name_b))
+    num_width = len(str(max(start_a, start_b) + len(aligned_a)))
+    blocks = []
+    pos_a, pos_b = start_a, start_b
+    for offset in range(0, len(aligned_a), line_width):
+        chunk_a, chunk_b = aligned_a[offset:offset+line_width], aligned_b[offset:offset+line_width]
+        bars = "".join("|" if x == y else " " for x, y in zip(chunk_a, chunk_b))
+        end_a = pos_a + len(chunk_a) - chunk_a.count("-")
+        end_b = pos_b + len(chunk_b) - chunk_b.count("-")
+        blocks.append("\n".join([
+            "{:<{pad}} {:>{nw}} {} {}".format(name_a, pos_a + 1, chunk_a, end_a, pad=pad, nw=num_width),
+            "{:<{pad}} {:>{nw}} {}".format("", "", bars, pad=pad, nw=num_width),
+            "{:<{pad}} {:>{nw}} {} {}".format(name_b, pos_b + 1, chunk_b, end_b, pad=pad, nw=num_width),
+        ]))
+        pos_a, pos_b = end_a, end_b
+    return "\n\n".join(blocks)
+
+
+def alignment_summary(score, aligned_a, aligned_b, mode="global"):
+    """ Return one-line summary with score, identity and gaps. """
+    length = len(aligned_a)
+    identities = sum(1 for x, y in zip(aligned_a, aligned_b) if x == y)
+    gaps = aligned_a.count("-") + aligned_b.count("-")
+    return "Alignment ({}): score {}, identity {}/{} ({:.1f}%), gaps {}".format(
+        mode, score, identities, length, 100.0 * identities / length if length else 0, gaps)
+
+
+class ElnSequenceAlignCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_sequence_align
+    Align the sequences in the first two selections, and insert the alignment at the end of the view.
+    Non-sequence characters (whitespace, numbers, etc.) are removed before aligning.
+    The alignment is computed in the background and inserted when done.
+
+    Args:
+        mode: "global" or "local".
+        rcompl_second: Reverse-complement the second sequence before aligning (e.g. for reverse reads).
+        band_margin: Number of diagonals added on each side of the band found by k-mer voting.
+    """
+
+    def run(self, edit, mode="global", rcompl_second=False, band_margin=None):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        selections = [sel for sel in self.view.sel() if not sel.empty()]
+        if len(selections) < 2:
+            sublime.status_message("Select two sequences to align.")
+            return
+        settings = get_settings()
+        a, b = (dna_filter(self.view.substr(sel), degenerate=True) for sel in selections[:2])
+        if rcompl_second:
+            b = rcompl(b, strict=False)
+        if band_margin is None:
+            band_margin = settings.get('eln_align_band_margin', 16)
+        align_kwargs = dict(mode=mode, scoring=settings.get('eln_align_scoring'), band_margin=band_margin,
+                            max_unbanded_cells=settings.get('eln_align_max_unbanded_cells', DEFAULT_MAX_UNBANDED_CELLS))
+        line_width = settings.get('eln_align_line_width', 60)
+
+        def run_alignment():
+            try:
+                score, aligned_a, aligned_b, (start_a, start_b) = align(a, b, **align_kwargs)
+            except ValueError as exc:
+                print("ELN align: %s" % (exc,))
+                sublime.status_message("Alignment not computed: %s" % (exc,))
+                return
+            summary = alignment_summary(score, aligned_a, aligned_b, mode=mode)
+            text = "\n".join([summary, "", format_alignment(
+                aligned_a, aligned_b, start_a, start_b, name_a="seq1", name_b="seq2 (rc)" if rcompl_second else "seq2",
+                line_width=line_width)])
+            print(summary)
+            sublime.set_timeout(lambda: self.insert_alignment(text, summary), 0)
+
+        sublime.status_message("Aligning {} and {} bases...".format(len(a), len(b)))
+        sublime.set_timeout_async(run_alignment, 0)
+
+    def insert_alignment(self, text, summary):
+        self.view.run_command("eln_insert_text", {"position": -1, "text": "\n\n" + text + "\n"})
+        sublime.status_message(summary)
@@ -0,0 +1,299 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Batch processing of sequence records (stats, transforms, translation) with a pool of workers.
+
+Records are (name, sequence) tuples, e.g. from a FASTA file. The record stream is split into chunks
+of roughly 'eln_batch_chunk_chars' bases, so the inter-process communication (pickling the chunk and
+the results) is amortized over many records, and chunks are sent to the workers as they are read.
+Only a bounded number of chunks are in flight at a time, so arbitrarily large streams can be processed,
+and results are yielded in the same order as the input records.
+
+Backends:
+    "serial": Process the chunks in the calling thread.
+    "thread": Thread pool. Most sequence functions hold the GIL, so this mostly helps for functions
+        that spend their time in C code which releases it.
+    "process": Process pool, using the "fork" start method so the workers inherit the loaded plugin
+        modules (the sequence functions cannot be imported in a freshly spawned interpreter, because
+        they import the sublime module). Forking Sublime's multi-threaded plugin host is only done on
+        Linux, and only when explicitly selected; elsewhere the thread backend is used.
+The default backend is "thread". This gives up near-linear multicore scaling for the pure-Python sequence
+functions (which hold the GIL) in exchange for never forking the plugin host unless asked to;
+select "process" on Linux for CPU-bound batches.
+
+Operations are referred to by name (see BATCH_OPERATIONS), so only strings and sequences are sent
+to the workers.
+
+Settings:
+    'eln_batch_backend'
+    'eln_batch_workers'
+    'eln_batch_chunk_chars'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import sys
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, sequence_stats, rcompl, compl, dna_filter, dna_to_rna
+from .eln_translate import translate
+logger = logging.getLogger(__name__)
+
+
+BATCH_OPERATIONS = {
+    'stats': sequence_stats,
+    'rcompl': lambda seq: rcompl(seq, strict=False),
+    'compl': lambda seq: compl(seq, strict=False),
+    'dna_filter': dna_filter,
+    'dna_to_rna': dna_to_rna,
+    'translate': translate,
+}
+BACKENDS = ("serial", "thread", "process")
+
+
+def process_chunk(operation, chunk):
+    """ Apply the named operation to the sequences in chunk, returning a list of (name, result). """
+    func = BATCH_OPERATIONS[operation]
+    return [(name, func(seq)) for name, seq in chunk]
+
+
+def iter_chunks(records, chunk_chars=200000, max_records=10000):
+    """ Yield lists of records, each with about chunk_chars bases in total (and at most max_records). """
+    chunk, size = [], 0
+    for record in records:
+        chunk.append(record)
+        size += len(record[1])
+        if size >= chunk_chars or len(chunk) >= max_records:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def iter_fasta_records(lines):
+    """ Yield (name, sequence) for each FASTA record in lines, reading the lines one at a time. """
+    name, parts = None, []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(">"):
+            if name is not None:
+                yield name, "".join(parts)
+            name, parts = line[1:], []
+        elif name is not None and line and not line.startswith(";"):
+            parts.append(line)
+    if name is not None:
+        yield name, "".join(parts)
+
+
+def get_fork_context():
+    """
+    Return multiprocessing context with the fork start method, or None if fork is not available or not safe.
+    Forking a multi-threaded process is unsafe on macOS (system frameworks are not fork-safe), so fork is only used
+    on Linux.
+    """
+    if not hasattr(os, 'fork') or not sys.platform.startswith('linux'):
+        return None
+    try:
+        return multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):
+        # Python < 3.4 has no contexts, but always uses fork on POSIX.
+        return multiprocessing
+
+
+def resolve_backend(backend):
+    """ Return the backend actually used for backend: "process" falls back to "thread" where fork is not used. """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown batch backend %r, must be one of %s." % (backend, ", ".join(BACKENDS)))
+    if backend == "process" and get_fork_context() is None:
+        return "thread"
+    return backend
+
+
+def make_executor(backend="thread", workers=None):
+    """
+    Return (executor, backend) for the requested backend, backend being the one actually used (c.f. `resolve_backend`).
+    The executor is None for the serial backend.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    used = resolve_backend(backend)
+    if used != backend:
+        logger.info("Fork start method not available (or not safe) here, using %s backend.", used)
+    backend = used
+    if backend == "process":
+        context = get_fork_context()
+        if context is multiprocessing:
+            return ProcessPoolExecutor(workers), backend
+        else:
+            return ProcessPoolExecutor(workers, mp_context=context), backend
+    if backend == "thread":
+        return ThreadPoolExecutor(workers), backend
+    return None, backend
+
+
+def map_records(operation, records, backend="thread", workers=None, chunk_chars=200000, used_backend=None):
+    """
+    Apply the named operation (a key in BATCH_OPERATIONS) to each (name, sequence) record.
+    Yields (name, result) in the same order as records.
+    At most 2*workers chunks are submitted ahead of the chunk currently being yielded.
+    If used_backend is a list, the backend actually used is appended to it when processing starts.
+    """
+    if operation not in BATCH_OPERATIONS:
+        raise ValueError("Unknown batch operation %r." % (operation,))
+    executor, backend = make_executor(backend, workers)
+    if used_backend is not None:
+        used_backend.append(backend)
+    chunks = iter_chunks(records, chunk_chars=chunk_chars)
+    if executor is None:
+        for chunk in chunks:
+            for result in process_chunk(operation, chunk):
+                yield result
+        return
+    max_pending = 2 * (workers or multiprocessing.cpu_count())
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(process_chunk, operation, chunk))
+            if len(pending) >= max_pending:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def benchmark(operation, records, backends=BACKENDS, workers=None, chunk_chars=200000):
+    """
+    Time the operation on records with each backend, checking that all backends give the same results.
+    Returns list of (requested backend, backend actually used, seconds) tuples.
+    """
+    timings = []
+    reference = None
+    for backend in backends:
+        used_backend = []
+        start = time.time()
+        results = list(map_records(operation, records, backend=backend, workers=workers, chunk_chars=chunk_chars,
+                                   used_backend=used_backend))
+        timings.append((backend, used_backend[0], time.time() - start))
+        if reference is None:
+            reference = results
+        elif results != reference:
+            raise RuntimeError("Batch backend %r gave different results than %r." % (backend, backends[0]))
+    return timings
+
+
+_RANDOM_BASES_TABLE = bytes.maketrans(bytes(range(256)), b"ACGT" * 64)
+
+
+def random_records(nrecords, length):
+    """ Return nrecords random DNA records of the given length (random bytes mapped to bases with bytes.translate). """
+    return [("seq%s" % i, os.urandom(length).translate(_RANDOM_BASES_TABLE).decode('ascii'))
+            for i in range(nrecords)]
+
+
+def format_result(name, result):
+    """ Return text for a single batch result (a FASTA record for sequences, a table row for stats). """
+    if isinstance(result, dict):
+        return "{}\t{length}\t{gc_content:0.3f}\t{gc}/{total}".format(name, **result)
+    return ">{}\n{}".format(name, result)
+
+
+class ElnBatchSequenceCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_batch_sequence
+    Apply a sequence operation to all FASTA records in the view (or in FASTA files), using a pool of
+    workers, and show the results in a new view. Files that cannot be read are reported, not fatal.
+    Args:
+        operation: A key in BATCH_OPERATIONS, e.g. "stats", "rcompl" or "translate".
+        filepath: Read records from this FASTA file (or list of files) instead of the view.
+        backend: "serial", "thread" or "process"; defaults to 'eln_batch_backend'.
+    """
+
+    def run(self, edit, operation="stats", filepath=None, backend=None):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        settings = get_settings()
+        self.operation = operation
+        if isinstance(filepath, str):
+            filepath = [filepath]
+        self.filepaths = [os.path.expanduser(path) for path in filepath] if filepath else None
+        self.text = None if filepath else self.view.substr(sublime.Region(0, self.view.size()))
+        self.map_kwargs = dict(
+            backend=backend or settings.get('eln_batch_backend', 'thread'),
+            workers=settings.get('eln_batch_workers'),
+            chunk_chars=settings.get('eln_batch_chunk_chars', 200000),
+        )
+        sublime.status_message("Running batch %s..." % operation)
+        sublime.set_timeout_async(self.process, 0)
+
+    def process(self):
+        start = time.time()
+        errors = []
+        if self.filepaths:
+            results = []
+            for filepath in self.filepaths:
+                try:
+                    with open(filepath, encoding='utf-8') as fd:
+                        results.extend(map_records(self.operation, iter_fasta_records(fd), **self.map_kwargs))
+                except (IOError, OSError, UnicodeDecodeError) as exc:
+                    print("Batch %s: Could not read %s: %r" % (self.operation, filepath, exc))
+                    errors.append("ERROR reading {}: {}".format(filepath, exc))
+        else:
+            results = list(map_records(self.operation, iter_fasta_records(self.text.split("\n")), **self.map_kwargs))
+        lines = errors + [format_result(name, result) for name, result in results]
+        if self.operation == "stats":
+            lines.insert(len(errors), "name\tlength\tgc_content\tgc/total")
+        msg = "Batch {}: {} records in {:.2f} s ({} backend){}".format(
+            self.operation, len(results), time.time() - start, resolve_backend(self.map_kwargs['backend']),
+            ", {} files could not be read".format(len(errors)) if errors else "")
+        print(msg)
+        sublime.set_timeout(lambda: self.show_results("\n".join(lines) + "\n", msg), 0)
+
+    def show_results(self, text, msg):
+        window = self.view.window() or sublime.active_window()
+        results_view = window.new_file()
+        results_view.set_name("Batch %s" % self.operation)
+        results_view.set_scratch(True)
+        results_view.run_command("append", {"characters": text})
+        sublime.status_message(msg)
+
+
+class ElnBatchBenchmarkCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_batch_benchmark
+    Benchmark the serial, thread and process batch backends on the FASTA records in the view,
+    (or on random sequences, if the view has no records) and print the timings to the console.
+    Args:
+        operation: A key in BATCH_OPERATIONS.
+        nrecords, length: Number and length of random sequences, if the view has no FASTA records.
+    """
+
+    def run(self, edit, operation="translate", nrecords=2000, length=5000):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        settings = get_settings()
+        workers = settings.get('eln_batch_workers')
+        chunk_chars = settings.get('eln_batch_chunk_chars', 200000)
+
+        def run_benchmark():
+            records = list(iter_fasta_records(text.split("\n"))) or random_records(nrecords, length)
+            timings = benchmark(operation, records, workers=workers, chunk_chars=chunk_chars)
+            serial = timings[0][2]
+            print("\nELN batch benchmark: {} on {} records ({} bases), {} workers:".format(
+                operation, len(records), sum(len(seq) for name, seq in records), workers or multiprocessing.cpu_count()))
+            for backend, used, seconds in timings:
+                label = backend if used == backend else "{} (fell back to {})".format(backend, used)
+                print(" - {:<8} {:7.3f} s  (speedup {:.2f}x)".format(label, seconds, serial / seconds))
+            sublime.status_message("Batch benchmark: " + ", ".join(
+                "{} {:.2f} s".format(used, seconds) for backend, used, seconds in timings))
+
+        sublime.status_message("Running batch benchmark...")
+        sublime.set_timeout_async(run_benchmark, 0)
@@ -0,0 +1,210 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Notebook activity dashboard: Experiments started per month, journal entries per day,
+journal notes merged per day, and sequence counts, for all pages in the experiments and projects base dirs.
+
+Each page is summarized once (journal entries per day, first journal date, number of sequences),
+and the summaries are cached by size and mtime (c.f. `eln_utils.FileSummaryCache`),
+so after the first build only changed pages are read again (or all pages, if 'eln_sequence_span_regex' changes). The dashboard aggregates
+are computed from the cached summaries, which takes milliseconds even for thousands of pages.
+
+Merged notes are counted by the merge commands, in the runtime state store.
+
+Settings:
+    'eln_dashboard_days'
+    'eln_dashboard_months'
+    'eln_sequence_span_regex'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+from collections import Counter
+from functools import lru_cache
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import (get_settings, get_state, get_cache_dir, FileSummaryCache, iter_notebook_files,
+                        find_sequence_spans, DEFAULT_SEQUENCE_SPAN_REGEX)
+from .eln_journal_index import parse_journal_line, iter_journal_entries
+logger = logging.getLogger(__name__)
+
+
+DASHBOARD_INDEX_FILENAME = 'eln_dashboard_index.json'
+DASHBOARD_INDEX_VERSION = 1
+_dashboard_index = None
+
+
+def get_sequence_pattern(settings=None):
+    return (settings or get_settings()).get('eln_sequence_span_regex') or DEFAULT_SEQUENCE_SPAN_REGEX
+
+
+@lru_cache(maxsize=4)
+def compile_sequence_regex(pattern):
+    return re.compile(pattern, re.MULTILINE)
+
+
+def summarize_page(filepath, sequence_regex=None):
+    """
+    Return summary dict for a notebook page with
+    'entries' (journal entries per day), 'first_date' (first journal date, or the file's mtime date),
+    and 'sequences' (number of sequences matching sequence_regex, by default 'eln_sequence_span_regex').
+    """
+    if sequence_regex is None:
+        sequence_regex = compile_sequence_regex(get_sequence_pattern())
+    with open(filepath, encoding='utf-8', errors='replace') as fp:
+        text = fp.read()
+    parsed = ((lineno, 0, parse_journal_line(line)) for lineno, line in enumerate(text.split("\n")))
+    entries = Counter()
+    dates = []
+    for kind, datestr, lineno, offset, entry_text in iter_journal_entries(parsed):
+        day = datestr.split(" ")[0]
+        if len(day) == 10:
+            dates.append(day)
+            if kind == "entry":
+                entries[day] += 1
+    first_date = min(dates) if dates else date.fromtimestamp(os.path.getmtime(filepath)).isoformat()
+    return {'entries': dict(entries), 'first_date': first_date,
+            'sequences': len(find_sequence_spans(text, sequence_regex))}
+
+
+def get_dashboard_index(settings=None):
+    """
+    Return the dashboard's page summary cache for the current sequence regex setting.
+    The regex is part of the cache version, so all pages are summarized again when the setting changes.
+    """
+    global _dashboard_index
+    pattern = get_sequence_pattern(settings)
+    version = "{}:{}".format(DASHBOARD_INDEX_VERSION, pattern)
+    if _dashboard_index is None or _dashboard_index.version != version:
+        sequence_regex = compile_sequence_regex(pattern)
+        _dashboard_index = FileSummaryCache(os.path.join(get_cache_dir(), DASHBOARD_INDEX_FILENAME),
+                                            lambda filepath: summarize_page(filepath, sequence_regex),
+                                            version=version)
+    return _dashboard_index
+
+
+def find_pages(settings=None):
+    """ Return list of (section, top-level folder, filepath) for pages in the experiments and projects base dirs. """
+    settings = settings or get_settings()
+    pattern = settings.get('eln_journal_index_file_pattern', '*.md')
+    pages = []
+    for section, basedir, filepath in iter_notebook_files(pattern, settings):
+        relpath = os.path.relpath(filepath, basedir)
+        folder = relpath.split(os.sep)[0] if os.sep in relpath else relpath
+        pages.append((section, folder, filepath))
+    return pages
+
+
+def aggregate(pages, summaries):
+    """
+    Compute dashboard aggregates from page summaries.
+    An experiment (or project) is a top-level folder in the base dir; it is started on the first date of its pages.
+    """
+    started = {"experiments": {}, "projects": {}}
+    entries_per_day = Counter()
+    sequences = Counter()
+    for section, folder, filepath in pages:
+        summary = summaries.get(filepath)
+        if summary is None:
+            continue
+        first = started[section].get(folder)
+        if first is None or summary['first_date'] < first:
+            started[section][folder] = summary['first_date']
+        entries_per_day.update(summary['entries'])
+        if summary['sequences']:
+            sequences[(section, folder)] += summary['sequences']
+    return {
+        'experiments_per_month': Counter(day[:7] for day in started["experiments"].values()),
+        'projects_per_month': Counter(day[:7] for day in started["projects"].values()),
+        'nexperiments': len(started["experiments"]),
+        'nprojects': len(started["projects"]),
+        'entries_per_day': entries_per_day,
+        'merged_notes_per_day': Counter(get_state().get("merged_notes_per_day", {})),
+        'sequences': sequences,
+        'npages': len(pages),
+    }
+
+
+def quarter_start(day):
+    return date(day.year, 3 * ((day.month - 1) // 3) + 1, 1)
+
+
+def render_dashboard(stats, days=30, months=12, today=None):
+    """ Render dashboard aggregates as a Markdown page. """
+    today = today or date.today()
+    this_month, this_quarter = today.strftime("%Y-%m"), quarter_start(today).strftime("%Y-%m")
+    per_month = stats['experiments_per_month']
+    last_days = [(today - timedelta(days=i)).isoformat() for i in range(days)]
+    lines = [
+        "# ELN Dashboard",
+        "",
+        "Updated {}: {nexperiments} experiments and {nprojects} projects in {npages} pages.".format(
+            datetime.now().strftime("%Y-%m-%d %H:%M"), **stats),
+        "",
+        "* Experiments started this month: {}".format(per_month.get(this_month, 0)),
+        "* Experiments started this quarter: {}".format(
+            sum(count for month, count in per_month.items() if this_quarter <= month <= this_month)),
+        "* Journal entries in the last {} days: {}".format(days, sum(stats['entries_per_day'][d] for d in last_days)),
+        "* Notes merged in the last {} days: {}".format(days, sum(stats['merged_notes_per_day'][d] for d in last_days)),
+        "* Sequences: {} (in {} experiments/projects)".format(
+            sum(stats['sequences'].values()), len(stats['sequences'])),
+        "",
+        "## Experiments started per month",
+        "",
+        "| Month   | Experiments | Projects |",
+        "|---------|-------------|----------|",
+    ]
+    for month in sorted(set(per_month) | set(stats['projects_per_month']), reverse=True)[:months]:
+        lines.append("| {} | {:>11} | {:>8} |".format(month, per_month.get(month, 0),
+                                                   stats['projects_per_month'].get(month, 0)))
+    lines += [
+        "",
+        "## Journal entries and merged notes per day (last {} days)".format(days),
+        "",
+        "| Date       | Entries | Notes merged |",
+        "|------------|---------|--------------|",
+    ]
+    for day in last_days:
+        entries, merged = stats['entries_per_day'][day], stats['merged_notes_per_day'][day]
+        if entries or merged:
+            lines.append("| {} | {:>7} | {:>12} |".format(day, entries, merged))
+    lines += ["", "## Most sequences", ""]
+    for (section, folder), count in stats['sequences'].most_common(10):
+        lines.append("* {} ({}): {}".format(folder, section, count))
+    return "\n".join(lines) + "\n"
+
+
+class ElnDashboardCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_dashboard
+    Show notebook activity statistics in a new view.
+    Only pages modified since the last time the dashboard was shown are read.
+    """
+
+    def run(self):
+        sublime.status_message("Updating ELN dashboard...")
+        sublime.set_timeout_async(self.update, 0)
+
+    def update(self):
+        start = time.time()
+        settings = get_settings()
+        pages = find_pages(settings)
+        summaries, nchanged = get_dashboard_index(settings).update([filepath for section, folder, filepath in pages])
+        stats = aggregate(pages, summaries)
+        text = render_dashboard(stats, days=settings.get('eln_dashboard_days', 30),
+                                months=settings.get('eln_dashboard_months', 12))
+        msg = "ELN dashboard: {} pages ({} re-read) in {:.0f} ms".format(len(pages), nchanged, 1000*(time.time() - start))
+        print(msg)
+        sublime.set_timeout(lambda: self.show(text, msg), 0)
+
+    def show(self, text, msg):
+        view = self.window.new_file()
+        view.set_name("ELN Dashboard")
+        view.set_scratch(True)
+        view.run_command("append", {"characters": text})
+        sublime.status_message(msg)
@@ -0,0 +1,227 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Primer-dimer, hairpin and cross-hybridization screening for sets of oligos.
+
+Instead of comparing all pairs of oligos base by base (O(N^2 * L^2)), all k-mers of all oligos are
+put in a hash index, and the reverse complement of each oligo is scanned against the index.
+Every hit is a k-base stretch of perfect complementarity between two oligos (or within one oligo);
+hits on the same diagonal are merged into maximal complementary stretches.
+Time and memory scale with the total sequence length plus the number of hits.
+
+Duplex stability is estimated with the SantaLucia (1998) unified nearest-neighbor parameters
+for the perfectly complementary stretch only (no mismatches, dangling ends or loop penalties),
+which is a reasonable ranking criterion, but not a substitute for a proper folding program.
+
+Settings:
+    'eln_dimer_min_length'
+    'eln_dimer_max_dg'
+    'eln_dimer_seed_length'
+    'eln_dimer_min_hairpin_loop'
+
+"""
+
+from __future__ import print_function, absolute_import
+import re
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, rcompl
+from .eln_oligos import iter_named_sequences, is_sequence_like, normalize_oligo
+logger = logging.getLogger(__name__)
+
+
+# SantaLucia 1998 unified nearest-neighbor free energies at 37 C (kcal/mol), for 5'-XY-3'/3'-X'Y'-5':
+NN_DG37 = {
+    "AA": -1.00, "TT": -1.00, "AT": -0.88, "TA": -0.58,
+    "CA": -1.45, "TG": -1.45, "GT": -1.44, "AC": -1.44,
+    "CT": -1.28, "AG": -1.28, "GA": -1.30, "TC": -1.30,
+    "CG": -2.17, "GC": -2.24, "GG": -1.84, "CC": -1.84,
+}
+# Initiation free energy, per duplex end, depending on the terminal base pair:
+NN_INIT_DG37 = {"G": 0.98, "C": 0.98, "A": 1.03, "T": 1.03}
+BASE_RUN_REGEX = re.compile(r"[ACGT]+")
+
+
+def duplex_dg(seq):
+    """ Return nearest-neighbor free energy (kcal/mol, 37 C) of seq paired with its perfect complement. """
+    if not seq:
+        return 0.0
+    return (sum(NN_DG37[seq[i:i+2]] for i in range(len(seq) - 1))
+            + NN_INIT_DG37[seq[0]] + NN_INIT_DG37[seq[-1]])
+
+
+def clean_oligo(seq):
+    """ Return the core sequence of an oligo (without mods and termini markers), in upper case DNA letters. """
+    return normalize_oligo(seq)[1].replace("U", "T")
+
+
+def build_kmer_index(seqs, k):
+    """
+    Return dict mapping k-mer to list of (seq index, position) for all k-mers in seqs.
+    K-mers containing non-bases (e.g. N or other IUPAC codes) are not indexed.
+    """
+    index = {}
+    for i, seq in enumerate(seqs):
+        for run in BASE_RUN_REGEX.finditer(seq):
+            for p in range(run.start(), run.end() - k + 1):
+                kmer = seq[p:p+k]
+                if kmer in index:
+                    index[kmer].append((i, p))
+                else:
+                    index[kmer] = [(i, p)]
+    return index
+
+
+def find_complementary_stretches(seqs, seed_length=8):
+    """
+    Find all maximal stretches of perfect complementarity (at least seed_length long) between seqs,
+    including within a single sequence.
+    Yields (i, start_i, j, start_j, length) tuples, where seqs[i][start_i:start_i+length] is the
+    reverse complement of seqs[j][start_j:start_j+length], and (i, start_i) <= (j, start_j).
+    """
+    k = seed_length
+    index = build_kmer_index(seqs, k)
+    for j, seq in enumerate(seqs):
+        rc = rcompl(seq, strict=False)
+        # Collect hits by (i, diagonal), in order of increasing position q in rc:
+        diagonals = {}
+        for run in BASE_RUN_REGEX.finditer(rc):
+            for q in range(run.start(), run.end() - k + 1):
+                for i, p in index.get(rc[q:q+k], ()):
+                    if i > j:
+                        continue
+                    key = (i, p - q)
+                    if key in diagonals:
+                        diagonals[key].append(q)
+                    else:
+                        diagonals[key] = [q]
+        # Merge consecutive hits on each diagonal to maximal stretches:
+        for (i, diagonal), qs in diagonals.items():
+            run_start = prev = qs[0]
+            for q in qs[1:] + [None]:
+                if q is not None and q == prev + 1:
+                    prev = q
+                    continue
+                length = prev - run_start + k
+                start_i = run_start + diagonal
+                start_j = len(seq) - run_start - length
+                if i < j or start_i <= start_j:
+                    yield i, start_i, j, start_j, length
+                run_start = prev = q
+
+
+def screen_oligos(oligos, min_length=8, max_dg=None, seed_length=5, min_hairpin_loop=3):
+    """
+    Screen (name, sequence) oligos for self-dimers, hairpin stems and cross-dimers.
+    A complementary stretch is reported if it is at least min_length bases,
+    or, if max_dg is given, if its estimated duplex free energy is at most max_dg (kcal/mol).
+    Returns list of dicts, sorted by free energy (most stable first).
+    """
+    names = [name for name, seq in oligos]
+    seqs = [clean_oligo(seq) for name, seq in oligos]
+    seed = min_length if max_dg is None else max(2, min(seed_length, min_length))
+    results = []
+    for i, start_i, j, start_j, length in find_complementary_stretches(seqs, seed):
+        stretch = seqs[i][start_i:start_i+length]
+        dg = duplex_dg(stretch)
+        if length < min_length and (max_dg is None or dg > max_dg):
+            continue
+        if i != j:
+            kind = "cross-dimer"
+        elif start_j - (start_i + length) >= min_hairpin_loop:
+            kind = "hairpin"
+        else:
+            kind = "self-dimer"
+        results.append(dict(kind=kind, name_i=names[i], seq_i=seqs[i], start_i=start_i,
+                            name_j=names[j], seq_j=seqs[j], start_j=start_j, length=length, dg=dg))
+    results.sort(key=lambda result: (result['dg'], -result['length']))
+    return results
+
+
+def format_result(result):
+    """ Return a multi-line text representation of a screening result, showing the paired stretches. """
+    seq_i, start_i, length = result['seq_i'], result['start_i'], result['length']
+    top = "5'-{}[{}]{}-3'".format(seq_i[:start_i], seq_i[start_i:start_i+length], seq_i[start_i+length:])
+    # The partner is written 3'->5' below, so the paired stretch is aligned with the top strand:
+    seq_j = result['seq_j'][::-1]
+    start_j = len(seq_j) - result['start_j'] - length
+    bottom = "3'-{}[{}]{}-5'".format(seq_j[:start_j], seq_j[start_j:start_j+length], seq_j[start_j+length:])
+    shift = start_i - start_j
+    top, bottom = " " * max(-shift, 0) + top, " " * max(shift, 0) + bottom
+    if result['kind'] == "hairpin":
+        header = "hairpin    {name_i}: {length} bp stem, dG {dg:.1f} kcal/mol (loop {loop} nt)".format(
+            loop=result['start_j'] - start_i - length, **result)
+    else:
+        header = "{kind:<10} {name_i} x {name_j}: {length} bp, dG {dg:.1f} kcal/mol".format(**result)
+    return "\n".join([header, "    " + top, "    " + bottom])
+
+
+def iter_oligos(text, min_length=8):
+    """
+    Yield (name, sequence) for named sequences in text, or, if there are none,
+    for each line that looks like a sequence (named by line number).
+    """
+    lines = text.split("\n")
+    found = False
+    for lineno, name, seq in iter_named_sequences(lines, min_length=min_length):
+        found = True
+        yield name, seq
+    if not found:
+        for lineno, line in enumerate(lines, 1):
+            if is_sequence_like(line, min_length):
+                yield "line %s" % lineno, line.strip()
+
+
+class ElnScreenDimersCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_screen_dimers
+    Screen the oligos in the selections (or the whole view, if nothing is selected) for
+    self-dimers, hairpins and cross-dimers, and show a report in a new view.
+    Oligos are named sequences (FASTA records or "name  sequence" table rows), or one sequence per line.
+    Args:
+        min_length: Minimum length of complementary stretches to report; defaults to 'eln_dimer_min_length'.
+        max_dg: Also report shorter stretches with estimated dG (kcal/mol) below this; defaults to 'eln_dimer_max_dg'.
+    """
+
+    def run(self, edit, min_length=None, max_dg=None):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        settings = get_settings()
+        selections = [sel for sel in self.view.sel() if not sel.empty()] or [sublime.Region(0, self.view.size())]
+        self.text = "\n".join(self.view.substr(sel) for sel in selections)
+        self.screen_kwargs = dict(
+            min_length=min_length or settings.get('eln_dimer_min_length', 8),
+            max_dg=max_dg if max_dg is not None else settings.get('eln_dimer_max_dg'),
+            seed_length=settings.get('eln_dimer_seed_length', 5),
+            min_hairpin_loop=settings.get('eln_dimer_min_hairpin_loop', 3),
+        )
+        self.oligo_min_length = settings.get('eln_oligo_min_length', 8)
+        sublime.status_message("Screening oligos for dimers and hairpins...")
+        sublime.set_timeout_async(self.screen, 0)
+
+    def screen(self):
+        oligos = list(iter_oligos(self.text, min_length=self.oligo_min_length))
+        if not oligos:
+            sublime.status_message("No oligo sequences found.")
+            return
+        results = screen_oligos(oligos, **self.screen_kwargs)
+        counts = {}
+        for result in results:
+            counts[result['kind']] = counts.get(result['kind'], 0) + 1
+        summary = "Screened {} oligos: {} cross-dimers, {} self-dimers, {} hairpins.".format(
+            len(oligos), counts.get("cross-dimer", 0), counts.get("self-dimer", 0), counts.get("hairpin", 0))
+        criteria = "Complementary stretches of at least {min_length} bp".format(**self.screen_kwargs)
+        if self.screen_kwargs['max_dg'] is not None:
+            criteria += " or dG <= {max_dg} kcal/mol".format(**self.screen_kwargs)
+        report = "\n\n".join(["# Oligo dimer screen", summary + "\n" + criteria + "."]
+                             + [format_result(result) for result in results]) + "\n"
+        print(summary)
+        sublime.set_timeout(lambda: self.show_report(report, summary), 0)
+
+    def show_report(self, report, summary):
+        window = self.view.window() or sublime.active_window()
+        report_view = window.new_file()
+        report_view.set_name("Oligo dimer screen")
+        report_view.set_scratch(True)
+        report_view.run_command("append", {"characters": report})
+        sublime.status_message(summary)
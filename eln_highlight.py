@@ -0,0 +1,296 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Highlighting of sequences, modifications and termini markers in notebook views.
+
+Sequence-like words (at least 8 letters, mostly A/C/G/T/U, in a single case, optionally with
+IDT modifications like /5Biosg/ and 5'/3' termini markers) are marked with `add_regions`,
+with separate region keys for the sequences, the modifications, the termini markers, and
+invalid characters inside sequences (e.g. a typo like "ATGCJTGC").
+
+Highlighting is incremental: right after each modification, the lines around the selections are marked
+as dirty with a hidden region (which Sublime keeps in place through later edits). After a pause in typing,
+only the dirty lines are read and tokenized (tokens are cached by line text), and the highlight regions
+in those lines are replaced; regions elsewhere have already been moved along by Sublime. Region kinds
+whose regions in the dirty lines didn't change are not touched.
+Edits that don't happen at the selections (undo/redo, revert) trigger a full re-highlight,
+and so does saving, as a safety net for e.g. plugins replacing text away from the cursor.
+
+Enable with the 'eln_sequence_highlighting' setting (in the package settings, or per view/syntax),
+or toggle for the current view with the eln_toggle_sequence_highlighting command.
+
+Settings:
+    'eln_sequence_highlighting'
+    'eln_sequence_highlighting_delay'
+    'eln_sequence_highlighting_scopes'
+
+"""
+
+from __future__ import print_function, absolute_import
+import re
+import threading
+from collections import OrderedDict
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, MODIFICATION_REGEX_PATTERNS, TERMINI_MARKERS
+logger = logging.getLogger(__name__)
+
+
+# Words of letters and IDT mods, optionally with termini markers, e.g. "5'-/5Phos/ATGCATGC-3'":
+CANDIDATE_REGEX = re.compile(
+    r"(?<![\w/])(?P<start>[53]['ʹ]-?)?(?P<body>(?:/[^/\s]+/|[A-Za-z])+)(?P<end>-?[53]['ʹ])?(?![\w/])"
+)
+MOD_REGEX = re.compile(MODIFICATION_REGEX_PATTERNS["IDT"])
+BASES = set("ACGTUacgtu")
+VALID_SEQUENCE_CHARS = set("ACGTUNRYKMSWBDHVacgtunrykmswbdhv")
+TOKEN_KINDS = ("sequence", "mod", "terminus", "invalid")
+DEFAULT_SCOPES = {
+    "sequence": "string",
+    "mod": "constant.language",
+    "terminus": "keyword",
+    "invalid": "invalid",
+}
+REGION_KEY_PREFIX = "eln_highlight_"
+DIRTY_REGION_KEY = REGION_KEY_PREFIX + "dirty"
+# Commands that modify the buffer away from the selections:
+FULL_UPDATE_COMMANDS = {"undo", "soft_undo", "redo", "redo_or_repeat", "soft_redo"}
+LINE_CACHE_SIZE = 50000
+
+
+def tokenize_line(line, min_length=8, min_base_fraction=0.8):
+    """
+    Return list of (start, end, kind) tokens in line, kind being one of TOKEN_KINDS.
+    A word counts as a sequence if it has at least min_length letters (excluding mods),
+    at least min_base_fraction of which are bases, all in the same case.
+    """
+    tokens = []
+    for match in CANDIDATE_REGEX.finditer(line):
+        body_start = match.start('body')
+        body = match.group('body')
+        parts = MOD_REGEX.split(body)
+        letters = "".join(parts)
+        if len(letters) < min_length or not (letters.isupper() or letters.islower()):
+            continue
+        if sum(1 for b in letters if b in BASES) < min_base_fraction * len(letters):
+            continue
+        tokens.append((match.start(), match.end(), "sequence"))
+        for group in ('start', 'end'):
+            marker = (match.group(group) or "").strip("-")
+            if marker in TERMINI_MARKERS:
+                marker_start = match.start(group) + match.group(group).index(marker)
+                tokens.append((marker_start, marker_start + len(marker), "terminus"))
+        for mod in MOD_REGEX.finditer(body):
+            tokens.append((body_start + mod.start(), body_start + mod.end(), "mod"))
+        # Blank out the mods, so they are not checked for invalid characters:
+        masked = MOD_REGEX.sub(lambda mod: " " * len(mod.group()), body)
+        for j, char in enumerate(masked):
+            if char != " " and char not in VALID_SEQUENCE_CHARS:
+                tokens.append((body_start + j, body_start + j + 1, "invalid"))
+    return tokens
+
+
+class LineTokenCache(object):
+    """
+    Cache of the tokens of lines, as returned by tokenize(line) (default: `tokenize_line`), keyed by the line's text.
+    The cache is a bounded LRU, shared by all views.
+    """
+
+    def __init__(self, tokenize=tokenize_line, cache_size=LINE_CACHE_SIZE):
+        self.tokenize = tokenize
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def get(self, line):
+        tokens = self.cache.get(line)
+        if tokens is None:
+            tokens = self.cache[line] = self.tokenize(line)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(line)
+        return tokens
+
+    def regions(self, text, offset=0):
+        """ Return dict with kind: list of sublime.Region for the tokens in text, starting at buffer offset. """
+        regions = {kind: [] for kind in TOKEN_KINDS}
+        for line in text.split("\n"):
+            for start, end, kind in self.get(line):
+                regions[kind].append(sublime.Region(offset + start, offset + end))
+            offset += len(line) + 1
+        return regions
+
+
+_line_tokens = LineTokenCache()
+_highlighted = set()  # Ids of views that have been highlighted.
+_full_update = set()  # Ids of views that need a full update.
+_row_counts = {}  # View id -> number of lines, at the last modification.
+_dirty_lock = threading.Lock()
+
+
+def is_highlighting_enabled(view):
+    return view.settings().get('eln_sequence_highlighting', get_settings().get('eln_sequence_highlighting', False))
+
+
+def mark_dirty(view):
+    """
+    Mark the lines around the selections as dirty. Called on the UI thread right after each modification,
+    where the selections are at the modified text. If lines were added (e.g. by pasting), the lines above
+    each selection are included, since the selection is at the end of the inserted text.
+    """
+    rows = view.rowcol(view.size())[0] + 1
+    added = max(0, rows - _row_counts.get(view.id(), rows))
+    _row_counts[view.id()] = rows
+    dirty = []
+    for selection in view.sel():
+        first_row = max(0, view.rowcol(selection.begin())[0] - added)
+        dirty.append(view.line(sublime.Region(view.text_point(first_row, 0), selection.end())))
+    with _dirty_lock:
+        view.add_regions(DIRTY_REGION_KEY, view.get_regions(DIRTY_REGION_KEY) + dirty, "", "", sublime.HIDDEN)
+
+
+def merge_line_spans(view, regions):
+    """ Return sorted list of non-overlapping regions covering the full lines of regions. """
+    spans = []
+    for line in sorted((view.line(region) for region in regions), key=lambda region: region.begin()):
+        if spans and line.begin() <= spans[-1].end() + 1:
+            spans[-1] = sublime.Region(spans[-1].begin(), max(spans[-1].end(), line.end()))
+        else:
+            spans.append(line)
+    return spans
+
+
+def bisect_regions(regions, pos, lo=0, key=sublime.Region.end):
+    """ Return index of the first region in (sorted, non-overlapping) regions with key(region) >= pos. """
+    hi = len(regions)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(regions[mid]) < pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def splice_regions(current, spans, new):
+    """
+    Replace the regions in current (sorted, as returned by view.get_regions) that are within spans with new.
+    Returns (regions, changed), changed being False if the regions within spans are already the same as new.
+    """
+    kept, replaced = [], []
+    last = 0
+    for span in spans:
+        first = bisect_regions(current, span.begin(), last)
+        end = bisect_regions(current, span.end() + 1, first, key=sublime.Region.begin)
+        kept.extend(current[last:first])
+        replaced.extend(current[first:end])
+        last = end
+    if replaced == new:
+        return current, False
+    kept.extend(current[last:])
+    return sorted(kept + new, key=lambda region: region.begin()), True
+
+
+def highlight_view(view, full=False):
+    """
+    Update the sequence highlighting of view, reading and tokenizing only the dirty lines (c.f. `mark_dirty`),
+    or the whole view if full is true (or if the view hasn't been highlighted yet).
+    """
+    view_id = view.id()
+    with _dirty_lock:
+        dirty = view.get_regions(DIRTY_REGION_KEY)
+        view.erase_regions(DIRTY_REGION_KEY)
+    if full or view_id not in _highlighted or view_id in _full_update:
+        _full_update.discard(view_id)
+        _highlighted.add(view_id)
+        _row_counts[view_id] = view.rowcol(view.size())[0] + 1
+        spans = [sublime.Region(0, view.size())]
+    else:
+        spans = merge_line_spans(view, dirty)
+        if not spans:
+            return
+    new_regions = {kind: [] for kind in TOKEN_KINDS}
+    for span in spans:
+        for kind, regions in _line_tokens.regions(view.substr(span), span.begin()).items():
+            new_regions[kind].extend(regions)
+    scopes = dict(DEFAULT_SCOPES, **(get_settings().get('eln_sequence_highlighting_scopes') or {}))
+    for kind in TOKEN_KINDS:
+        key = REGION_KEY_PREFIX + kind
+        regions, changed = splice_regions(view.get_regions(key), spans, new_regions[kind])
+        if changed:
+            flags = sublime.DRAW_NO_FILL if kind == "sequence" else 0
+            view.add_regions(key, regions, scopes[kind], "", flags)
+
+
+def forget_view(view_id):
+    _highlighted.discard(view_id)
+    _full_update.discard(view_id)
+    _row_counts.pop(view_id, None)
+
+
+def clear_highlighting(view):
+    forget_view(view.id())
+    for kind in TOKEN_KINDS:
+        view.erase_regions(REGION_KEY_PREFIX + kind)
+    view.erase_regions(DIRTY_REGION_KEY)
+
+
+class ElnSequenceHighlightListener(sublime_plugin.EventListener):
+    """ Highlight sequences in views where 'eln_sequence_highlighting' is enabled, updating after modifications. """
+
+    def on_load_async(self, view):
+        if is_highlighting_enabled(view):
+            highlight_view(view)
+
+    def on_activated_async(self, view):
+        if is_highlighting_enabled(view) and view.id() not in _highlighted:
+            highlight_view(view)
+
+    def on_modified(self, view):
+        if view.id() in _highlighted and is_highlighting_enabled(view):
+            mark_dirty(view)
+
+    def on_post_text_command(self, view, command_name, args):
+        if command_name in FULL_UPDATE_COMMANDS and view.id() in _highlighted:
+            _full_update.add(view.id())
+
+    def on_revert(self, view):
+        if view.id() in _highlighted:
+            _full_update.add(view.id())
+
+    def on_post_save_async(self, view):
+        if view.id() in _highlighted and is_highlighting_enabled(view):
+            highlight_view(view, full=True)
+
+    def on_modified_async(self, view):
+        if not is_highlighting_enabled(view):
+            return
+        # Wait for a pause in typing; skip the update if the view has been modified again since.
+        change_count = view.change_count()
+        delay = get_settings().get('eln_sequence_highlighting_delay', 150)
+
+        def update():
+            if view.is_valid() and view.change_count() == change_count:
+                highlight_view(view)
+
+        sublime.set_timeout_async(update, delay)
+
+    def on_close(self, view):
+        forget_view(view.id())
+
+
+class ElnToggleSequenceHighlightingCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_toggle_sequence_highlighting
+    Toggle sequence highlighting for the current view.
+    """
+
+    def run(self, edit):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        enabled = not is_highlighting_enabled(self.view)
+        self.view.settings().set('eln_sequence_highlighting', enabled)
+        if enabled:
+            highlight_view(self.view)
+        else:
+            clear_highlighting(self.view)
+        sublime.status_message("Sequence highlighting %s" % ("enabled" if enabled else "disabled"))
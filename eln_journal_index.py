@@ -0,0 +1,235 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Journal index: Jump to any journal date or entry in the current page, or in any notebook page.
+
+Journal date headers and entry timestamps are recognized with regexes derived from the
+'journal_date_header' and 'journal_timestamp' snippet formats, e.g.
+
+    '''Journal, 2019-03-14:'''
+    * 10:42 > Started the ligation.
+
+The per-view index is a line cache (c.f. `eln_highlight.LineTokenCache`) that is updated incrementally
+after modifications, so only changed lines are parsed again.
+The notebook-wide index is persisted in Sublime's cache dir, and only files whose size or mtime
+has changed since they were last indexed are parsed again.
+
+Settings:
+    'eln_journal_index_file_pattern'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import re
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, get_cache_dir, snippets, FileSummaryCache, iter_notebook_files
+from .eln_highlight import LineTokenCache
+logger = logging.getLogger(__name__)
+
+
+JOURNAL_INDEX_FILENAME = 'eln_journal_index.json'
+JOURNAL_INDEX_VERSION = 1
+# Regexes for strftime directives; directives not listed here match any text.
+STRFTIME_REGEXES = {
+    '%Y': r"(?P<year>\d{4})",
+    '%m': r"(?P<month>\d{1,2})",
+    '%d': r"(?P<day>\d{1,2})",
+    '%H': r"(?P<hour>\d{1,2})",
+    '%M': r"(?P<minute>\d{2})",
+    '%S': r"(?P<second>\d{2})",
+    '%%': r"%",
+}
+
+
+def format_to_regex(fmt):
+    """
+    Convert the first line of a snippet format with a {date:<strftime format>} field, e.g. "* {date:%H:%M} > ",
+    to a compiled regex matching a line starting with the formatted text. The rest of the line is the 'text' group.
+    """
+    fmt = fmt.split("\n")[0].strip()
+    regex, seen = [r"^\s*"], set()
+    for i, part in enumerate(re.split(r"\{date(?::([^}]*))?\}", fmt)):
+        if i % 2 == 0:
+            regex.append(re.escape(part))
+        else:
+            for j, token in enumerate(re.split(r"(%.)", part or "%Y-%m-%d %H:%M:%S")):
+                if j % 2 == 0:
+                    regex.append(re.escape(token))
+                elif token in STRFTIME_REGEXES and token not in seen:
+                    seen.add(token)
+                    regex.append(STRFTIME_REGEXES[token])
+                else:
+                    regex.append(r".+?")
+    regex.append(r"\s*(?P<text>.*)$")
+    return re.compile("".join(regex))
+
+
+HEADER_REGEX = format_to_regex(snippets['journal_date_header'])
+ENTRY_REGEX = format_to_regex(snippets['journal_timestamp'])
+
+
+def format_match_date(match):
+    """ Return the date and/or time in a header or timestamp match as "YYYY-mm-dd", "HH:MM" or "YYYY-mm-dd HH:MM". """
+    groups = match.groupdict()
+    parts = []
+    if groups.get('year') and groups.get('month') and groups.get('day'):
+        parts.append("{}-{:02d}-{:02d}".format(groups['year'], int(groups['month']), int(groups['day'])))
+    if groups.get('hour') and groups.get('minute'):
+        parts.append("{:02d}:{}".format(int(groups['hour']), groups['minute']))
+    return " ".join(parts)
+
+
+def parse_journal_line(line):
+    """ Return [("header", date, text)] or [("entry", time, text)] if line is a journal header or entry, else []. """
+    for kind, regex in (("header", HEADER_REGEX), ("entry", ENTRY_REGEX)):
+        match = regex.match(line)
+        if match:
+            date = format_match_date(match)
+            if date:
+                return [(kind, date, match.group('text').strip())]
+    return []
+
+
+def iter_journal_entries(parsed_lines):
+    """
+    Yield (kind, datetime string, line number, offset, text) for headers and entries,
+    from an iterable of (line number, offset, tokens) with tokens from `parse_journal_line`.
+    Entries get the date of the preceding header.
+    """
+    current_date = ""
+    for lineno, offset, tokens in parsed_lines:
+        for kind, date, text in tokens:
+            if kind == "header":
+                current_date = date.split(" ")[0]
+            elif len(date) <= 5 and current_date:
+                date = current_date + " " + date
+            yield kind, date, lineno, offset, text
+
+
+def summarize_journal_file(filepath):
+    """ Return list of [kind, datetime string, line number, text] for all journal headers and entries in file. """
+    with open(filepath, encoding='utf-8', errors='replace') as fp:
+        parsed = ((lineno, 0, parse_journal_line(line)) for lineno, line in enumerate(fp))
+        return [[kind, date, lineno, text[:120]] for kind, date, lineno, offset, text in iter_journal_entries(parsed)]
+
+
+def format_item(kind, date, text):
+    if kind == "header":
+        return "{}  ({})".format(date, text) if text else date
+    return "    {}  {}".format(date, text)
+
+
+_view_indexes = {}
+_notebook_index = None
+
+
+def get_view_index(view):
+    """ Return the journal line index of view, updated with any changes since the last update. """
+    index = _view_indexes.get(view.id())
+    if index is None:
+        index = _view_indexes[view.id()] = LineTokenCache(tokenize=parse_journal_line)
+    index.update(view.substr(sublime.Region(0, view.size())))
+    return index
+
+
+def get_notebook_index():
+    global _notebook_index
+    if _notebook_index is None:
+        _notebook_index = FileSummaryCache(os.path.join(get_cache_dir(), JOURNAL_INDEX_FILENAME),
+                                           summarize_journal_file, version=JOURNAL_INDEX_VERSION)
+    return _notebook_index
+
+
+def find_notebook_files(settings=None):
+    """ Return list of all notebook pages in the experiments and projects base directories. """
+    settings = settings or get_settings()
+    pattern = settings.get('eln_journal_index_file_pattern', '*.md')
+    return sorted({filepath for section, basedir, filepath in iter_notebook_files(pattern, settings)})
+
+
+class ElnJournalIndexListener(sublime_plugin.EventListener):
+    """ Keep journal indexes of views up to date (only for views that have been indexed). """
+
+    def on_modified_async(self, view):
+        if view.id() not in _view_indexes:
+            return
+        change_count = view.change_count()
+
+        def update():
+            if view.is_valid() and view.change_count() == change_count:
+                get_view_index(view)
+
+        sublime.set_timeout_async(update, 500)
+
+    def on_close(self, view):
+        _view_indexes.pop(view.id(), None)
+
+
+class ElnJournalGotoCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_journal_goto
+    Show a quick panel with the journal dates (and entries) in the current view, newest first,
+    and move the cursor to the selected date or entry.
+    Args:
+        entries: Include entries, not just the date headers.
+    """
+
+    def run(self, edit, entries=True):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        index = get_view_index(self.view)
+        parsed = ((lineno, offset, tokens) for lineno, offset, line, tokens in index.iter_lines() if tokens)
+        self.entries = [entry for entry in iter_journal_entries(parsed) if entries or entry[0] == "header"][::-1]
+        if not self.entries:
+            sublime.status_message("No journal entries found.")
+            return
+        items = [format_item(kind, date, text) for kind, date, lineno, offset, text in self.entries]
+        self.view.window().show_quick_panel(items, self.on_selected)
+
+    def on_selected(self, index):
+        if index < 0:
+            return
+        offset = self.entries[index][3]
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(offset))
+        self.view.show_at_center(offset)
+
+
+class ElnJournalGotoNotebookCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_journal_goto_notebook
+    Show a quick panel with the journal dates (and entries) in all notebook pages in the experiments and
+    projects base directories, newest first, and open the selected page at the selected date or entry.
+    Uses a persistent index, so only pages modified since the last time are read.
+    Args:
+        entries: Include entries, not just the date headers.
+    """
+
+    def run(self, entries=False):
+        self.include_entries = entries
+        sublime.status_message("Updating journal index...")
+        sublime.set_timeout_async(self.update_index, 0)
+
+    def update_index(self):
+        filepaths = find_notebook_files()
+        summaries, nchanged = get_notebook_index().update(filepaths)
+        self.entries = sorted(
+            ((date, filepath, lineno, kind, text) for filepath, summary in summaries.items()
+             for kind, date, lineno, text in summary if self.include_entries or kind == "header"),
+            reverse=True)
+        print("ELN journal index: {} files ({} re-indexed), {} items.".format(
+            len(filepaths), nchanged, len(self.entries)))
+        if not self.entries:
+            sublime.status_message("No journal entries found in the notebook.")
+            return
+        items = [[format_item(kind, date, text), os.path.basename(filepath)]
+                 for date, filepath, lineno, kind, text in self.entries]
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, self.on_selected), 0)
+
+    def on_selected(self, index):
+        if index < 0:
+            return
+        date, filepath, lineno, kind, text = self.entries[index]
+        self.window.open_file("{}:{}".format(filepath, lineno + 1), sublime.ENCODED_POSITION)
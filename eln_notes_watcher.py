@@ -0,0 +1,350 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Background watcher for journal notes files.
+
+Notes files land in `external_journal_dirs` continuously (e.g. from phone sync).
+The watcher detects new or changed notes files and routes them to the matching experiment,
+using `notes_filename_pat`, `view_filename_pat` and `notes_filename_keys`, just like `eln_merge_journal_notes`:
+
+* In 'queue' mode, notes are queued for the experiment, and views of the experiment show a status message.
+    Run "ELN: Merge queued notes" to merge them all with one command.
+* In 'append' mode, notes are merged directly to the end of the matching open view.
+
+On Linux the directories are watched with inotify (no CPU use while idle).
+Elsewhere, the directories are polled for mtime/size changes, backing off exponentially while nothing changes.
+
+Settings:
+    'journal_notes_watcher_enabled'
+    'journal_notes_watcher_mode'
+    'journal_notes_watcher_poll_interval'
+    'journal_notes_watcher_merge_args'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import re
+import glob
+import fnmatch
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings
+logger = logging.getLogger(__name__)
+
+
+WATCHER_STATUS_KEY = 'eln_journal_notes'
+# How long to wait for more events before processing changed files; sync clients often write files in several steps.
+SETTLE_DELAY = 1.0
+
+# inotify constants, c.f. /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def load_libc_inotify():
+    """ Return libc if it provides inotify (Linux), else None. """
+    if not sublime.platform() == 'linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init  # Raises AttributeError if not available.
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def list_notes_files(note_dirs, pattern, min_file_size=0):
+    """ Return dict with {filepath: (mtime, size)} for all notes files in note_dirs. """
+    snapshot = {}
+    for dirpath in note_dirs:
+        for filepath in glob.glob(os.path.join(dirpath, pattern)):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue  # File was removed while listing.
+            if stat.st_size >= min_file_size and os.path.isfile(filepath):
+                snapshot[filepath] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+
+class JournalNotesWatcher(threading.Thread):
+    """
+    Thread watching note_dirs for new or changed notes files matching pattern.
+    Calls `callback(filepaths)` (in the watcher thread) with a list of new/changed files.
+    Existing files are not reported when the watcher is started.
+    """
+
+    def __init__(self, note_dirs, pattern, callback, min_file_size=10, poll_interval=(2, 120)):
+        super().__init__(name="ELN journal notes watcher")
+        self.daemon = True
+        self.note_dirs = [d for d in note_dirs if os.path.isdir(d)]
+        self.pattern = pattern
+        self.callback = callback
+        self.min_file_size = min_file_size
+        self.min_interval, self.max_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.snapshot = {}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.snapshot = list_notes_files(self.note_dirs, self.pattern, self.min_file_size)
+        libc = load_libc_inotify()
+        if libc is not None:
+            try:
+                self.watch_inotify(libc)
+                return
+            except OSError as exc:
+                print("ELN journal notes watcher: inotify failed (%s), falling back to polling." % (exc,))
+        self.watch_polling()
+
+    def check_for_changes(self):
+        """ Compare directory listing with the last snapshot and report new/changed files. """
+        snapshot = list_notes_files(self.note_dirs, self.pattern, self.min_file_size)
+        changed = sorted(fp for fp, stat in snapshot.items() if self.snapshot.get(fp) != stat)
+        self.snapshot = snapshot
+        if changed:
+            self.callback(changed)
+        return changed
+
+    def watch_polling(self):
+        """ Poll for changes, doubling the interval (up to max_interval) every time nothing has changed. """
+        interval = self.min_interval
+        while not self.stop_event.wait(interval):
+            if self.check_for_changes():
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+
+    def watch_inotify(self, libc):
+        """ Block on inotify events; changes are checked once the directories have been quiet for SETTLE_DELAY. """
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        try:
+            for dirpath in self.note_dirs:
+                wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s" % dirpath)
+            pending = False
+            while not self.stop_event.is_set():
+                # Wake up periodically to check the stop flag; when events are pending, wait only until settled.
+                readable, _, _ = select.select([fd], [], [], SETTLE_DELAY if pending else 5.0)
+                if not readable:
+                    if pending:
+                        pending = False
+                        self.check_for_changes()
+                    continue
+                data = os.read(fd, 64 * 1024)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = IN_EVENT_HEADER.unpack_from(data, offset)
+                    name = data[offset + IN_EVENT_HEADER.size:offset + IN_EVENT_HEADER.size + length].rstrip(b'\0')
+                    offset += IN_EVENT_HEADER.size + length
+                    if fnmatch.fnmatch(os.fsdecode(name), self.pattern):
+                        pending = True
+        finally:
+            os.close(fd)
+
+
+class JournalNotesRouter(object):
+    """
+    Routes changed notes files to experiment views, either queueing them or merging them into the view.
+    Queued notes files are kept per experiment key (the values of `notes_filename_keys`).
+    """
+
+    def __init__(self):
+        self.queued = {}  # key-tuple -> set of filepaths
+        self.lock = threading.Lock()
+
+    def get_regexes(self):
+        settings = get_settings()
+        view_filename_pat = settings.get('view_filename_pat')
+        notes_filename_pat = settings.get('notes_filename_pat')
+        keys = settings.get('notes_filename_keys')
+        if not (view_filename_pat and notes_filename_pat and keys):
+            return None, None, None
+        return re.compile(view_filename_pat), re.compile(notes_filename_pat), keys
+
+    def view_key(self, view, view_regex=None, keys=None):
+        """ Return the experiment key for a view, or None if the view's filename does not match. """
+        if view_regex is None:
+            view_regex, _, keys = self.get_regexes()
+        filename = view.file_name()
+        if not (view_regex and filename):
+            return None
+        match = view_regex.match(os.path.basename(filename))
+        return tuple(match.group(key) for key in keys) if match else None
+
+    def on_files_changed(self, filepaths):
+        """ Called in the watcher thread; routing is done on the main thread where we can access views. """
+        sublime.set_timeout(lambda: self.route(filepaths), 0)
+
+    def route(self, filepaths):
+        view_regex, notes_regex, keys = self.get_regexes()
+        if notes_regex is None:
+            print("ELN journal notes watcher: view_filename_pat, notes_filename_pat and notes_filename_keys "
+                  "must be configured to route notes.")
+            return
+        settings = get_settings()
+        mode = settings.get('journal_notes_watcher_mode', 'queue')
+        merge_args = settings.get('journal_notes_watcher_merge_args') or {}
+        views_by_key = {}
+        for window in sublime.windows():
+            for view in window.views():
+                key = self.view_key(view, view_regex, keys)
+                if key is not None:
+                    views_by_key.setdefault(key, []).append(view)
+
+        routed_keys = set()
+        for filepath in filepaths:
+            match = notes_regex.match(os.path.basename(filepath))
+            if not match:
+                continue
+            key = tuple(match.group(k) for k in keys)
+            with self.lock:
+                self.queued.setdefault(key, set()).add(filepath)
+            routed_keys.add(key)
+        for key in routed_keys:
+            views = views_by_key.get(key, [])
+            if views and mode == 'append':
+                self.merge_queued(views[0], merge_args=merge_args, position=-1)
+            else:
+                for view in views:
+                    self.update_status(view, key)
+        print("ELN journal notes watcher: routed %s changed files for %s experiments." % (
+            len(filepaths), len(routed_keys)))
+
+    def queued_files(self, key):
+        with self.lock:
+            return sorted(self.queued.get(key, ()))
+
+    def update_status(self, view, key=None):
+        if key is None:
+            key = self.view_key(view)
+        queued = self.queued_files(key) if key is not None else []
+        if queued:
+            view.set_status(WATCHER_STATUS_KEY, "ELN: {} new journal notes files".format(len(queued)))
+        else:
+            view.erase_status(WATCHER_STATUS_KEY)
+
+    def merge_queued(self, view, merge_args=None, position=None):
+        """
+        Merge the notes files queued for the view's experiment into the view.
+        The merge is asynchronous; files are removed from the queue by `mark_merged` once they have been merged.
+        """
+        key = self.view_key(view)
+        queued = self.queued_files(key) if key is not None else []
+        if not queued:
+            sublime.status_message("ELN: No queued journal notes files for this experiment.")
+            return
+        args = {"move": True, "add_journal_header": True, "paragraphs_to_bullet": True, "add_timestamp": True}
+        args.update(merge_args or {})
+        args.update(filepaths=queued, position=position, on_merged="eln_journal_notes_merged")
+        view.run_command("eln_merge_journal_notes", args)
+
+    def mark_merged(self, view, filepaths):
+        """ Remove merged (or since removed) notes files from the queue, and update the view's status. """
+        merged = set(filepaths)
+        with self.lock:
+            for key, queued in list(self.queued.items()):
+                queued.difference_update([fp for fp in queued if fp in merged or not os.path.isfile(fp)])
+                if not queued:
+                    del self.queued[key]
+        self.update_status(view)
+
+
+router = JournalNotesRouter()
+_watcher = None
+_watcher_config = None
+
+
+def get_watcher_config(settings=None):
+    """ Return a tuple with the settings used by the watcher thread, used to detect when a restart is needed. """
+    if settings is None:
+        settings = get_settings()
+    return (
+        bool(settings.get('journal_notes_watcher_enabled', False)),
+        tuple(settings.get('external_journal_dirs') or ()),
+        settings.get('journal_notes_pattern', '*'),
+        settings.get('min_file_size', 10),
+        tuple(settings.get('journal_notes_watcher_poll_interval', [2, 120])),
+    )
+
+
+def start_watcher():
+    """ (Re)start the journal notes watcher according to the current settings. """
+    global _watcher, _watcher_config
+    stop_watcher()
+    _watcher_config = enabled, note_dirs, pattern, min_file_size, poll_interval = get_watcher_config()
+    if not enabled:
+        return
+    if not note_dirs:
+        print("ELN journal notes watcher: 'external_journal_dirs' is not configured; not starting watcher.")
+        return
+    _watcher = JournalNotesWatcher(
+        note_dirs, pattern, router.on_files_changed, min_file_size=min_file_size, poll_interval=poll_interval)
+    _watcher.start()
+    print("ELN journal notes watcher started for", _watcher.note_dirs)
+
+
+def stop_watcher():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
+
+
+def on_settings_changed():
+    """ Restart the watcher only if one of the settings it uses has changed. """
+    if get_watcher_config() != _watcher_config:
+        start_watcher()
+
+
+def plugin_loaded():
+    get_settings().add_on_change('eln_journal_notes_watcher', on_settings_changed)
+    start_watcher()
+
+
+def plugin_unloaded():
+    get_settings().clear_on_change('eln_journal_notes_watcher')
+    stop_watcher()
+
+
+class ElnMergeQueuedJournalNotesCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_merge_queued_journal_notes
+    Merge all notes files queued by the journal notes watcher for the current view's experiment.
+    Arguments are passed on to `eln_merge_journal_notes`, e.g. add_journal_header.
+    """
+    def run(self, edit, position=None, **merge_args):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        router.merge_queued(self.view, merge_args=merge_args, position=position)
+
+
+class ElnJournalNotesMergedCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_journal_notes_merged
+    Run by `eln_merge_journal_notes` (as `on_merged`) after queued notes files have been merged into the view.
+    """
+    def run(self, edit, filepaths=()):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        router.mark_merged(self.view, filepaths)
+
+
+class ElnJournalNotesWatcherListener(sublime_plugin.EventListener):
+    """ Show the number of queued notes files in the status bar when a matching view is activated. """
+
+    def on_activated(self, view):
+        if _watcher is not None:
+            router.update_status(view)
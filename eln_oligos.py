@@ -0,0 +1,329 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Oligo order-sheet export.
+
+Finds named sequences in notebook pages, e.g. lines in order tables like
+
+    RS123_fwd   5'-/5Biosg/ATGCATGCATGC-3'   100nm
+    | RS123_rev | [Cy5]GCATGCATGCAT |
+
+or FASTA records, validates them, normalizes modifications to IDT notation,
+and writes an order sheet (CSV) that can be uploaded to the vendor, either as a
+list of tubes (Name, Sequence, Scale, Purification) or as plate layouts (Well Position, Name, Sequence).
+
+Files are read line by line and rows are written as they are found, so memory use is bounded
+regardless of the number of files or sequences.
+
+Settings:
+    'eln_oligo_min_length'
+    'eln_oligo_mod_aliases'
+    'eln_oligo_order_scale'
+    'eln_oligo_order_purification'
+    'eln_oligo_export_file_pattern'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import re
+import csv
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, dna_filter, find_experiment_files, MODIFICATION_REGEX_PATTERNS, TERMINI_MARKERS
+logger = logging.getLogger(__name__)
+
+
+# "name<separator>sequence", where separator is ':', tab, '|', ',', ';' or whitespace (e.g. in tables):
+NAMED_SEQUENCE_REGEX = re.compile(
+    r"^[\s|*>-]*(?P<name>[^\s|:,;]+)\s*(?:[:\t|,;]\s*|\s+)(?P<seq>[^\s|,;]+)(?:\s|[|,;]|$)"
+)
+# Modifications in IDT notation (/5Biosg/), or in square or curly brackets ([Biotin], {FAM}):
+MOD_TOKEN_REGEX = re.compile("(%s)" % "|".join(
+    list(MODIFICATION_REGEX_PATTERNS.values()) + [r"\[[^\]\s]*\]", r"\{[^}\s]*\}"]))
+SEQUENCE_CHARS = set("ACGTUNRYKMSWBDHV")
+PLATE_SIZES = {96: (8, 12), 384: (16, 24)}
+
+# Common modification names and their IDT codes at the 5' end, internally, and at the 3' end:
+IDT_MOD_ALIASES = {
+    'biotin': {'5': '/5Biosg/', 'i': '/iBiodT/', '3': '/3Bio/'},
+    'bio': {'5': '/5Biosg/', 'i': '/iBiodT/', '3': '/3Bio/'},
+    'phos': {'5': '/5Phos/', '3': '/3Phos/'},
+    'phosphate': {'5': '/5Phos/', '3': '/3Phos/'},
+    'fam': {'5': '/56-FAM/', 'i': '/iFluorT/', '3': '/36-FAM/'},
+    'cy3': {'5': '/5Cy3/', 'i': '/iCy3/', '3': '/3Cy3Sp/'},
+    'cy5': {'5': '/5Cy5/', 'i': '/iCy5/', '3': '/3Cy5Sp/'},
+    'amine': {'5': '/5AmMC6/', 'i': '/iUniAmM/', '3': '/3AmMO/'},
+    'nh2': {'5': '/5AmMC6/', 'i': '/iUniAmM/', '3': '/3AmMO/'},
+    'thiol': {'5': '/5ThioMC6-D/', '3': '/3ThioMC3-D/'},
+    'sh': {'5': '/5ThioMC6-D/', '3': '/3ThioMC3-D/'},
+    'tamra': {'5': '/56-TAMN/', '3': '/36-TAMSp/'},
+    'cholesterol': {'5': '/5CholTEG/', '3': '/3CholTEG/'},
+    'chol': {'5': '/5CholTEG/', '3': '/3CholTEG/'},
+}
+
+
+def strip_termini_markers(seq):
+    """ Remove 5'/3' termini markers (and the dashes next to them) from the ends of seq. """
+    seq = seq.strip()
+    for marker in TERMINI_MARKERS:
+        if seq.startswith(marker):
+            seq = seq[len(marker):].lstrip("-")
+        if seq.endswith(marker):
+            seq = seq[:-len(marker)].rstrip("-")
+    return seq
+
+
+def is_sequence_like(seq, min_length=8):
+    """ Return true if seq (with mods and termini markers) looks like an oligo sequence (even if invalid). """
+    core = "".join(MOD_TOKEN_REGEX.split(strip_termini_markers(seq))[::2]).replace("-", "").upper()
+    if len(core) < min_length:
+        return False
+    return sum(1 for b in core if b in SEQUENCE_CHARS) >= 0.8 * len(core)
+
+
+def normalize_oligo(seq, mod_aliases=None):
+    """
+    Normalize an oligo sequence to IDT notation.
+    Returns (normalized sequence, core sequence without mods, list of problems).
+    Modifications are mapped to IDT codes using mod_aliases, depending on their position (5', internal, 3').
+    """
+    if mod_aliases is None:
+        mod_aliases = IDT_MOD_ALIASES
+    problems = []
+    parts = MOD_TOKEN_REGEX.split(strip_termini_markers(seq))
+    seq_parts = [part.replace("-", "").replace(" ", "").upper() for part in parts[::2]]
+    core = "".join(seq_parts)
+    out = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            out.append(seq_parts[i // 2])
+            continue
+        name = part[1:-1]
+        position = ('5' if not "".join(seq_parts[:i // 2 + 1]) else
+                    '3' if not "".join(seq_parts[i // 2 + 1:]) else 'i')
+        idt_codes = mod_aliases.get(name.lower())
+        if idt_codes:
+            if position in idt_codes:
+                out.append(idt_codes[position])
+                continue
+            problems.append("modification %r not available at position %s" % (name, position))
+        elif not part.startswith("/"):
+            problems.append("unknown modification %r" % (name,))
+        out.append("/%s/" % name)
+    valid_core = dna_filter(core, degenerate=True)
+    if valid_core != core:
+        problems.append("invalid characters: %s" % "".join(sorted(set(core) - set(valid_core))))
+    return "".join(out), core, problems
+
+
+def iter_named_sequences(lines, min_length=8):
+    """
+    Yield (lineno, name, sequence) for all named sequences in lines, in a single pass.
+    Recognizes FASTA records and "name <separator> sequence" lines (e.g. table rows).
+    """
+    fasta_name = fasta_lineno = None
+    fasta_parts = []
+    for lineno, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if fasta_name is not None:
+            if stripped and not stripped.startswith(">") and len(stripped.split()) == 1:
+                fasta_parts.append(stripped)
+                continue
+            fasta_seq = "".join(fasta_parts)
+            if is_sequence_like(fasta_seq, min_length):
+                yield fasta_lineno, fasta_name, fasta_seq
+            fasta_name, fasta_parts = None, []
+        match = NAMED_SEQUENCE_REGEX.match(line)
+        if match and is_sequence_like(match.group('seq'), min_length):
+            yield lineno, match.group('name'), match.group('seq')
+        elif stripped.startswith(">") and len(stripped) > 1 and not stripped.startswith(">>"):
+            # FASTA header (or a markdown quote; the record is discarded if it doesn't contain a sequence).
+            fasta_name, fasta_lineno = stripped[1:].split()[0], lineno
+    if fasta_name is not None:
+        fasta_seq = "".join(fasta_parts)
+        if is_sequence_like(fasta_seq, min_length):
+            yield fasta_lineno, fasta_name, fasta_seq
+
+
+def iter_well_positions(plate_size=96, fill_order="column"):
+    """ Yield well positions (A1, B1, ...) for a plate, filling by column (default) or by row. """
+    nrows, ncols = PLATE_SIZES[plate_size]
+    rows = [chr(ord('A') + i) for i in range(nrows)]
+    if fill_order == "row":
+        for row in rows:
+            for col in range(1, ncols + 1):
+                yield "%s%s" % (row, col)
+    else:
+        for col in range(1, ncols + 1):
+            for row in rows:
+                yield "%s%s" % (row, col)
+
+
+class OrderSheetWriter(object):
+    """
+    Streams order rows to CSV file(s). Invalid sequences are written to a separate '_errors.csv' file.
+    In 'plate' layout, a new file is started for every plate ('<output>_plate1.csv', ...).
+    """
+
+    def __init__(self, output, layout="tubes", plate_size=96, fill_order="column",
+                 scale="25nm", purification="STD"):
+        self.output_base, self.ext = os.path.splitext(output)
+        self.ext = self.ext or ".csv"
+        self.layout = layout
+        self.plate_size = plate_size
+        self.fill_order = fill_order
+        self.scale = scale
+        self.purification = purification
+        self.files = []
+        self.nrows = self.nerrors = 0
+        self.plate_num = 0
+        self.wells = iter(())
+        self._fp = self._writer = None
+        self._errors_fp = self._errors_writer = None
+
+    def _open(self, filepath, header):
+        fp = open(filepath, 'w', encoding='utf-8', newline='')
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        self.files.append(filepath)
+        return fp, writer
+
+    def write(self, name, sequence):
+        if self.layout == "plate":
+            well = next(self.wells, None)
+            if well is None:
+                self.plate_num += 1
+                self.wells = iter_well_positions(self.plate_size, self.fill_order)
+                well = next(self.wells)
+                if self._fp:
+                    self._fp.close()
+                self._fp, self._writer = self._open(
+                    "%s_plate%s%s" % (self.output_base, self.plate_num, self.ext),
+                    ["Well Position", "Name", "Sequence"])
+            self._writer.writerow([well, name, sequence])
+        else:
+            if self._writer is None:
+                self._fp, self._writer = self._open(self.output_base + self.ext,
+                                                    ["Name", "Sequence", "Scale", "Purification"])
+            self._writer.writerow([name, sequence, self.scale, self.purification])
+        self.nrows += 1
+
+    def write_error(self, source, lineno, name, sequence, problems):
+        if self._errors_writer is None:
+            self._errors_fp, self._errors_writer = self._open(
+                self.output_base + "_errors" + self.ext, ["File", "Line", "Name", "Sequence", "Problems"])
+        self._errors_writer.writerow([source, lineno, name, sequence, "; ".join(problems)])
+        self.nerrors += 1
+
+    def close(self):
+        for fp in (self._fp, self._errors_fp):
+            if fp is not None:
+                fp.close()
+
+
+def export_oligo_order(sources, output, min_length=8, mod_aliases=None, **writer_kwargs):
+    """
+    Export all named sequences in sources to an order sheet.
+    Sources is an iterable of (source name, lines iterable); files are best given as open file objects,
+    so that only one line is kept in memory at a time.
+    Returns the OrderSheetWriter (with statistics and list of files written).
+    """
+    aliases = dict(IDT_MOD_ALIASES)
+    aliases.update({k.lower(): v for k, v in (mod_aliases or {}).items()})
+    writer = OrderSheetWriter(output, **writer_kwargs)
+    try:
+        for source, lines in sources:
+            for lineno, name, seq in iter_named_sequences(lines, min_length=min_length):
+                normalized, core, problems = normalize_oligo(seq, aliases)
+                if problems:
+                    writer.write_error(source, lineno, name, seq, problems)
+                else:
+                    writer.write(name, normalized)
+    finally:
+        writer.close()
+    return writer
+
+
+def iter_file_sources(filepaths):
+    """ Yield (filepath, open file) for each file; each file is closed before the next is opened. """
+    for filepath in filepaths:
+        try:
+            with open(filepath, encoding='utf-8', errors='replace') as fp:
+                yield filepath, fp
+        except (IOError, OSError) as exc:
+            print("Could not read %s: %r" % (filepath, exc))
+
+
+class ElnExportOligoOrderCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_export_oligo_order
+    Export named sequences from the current view (source="view"), or from all experiment files
+    in 'eln_experiments_basedir' (source="experiments"), to an order sheet CSV file.
+
+    Args:
+        source: "view" or "experiments".
+        output: Path of the CSV file. If not given, the user is prompted (defaulting to a file next to the view).
+        layout: "tubes" or "plate".
+        plate_size: 96 or 384 (for plate layout).
+        fill_order: "column" or "row" (for plate layout).
+        scale, purification: Order options for the tubes layout; default to the settings.
+    """
+
+    def run(self, source="view", output=None, layout="tubes", plate_size=96, fill_order="column",
+            scale=None, purification=None):
+        settings = get_settings()
+        view = self.window.active_view()
+        self.export_kwargs = dict(
+            layout=layout, plate_size=plate_size, fill_order=fill_order,
+            scale=scale or settings.get('eln_oligo_order_scale', '25nm'),
+            purification=purification or settings.get('eln_oligo_order_purification', 'STD'),
+            min_length=settings.get('eln_oligo_min_length', 8),
+            mod_aliases=settings.get('eln_oligo_mod_aliases') or {},
+        )
+        if source == "view":
+            if view is None:
+                sublime.status_message("No active view to export sequences from.")
+                return
+            self.source_name = view.file_name() or view.name() or "untitled"
+            self.text = view.substr(sublime.Region(0, view.size()))
+            self.filepaths = None
+        else:
+            basedir = settings.get('eln_experiments_basedir')
+            if not basedir:
+                sublime.status_message("'eln_experiments_basedir' must be configured to export from experiments.")
+                return
+            self.basedir = os.path.abspath(os.path.expanduser(basedir))
+            self.filepaths = self.text = None
+        if output:
+            self.output_received(output)
+        else:
+            filename = view.file_name() if view is not None else None
+            default = (os.path.splitext(filename)[0] if filename else os.path.expanduser("~/oligo")) + "_order.csv"
+            self.window.show_input_panel("Order sheet CSV file:", default, self.output_received, None, None)
+
+    def output_received(self, output):
+        output = os.path.expanduser(output.strip())
+        if not output:
+            return
+        sublime.status_message("Exporting oligo order sheet...")
+        sublime.set_timeout_async(lambda: self.export(output), 0)
+
+    def export(self, output):
+        kwargs = dict(self.export_kwargs)
+        if self.text is not None:
+            sources = [(self.source_name, iter(self.text.split("\n")))]
+        else:
+            pattern = get_settings().get('eln_oligo_export_file_pattern', '*.md')
+            sources = iter_file_sources(find_experiment_files(self.basedir, pattern))
+        try:
+            writer = export_oligo_order(sources, output, **kwargs)
+        except (IOError, OSError) as exc:
+            msg = "ERROR writing order sheet %s: %r" % (output, exc)
+            print(msg)
+            sublime.error_message(msg)
+            return
+        msg = "Exported {} oligos ({} invalid) to {}".format(writer.nrows, writer.nerrors, ", ".join(writer.files))
+        print(msg)
+        sublime.status_message(msg)
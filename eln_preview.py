@@ -0,0 +1,481 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Live HTML preview of notebook pages.
+
+The document is split into blocks (paragraphs, lists, headers, fenced code blocks, etc.),
+and the rendered HTML for each block is cached, keyed by the block's text.
+When the document is saved, only new or changed blocks are rendered.
+
+The preview is served by a small local HTTP server (bound to localhost).
+The browser tab receives updates through server-sent events (SSE), which only carry the HTML
+for blocks the browser doesn't already have, so the tab updates in place instead of opening a new tab.
+
+If the python-markdown package is available (e.g. as a Package Control dependency), it is used to render
+each block; otherwise a small built-in renderer for the most common markdown elements is used.
+
+Settings:
+    'eln_preview_port'
+    'eln_preview_renderer'
+
+"""
+
+from __future__ import print_function, absolute_import
+import re
+import json
+import html
+import time
+import threading
+import webbrowser
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import urllib.parse
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings
+logger = logging.getLogger(__name__)
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+
+BLOCK_CACHE_SIZE = 50000
+FENCE_REGEX = re.compile(r"^\s*(```|~~~)\s*([\w+-]*)")
+HEADER_REGEX = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+HR_REGEX = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+LIST_ITEM_REGEX = re.compile(r"^(\s*)([*+-]|\d+[.)])\s+(.*)$")
+CODE_SPAN_REGEX = re.compile(r"`([^`]+)`")
+URL_SCHEME_REGEX = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*):")
+SAFE_URL_SCHEMES = {"http", "https"}
+
+
+def safe_url(url, image=False):
+    """
+    Return url (unescaped from the HTML-escaped text) if it is safe to use as a link or image source, else None.
+    Only http(s) and relative URLs are allowed (and data:image/ URLs for images), so e.g. javascript: URLs are dropped.
+    """
+    url = html.unescape(url)
+    # Browsers ignore whitespace and control characters in the scheme, e.g. "java\tscript:".
+    match = URL_SCHEME_REGEX.match(re.sub(r"[\x00-\x20]", "", url))
+    if match is None:
+        return url
+    scheme = match.group(1).lower()
+    if scheme in SAFE_URL_SCHEMES or (image and scheme == "data" and url.lower().startswith("data:image/")):
+        return url
+    return None
+
+
+def render_image(match):
+    alt, src = match.group(1), safe_url(match.group(2), image=True)
+    if src is None:
+        return alt
+    return '<img src="%s" alt="%s">' % (html.escape(src, quote=True), html.escape(html.unescape(alt), quote=True))
+
+
+def render_link(match):
+    text, href = match.group(1), safe_url(match.group(2))
+    if href is None:
+        return text
+    return '<a href="%s">%s</a>' % (html.escape(href, quote=True), text)
+
+
+def render_autolink(match):
+    url = html.escape(html.unescape(match.group(1)), quote=True)
+    return '<a href="%s">%s</a>' % (url, match.group(1))
+
+
+# Replacements are applied to HTML-escaped text (quote=False); URLs are re-escaped for attributes by the functions.
+INLINE_PATTERNS = [
+    (re.compile(r"!\[([^\]]*)\]\(([^)\s]+)\)"), render_image),
+    (re.compile(r"\[([^\]]+)\]\(([^)\s]+)\)"), render_link),
+    (re.compile(r"'''(.+?)'''"), r"<strong>\1</strong>"),  # Mediawiki-style bold, used by journal headers.
+    (re.compile(r"''(.+?)''"), r"<em>\1</em>"),
+    (re.compile(r"\*\*(.+?)\*\*"), r"<strong>\1</strong>"),
+    (re.compile(r"(?<!\w)__(.+?)__(?!\w)"), r"<strong>\1</strong>"),
+    (re.compile(r"(?<![\w*])\*([^*\s](?:.*?[^*\s])?)\*(?![\w*])"), r"<em>\1</em>"),
+    (re.compile(r"(?<!\w)_([^_\s](?:.*?[^_\s])?)_(?!\w)"), r"<em>\1</em>"),
+    (re.compile(r"(?<![\"'=])(https?://[^\s<\"]+[^\s<\".,;:)])"), render_autolink),
+]
+
+
+def split_blocks(text):
+    """
+    Split markdown text into blocks, separated by blank lines.
+    Fenced code blocks are kept intact, and headers are always blocks of their own.
+    """
+    blocks, current, fence = [], [], None
+    for line in text.split("\n"):
+        if fence:
+            current.append(line)
+            if line.strip().startswith(fence):
+                blocks.append("\n".join(current))
+                current, fence = [], None
+            continue
+        fence_match = FENCE_REGEX.match(line)
+        if fence_match or line.startswith("#"):
+            if current:
+                blocks.append("\n".join(current))
+            current = [line]
+            if fence_match:
+                fence = fence_match.group(1)
+            else:
+                blocks.append(line)
+                current = []
+        elif not line.strip():
+            if current:
+                blocks.append("\n".join(current))
+                current = []
+        else:
+            current.append(line)
+    if current:
+        blocks.append("\n".join(current))
+    return blocks
+
+
+def render_inline(text):
+    """ Render inline markdown (emphasis, links, code spans) in a single line/paragraph of text. """
+    code_spans = []
+
+    def stash_code(match):
+        code_spans.append("<code>%s</code>" % html.escape(match.group(1), quote=False))
+        return "\x00%d\x00" % (len(code_spans) - 1)
+
+    text = CODE_SPAN_REGEX.sub(stash_code, text)
+    text = html.escape(text, quote=False)
+    for regex, replacement in INLINE_PATTERNS:
+        text = regex.sub(replacement, text)
+    if code_spans:
+        text = re.sub("\x00(\\d+)\x00", lambda match: code_spans[int(match.group(1))], text)
+    return text
+
+
+def render_list(lines):
+    """ Render a (possibly nested) list, using indentation to determine nesting. """
+    out = []
+    stack = []  # (indent, tag)
+    for line in lines:
+        match = LIST_ITEM_REGEX.match(line)
+        if not match:
+            # Continuation of previous item:
+            out.append(" " + render_inline(line.strip()))
+            continue
+        indent, marker, content = len(match.group(1).expandtabs(4)), match.group(2), match.group(3)
+        tag = "ul" if marker in "*+-" else "ol"
+        while stack and indent < stack[-1][0]:
+            out.append("</li></%s>" % stack.pop()[1])
+        if not stack or indent > stack[-1][0]:
+            stack.append((indent, tag))
+            out.append("<%s><li>" % tag)
+        else:
+            out.append("</li><li>")
+        out.append(render_inline(content))
+    while stack:
+        out.append("</li></%s>" % stack.pop()[1])
+    return "".join(out)
+
+
+def render_block_builtin(block):
+    """ Render a single markdown block to HTML using the built-in renderer. """
+    lines = block.split("\n")
+    first = lines[0]
+    fence_match = FENCE_REGEX.match(first)
+    if fence_match:
+        end = -1 if len(lines) > 1 and lines[-1].strip().startswith(fence_match.group(1)) else len(lines)
+        lang = fence_match.group(2)
+        return '<pre><code%s>%s</code></pre>' % (
+            ' class="language-%s"' % lang if lang else "", html.escape("\n".join(lines[1:end]), quote=False))
+    header_match = HEADER_REGEX.match(first)
+    if header_match and len(lines) == 1:
+        level = len(header_match.group(1))
+        return "<h%d>%s</h%d>" % (level, render_inline(header_match.group(2)), level)
+    if len(lines) == 1 and HR_REGEX.match(first):
+        return "<hr>"
+    if all(line.lstrip().startswith(">") for line in lines):
+        inner = "\n".join(re.sub(r"^\s*>\s?", "", line) for line in lines)
+        return "<blockquote>%s</blockquote>" % "".join(render_block_builtin(b) for b in split_blocks(inner))
+    if LIST_ITEM_REGEX.match(first):
+        return render_list(lines)
+    if all(line.startswith("    ") or line.startswith("\t") for line in lines):
+        return "<pre><code>%s</code></pre>" % html.escape(
+            "\n".join(line[4:] if line.startswith("    ") else line[1:] for line in lines), quote=False)
+    for i, line in enumerate(lines):
+        if LIST_ITEM_REGEX.match(line):
+            # Paragraph followed directly by a list, e.g. a journal header followed by journal entries.
+            return render_block_builtin("\n".join(lines[:i])) + render_list(lines[i:])
+    return "<p>%s</p>" % "<br>\n".join(render_inline(line.rstrip()) for line in lines)
+
+
+def render_block_markdown(block):
+    """ Render a single markdown block to HTML using python-markdown. """
+    return markdown.markdown(block, extensions=['fenced_code', 'tables'])
+
+
+class BlockRenderer(object):
+    """
+    Renders markdown documents block by block, caching the rendered HTML of each block.
+    The cache is a bounded LRU, shared by all documents, keyed by the block's text.
+    """
+
+    def __init__(self, render_block=None, cache_size=BLOCK_CACHE_SIZE):
+        if render_block is None:
+            render_block = render_block_markdown if markdown is not None else render_block_builtin
+        self.render_block = render_block
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, text):
+        """ Render text, returning a list of (key, html) tuples, one for each block. """
+        blocks = []
+        cache = self.cache
+        with self.lock:
+            for block in split_blocks(text):
+                block_html = cache.get(block)
+                if block_html is None:
+                    block_html = cache[block] = self.render_block(block)
+                else:
+                    cache.move_to_end(block)
+                blocks.append(("%x" % (hash(block) & 0xFFFFFFFFFFFF), block_html))
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return blocks
+
+
+class PreviewDocument(object):
+    """ The most recent rendering of a previewed view, and a condition used to notify SSE clients of updates. """
+
+    def __init__(self, doc_id, title):
+        self.doc_id = doc_id
+        self.title = title
+        self.version = 0
+        self.blocks = []
+        self.last_update = None
+        self.condition = threading.Condition()
+
+    def update(self, blocks):
+        """ Update blocks and notify clients. The update payload only has HTML for blocks not in previous version. """
+        with self.condition:
+            previous_keys = set(key for key, _ in self.blocks)
+            self.blocks = blocks
+            self.version += 1
+            self.last_update = self.payload(previous_keys)
+            self.condition.notify_all()
+
+    def payload(self, known_keys=()):
+        return json.dumps({
+            'version': self.version,
+            'blocks': [[key, None if key in known_keys else block_html] for key, block_html in self.blocks],
+        })
+
+    def page(self):
+        body = "\n".join('<div class="eln-block" data-key="%s">%s</div>' % block for block in self.blocks)
+        return PAGE_TEMPLATE.format(title=html.escape(self.title), body=body, doc_id=self.doc_id, version=self.version)
+
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 50em; margin: 2em auto; line-height: 1.4; }}
+pre {{ background: #f4f4f4; padding: 0.5em; overflow-x: auto; }}
+code {{ background: #f4f4f4; }}
+blockquote {{ border-left: 3px solid #ccc; margin-left: 0; padding-left: 1em; color: #555; }}
+</style></head>
+<body><div id="eln-body">
+{body}
+</div>
+<script>
+(function () {{
+  var version = {version};
+  var source = new EventSource("/events/{doc_id}?version=" + version);
+  source.onmessage = function (event) {{
+    var update = JSON.parse(event.data);
+    var container = document.getElementById("eln-body");
+    var existing = {{}}, used = {{}};
+    Array.prototype.forEach.call(container.children, function (node) {{
+      (existing[node.dataset.key] = existing[node.dataset.key] || []).push(node);
+    }});
+    var fragment = document.createDocumentFragment();
+    for (var i = 0; i < update.blocks.length; i++) {{
+      var key = update.blocks[i][0], blockHtml = update.blocks[i][1], node;
+      if (blockHtml === null) {{
+        if (existing[key] && existing[key].length) {{
+          node = used[key] = existing[key].shift();
+        }} else if (used[key]) {{
+          node = used[key].cloneNode(true);
+        }} else {{
+          location.reload();  // We are missing a block; get a fresh page.
+          return;
+        }}
+      }} else {{
+        node = document.createElement("div");
+        node.className = "eln-block";
+        node.dataset.key = key;
+        node.innerHTML = blockHtml;
+        used[key] = node;
+      }}
+      fragment.appendChild(node);
+    }}
+    container.innerHTML = "";
+    container.appendChild(fragment);
+    version = update.version;
+  }};
+}})();
+</script>
+</body></html>
+"""
+
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    """ Serves preview pages (/view/<doc_id>) and server-sent event streams (/events/<doc_id>). """
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def get_document(self, doc_id):
+        return self.server.documents.get(doc_id)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        doc = self.get_document(parts[1]) if len(parts) == 2 else None
+        if doc is None:
+            self.send_error(404)
+        elif parts[0] == "view":
+            content = doc.page().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif parts[0] == "events":
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                client_version = int(query.get('version', ['0'])[0])
+            except ValueError:
+                self.send_error(400, "Invalid version")
+                return
+            self.stream_events(doc, client_version)
+        else:
+            self.send_error(404)
+
+    def stream_events(self, doc, client_version):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while not self.server.stopped:
+                with doc.condition:
+                    if doc.version == client_version:
+                        doc.condition.wait(15)
+                    if doc.version == client_version:
+                        payload = None
+                    elif doc.version == client_version + 1:
+                        payload = doc.last_update
+                    else:
+                        payload = doc.payload()  # Client is more than one version behind; send everything.
+                    client_version = doc.version
+                if payload is None:
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    self.wfile.write(("data: %s\n\n" % payload).encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass  # Browser tab was closed.
+
+
+class PreviewServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), PreviewRequestHandler)
+        self.documents = {}
+        self.stopped = False
+
+    def url(self, doc_id):
+        return "http://127.0.0.1:%s/view/%s" % (self.server_address[1], doc_id)
+
+    def stop(self):
+        self.stopped = True
+        for doc in list(self.documents.values()):
+            with doc.condition:
+                doc.condition.notify_all()
+        self.shutdown()
+        self.server_close()
+
+
+_server = None
+_renderers = {}  # 'builtin' or 'markdown' -> BlockRenderer
+
+
+def get_renderer():
+    """ Return the block renderer for the current 'eln_preview_renderer' setting (re-read on every render). """
+    mode = get_settings().get('eln_preview_renderer', 'auto')
+    kind = 'markdown' if markdown is not None and mode != 'builtin' else 'builtin'
+    if kind not in _renderers:
+        _renderers[kind] = BlockRenderer(render_block_builtin if kind == 'builtin' else render_block_markdown)
+    return _renderers[kind]
+
+
+def get_server():
+    """ Get the preview server, starting it (in a background thread) if it isn't running. """
+    global _server
+    if _server is None:
+        _server = PreviewServer(get_settings().get('eln_preview_port', 0) or 0)
+        threading.Thread(target=_server.serve_forever, name="ELN preview server", daemon=True).start()
+        print("ELN preview server started at http://127.0.0.1:%s/" % (_server.server_address[1],))
+    return _server
+
+
+def update_preview(view):
+    """ Render the view and push the update to the browser. Returns the preview document. """
+    server = get_server()
+    doc_id = str(view.id())
+    doc = server.documents.get(doc_id)
+    if doc is None:
+        doc = server.documents[doc_id] = PreviewDocument(doc_id, view.file_name() or view.name() or "untitled")
+    t0 = time.time()
+    blocks = get_renderer().render(view.substr(sublime.Region(0, view.size())))
+    doc.update(blocks)
+    logger.debug("ELN preview: rendered %s blocks in %0.1f ms.", len(blocks), (time.time() - t0) * 1000)
+    return doc
+
+
+def plugin_unloaded():
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server = None
+
+
+class ElnHtmlPreviewCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_html_preview
+    Render the current view to HTML and open it in the browser.
+    The preview is updated in place (in the same browser tab) every time the view is saved.
+    If the view is already being previewed, the browser is only opened if `reopen` is true.
+    """
+    def run(self, edit, reopen=False):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        is_new = _server is None or str(self.view.id()) not in _server.documents
+        doc = update_preview(self.view)
+        if is_new or reopen:
+            url = get_server().url(doc.doc_id)
+            sublime.status_message("Opening preview in browser: " + url)
+            webbrowser.open(url)
+
+
+class ElnHtmlPreviewListener(sublime_plugin.EventListener):
+    """ Update previews when previewed views are saved, and forget them when the view is closed. """
+
+    def on_post_save_async(self, view):
+        if _server is not None and str(view.id()) in _server.documents:
+            update_preview(view)
+
+    def on_close(self, view):
+        if _server is not None:
+            _server.documents.pop(str(view.id()), None)
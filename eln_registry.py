@@ -0,0 +1,290 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Sequence registry: "Have we made this oligo before?"
+
+All named sequences (e.g. rows in order tables, or FASTA records, c.f. `eln_oligos.iter_named_sequences`)
+in the pages in the experiments and projects base dirs are registered by the hash of their canonical form:
+Termini markers and modifications are stripped, the sequence is filtered to (IUPAC) bases and converted to DNA,
+and the lexicographically smaller of the sequence and its reverse complement is used, so an oligo is found
+regardless of which strand was written down (or ordered).
+
+The registry maps hashes to (file, line, name, strand), so checking a sequence is a single dict lookup.
+The registry is built once, the first time it is used: the per-file entries are persisted in Sublime's
+cache dir (c.f. `eln_utils.FileSummaryCache`), so only pages whose size or mtime has changed since the
+last session are read again. After that, lookups only use the in-memory index, and pages saved in Sublime
+are re-registered right away, replacing just that page's entries. Pages changed outside Sublime are
+picked up with the eln_rebuild_sequence_registry command.
+
+Settings:
+    'eln_sequence_registry_file_pattern'
+    'eln_oligo_min_length'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import time
+import fnmatch
+import hashlib
+import threading
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import (get_settings, get_cache_dir, dna_filter, rcompl, FileSummaryCache,
+                        get_notebook_basedirs, iter_notebook_files)
+from .eln_oligos import MOD_TOKEN_REGEX, strip_termini_markers, iter_named_sequences
+logger = logging.getLogger(__name__)
+
+
+REGISTRY_INDEX_FILENAME = 'eln_sequence_registry.json'
+REGISTRY_INDEX_VERSION = 1
+
+
+def canonical_sequence(seq):
+    """
+    Return (canonical sequence, strand) for an oligo, strand being '+' if the canonical sequence is the
+    oligo itself and '-' if it is the reverse complement. Modifications and termini markers are ignored.
+    """
+    core = "".join(MOD_TOKEN_REGEX.split(strip_termini_markers(seq))[::2])
+    core = dna_filter(core, degenerate=True).replace("U", "T")
+    reverse = rcompl(core, strict=False)
+    return (core, "+") if core <= reverse else (reverse, "-")
+
+
+def sequence_key(canonical):
+    """ Return the registry key (a short hash) for a canonical sequence. """
+    return hashlib.sha256(canonical.encode('ascii')).hexdigest()[:20]
+
+
+def summarize_file(filepath):
+    """ Return list of [key, line number, name, strand, sequence] for all named sequences in file. """
+    min_length = get_settings().get('eln_oligo_min_length', 8)
+    entries = []
+    with open(filepath, encoding='utf-8', errors='replace') as fp:
+        for lineno, name, seq in iter_named_sequences(fp, min_length=min_length):
+            canonical, strand = canonical_sequence(seq)
+            if canonical:
+                entries.append([sequence_key(canonical), lineno, name, strand, seq[:120]])
+    return entries
+
+
+class SequenceRegistry(object):
+    """
+    In-memory hash index of the named sequences in a set of files, backed by a persistent FileSummaryCache.
+    `lookup(seq)` returns all registered sequences with the same canonical form as seq.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.index = {}
+        self.filepaths = None
+        self._lock = threading.RLock()
+
+    def _add(self, filepath, entries):
+        for key, lineno, name, strand, seq in entries:
+            self.index.setdefault(key, []).append((filepath, lineno, name, strand, seq))
+
+    def _remove(self, filepath, entries):
+        for key in {entry[0] for entry in entries}:
+            matches = [match for match in self.index.get(key, ()) if match[0] != filepath]
+            if matches:
+                self.index[key] = matches
+            else:
+                self.index.pop(key, None)
+
+    def refresh(self, filepaths):
+        """ Bring the registry up to date with filepaths; returns the number of files read again. """
+        with self._lock:
+            summaries, nchanged = self.cache.update(filepaths)
+            if nchanged or self.filepaths is None or self.filepaths != set(summaries):
+                self.index = {}
+                for filepath, entries in summaries.items():
+                    self._add(filepath, entries)
+            self.filepaths = set(summaries)
+            return nchanged
+
+    def update_file(self, filepath):
+        """ Re-register the sequences in a single file, e.g. after it has been saved. """
+        with self._lock:
+            entries, previous = self.cache.update_file(filepath)
+            if previous:
+                self._remove(filepath, previous)
+            if entries:
+                self._add(filepath, entries)
+            if self.filepaths is not None and entries is not None:
+                self.filepaths.add(filepath)
+            elif self.filepaths is not None:
+                self.filepaths.discard(filepath)
+
+    def lookup(self, seq):
+        """
+        Return (canonical sequence, list of matches) for seq, each match being
+        (filepath, line number, name, same strand, sequence as written).
+        """
+        canonical, strand = canonical_sequence(seq)
+        if not canonical:
+            return canonical, []
+        with self._lock:
+            matches = self.index.get(sequence_key(canonical), [])
+        return canonical, [(filepath, lineno, name, match_strand == strand, match_seq)
+                           for filepath, lineno, name, match_strand, match_seq in matches]
+
+
+_registry = None
+_registry_build_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = SequenceRegistry(FileSummaryCache(
+            os.path.join(get_cache_dir(), REGISTRY_INDEX_FILENAME), summarize_file, version=REGISTRY_INDEX_VERSION))
+    return _registry
+
+
+def find_registry_files(settings=None):
+    """ Return list of all pages to register sequences from. """
+    settings = settings or get_settings()
+    pattern = settings.get('eln_sequence_registry_file_pattern', '*.md')
+    return sorted({filepath for section, basedir, filepath in iter_notebook_files(pattern, settings)})
+
+
+def experiment_name(filepath, basedirs):
+    """ Return the experiment (or project) of filepath, i.e. its top-level folder in the base dir. """
+    for basedir in basedirs:
+        relpath = os.path.relpath(filepath, basedir)
+        if not relpath.startswith(os.pardir):
+            return relpath.split(os.sep)[0]
+    return os.path.basename(os.path.dirname(filepath))
+
+
+def is_registry_file(filepath, settings=None):
+    settings = settings or get_settings()
+    if not fnmatch.fnmatch(os.path.basename(filepath), settings.get('eln_sequence_registry_file_pattern', '*.md')):
+        return False
+    filepath = os.path.abspath(filepath)
+    return any(filepath.startswith(basedir + os.sep) for basedir in get_notebook_basedirs(settings).values())
+
+
+def load_registry(rebuild=False):
+    """
+    Return the sequence registry, building it the first time (or if rebuild is true).
+    Building walks the base dirs, so call this from a background thread.
+    """
+    registry = get_registry()
+    with _registry_build_lock:
+        if rebuild or registry.filepaths is None:
+            start = time.time()
+            filepaths = find_registry_files()
+            nchanged = registry.refresh(filepaths)
+            print("ELN sequence registry: {} files ({} re-read), {} unique sequences, in {:.0f} ms.".format(
+                len(filepaths), nchanged, len(registry.index), 1000*(time.time() - start)))
+    return registry
+
+
+class ElnSequenceRegistryListener(sublime_plugin.EventListener):
+    """ Re-register the sequences of notebook pages when they are saved. """
+
+    def on_post_save_async(self, view):
+        filepath = view.file_name()
+        if _registry is not None and filepath and is_registry_file(filepath):
+            _registry.update_file(os.path.abspath(filepath))
+
+
+class ElnSequenceRegistryLookupCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_sequence_registry_lookup
+    Check whether a sequence (or its reverse complement) is already in any page in the experiments and projects
+    base dirs, and show the matches in a quick panel. The sequence is taken from the selection, or asked for.
+    With batch=True, check all named sequences (e.g. an order table) in the selection or the whole view,
+    and show a report in a new view.
+    Args:
+        sequence: Sequence to look up (instead of the selection).
+        batch: Check all named sequences.
+    """
+
+    def run(self, edit, sequence=None, batch=False):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        if batch:
+            regions = [region for region in self.view.sel() if not region.empty()] or [
+                sublime.Region(0, self.view.size())]
+            self.blocks = [(self.view.rowcol(region.begin())[0], self.view.substr(region)) for region in regions]
+            sublime.status_message("Checking sequences against the registry...")
+            sublime.set_timeout_async(self.check_batch, 0)
+            return
+        if sequence is None:
+            sequence = next((self.view.substr(region) for region in self.view.sel() if not region.empty()), None)
+        if sequence is None:
+            self.view.window().show_input_panel("Sequence:", "", self.lookup, None, None)
+        else:
+            self.lookup(sequence)
+
+    def lookup(self, sequence):
+        sublime.set_timeout_async(lambda: self.show_matches(sequence), 0)
+
+    def show_matches(self, sequence):
+        canonical, matches = load_registry().lookup(sequence)
+        if not canonical:
+            sublime.status_message("No sequence to look up.")
+            return
+        if not matches:
+            sublime.status_message("Sequence not found in the registry ({} bases).".format(len(canonical)))
+            return
+        basedirs = list(get_notebook_basedirs().values())
+        self.matches = sorted(matches)
+        items = [["{}  ({}{})".format(name, experiment_name(filepath, basedirs),
+                                      "" if same_strand else ", reverse complement"),
+                  "{}:{}  {}".format(os.path.basename(filepath), lineno, seq)]
+                 for filepath, lineno, name, same_strand, seq in self.matches]
+        sublime.set_timeout(lambda: self.view.window().show_quick_panel(items, self.on_selected), 0)
+
+    def on_selected(self, index):
+        if index < 0:
+            return
+        filepath, lineno = self.matches[index][:2]
+        self.view.window().open_file("{}:{}".format(filepath, lineno), sublime.ENCODED_POSITION)
+
+    def check_batch(self):
+        registry = load_registry()
+        basedirs = list(get_notebook_basedirs().values())
+        min_length = get_settings().get('eln_oligo_min_length', 8)
+        this_file = os.path.abspath(self.view.file_name()) if self.view.file_name() else None
+        lines = ["| Name | Sequence | Made before |", "|------|----------|-------------|"]
+        nseqs = nfound = 0
+        for first_line, text in self.blocks:
+            for lineno, name, seq in iter_named_sequences(text.split("\n"), min_length=min_length):
+                lineno += first_line
+                canonical, matches = registry.lookup(seq)
+                # Don't report the sequence itself, if the page has already been saved and registered:
+                matches = [match for match in matches if (match[0], match[1]) != (this_file, lineno)]
+                nseqs += 1
+                nfound += bool(matches)
+                found = ", ".join("{} in {} ({}:{}{})".format(
+                    match_name, experiment_name(filepath, basedirs), os.path.basename(filepath), match_lineno,
+                    "" if same_strand else ", rc") for filepath, match_lineno, match_name, same_strand, match_seq
+                    in sorted(matches)) or "-"
+                lines.append("| {} | {} | {} |".format(name, seq, found))
+        msg = "Sequence registry: {} of {} sequences made before.".format(nfound, nseqs)
+        print(msg)
+        sublime.set_timeout(lambda: self.show_report("\n".join(lines) + "\n", msg), 0)
+
+    def show_report(self, text, msg):
+        window = self.view.window() or sublime.active_window()
+        report_view = window.new_file()
+        report_view.set_name("Sequence registry check")
+        report_view.set_scratch(True)
+        report_view.run_command("append", {"characters": text})
+        sublime.status_message(msg)
+
+
+class ElnRebuildSequenceRegistryCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_rebuild_sequence_registry
+    Bring the sequence registry up to date with all pages in the base dirs, e.g. after pages were changed
+    outside Sublime. Only pages whose size or mtime has changed are read again.
+    """
+
+    def run(self):
+        sublime.status_message("Updating sequence registry...")
+        sublime.set_timeout_async(lambda: load_registry(rebuild=True), 0)
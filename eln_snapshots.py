@@ -0,0 +1,360 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Incremental, deduplicated snapshots of the experiments base directory.
+
+Files are split into fixed-size chunks, and each chunk is stored once in a content-addressed
+object store, named by the SHA-256 hash of its content. A snapshot is a manifest (JSON) listing
+every file with its size, mtime and chunk hashes. Files whose size and mtime are unchanged since
+the previous snapshot are not read at all; their chunk lists are copied from the previous manifest.
+So a snapshot of a large notebook where little has changed only costs a directory walk and a stat per file,
+and only new data is stored.
+
+Store layout:
+    <store>/objects/ab/abcdef...    Chunks, named by SHA-256 hash.
+    <store>/snapshots/<id>.json     Manifests, with id = creation time as YYYYmmdd-HHMMSS.
+
+Any experiment folder (or the whole base directory) can be restored to a snapshot;
+files that already match the snapshot (same size and mtime) are not rewritten.
+Files that could not be read when the snapshot was taken are listed in the manifest as 'unreadable';
+they are left as they are by a restore (and never deleted as extra files).
+
+Settings:
+    'eln_snapshot_store'
+    'eln_snapshot_chunk_size'
+    'eln_snapshot_exclude'
+    'eln_snapshot_daily'
+
+"""
+
+from __future__ import print_function, absolute_import
+import os
+import json
+import time
+import fnmatch
+import hashlib
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import get_settings, atomic_write
+logger = logging.getLogger(__name__)
+
+
+SNAPSHOT_STORE_DIRNAME = ".eln_snapshots"
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# Files modified less than this many seconds before a snapshot could be modified again without changing mtime,
+# so they are re-hashed in the next snapshot:
+RACY_MTIME_WINDOW = 2.0
+
+
+def remove_tmp_file(tmp_path):
+    """ Remove a partially written temporary file, ignoring errors (e.g. if it was never created). """
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+class SnapshotStore(object):
+    """
+    Content-addressed chunk store with snapshot manifests, c.f. module docstring.
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.objects_dir = os.path.join(path, "objects")
+        self.snapshots_dir = os.path.join(path, "snapshots")
+
+    def chunk_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def list_snapshots(self):
+        """ Return list of snapshot ids, oldest first. """
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return sorted(fn[:-5] for fn in os.listdir(self.snapshots_dir) if fn.endswith(".json"))
+
+    def read_chunk(self, digest):
+        """ Return the content of a chunk, raising RuntimeError if it is missing, unreadable or corrupt. """
+        try:
+            with open(self.chunk_path(digest), 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError) as exc:
+            raise RuntimeError("Snapshot chunk %s could not be read: %r" % (digest, exc))
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError("Snapshot chunk %s is corrupt (content does not match its hash)." % (digest,))
+        return data
+
+    def load_manifest(self, snapshot_id):
+        with open(os.path.join(self.snapshots_dir, snapshot_id + ".json"), encoding='utf-8') as fp:
+            return json.load(fp)
+
+    def store_file(self, filepath, stats):
+        """ Store the chunks of filepath that are not already in the store. Returns list of chunk hashes. """
+        chunks = []
+        with open(filepath, 'rb') as fp:
+            while True:
+                data = fp.read(self.chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                chunk_path = self.chunk_path(digest)
+                if not os.path.exists(chunk_path):
+                    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                    tmp_path = "{}.{}.tmp".format(chunk_path, os.getpid())
+                    try:
+                        with open(tmp_path, 'wb') as out:
+                            out.write(data)
+                        os.replace(tmp_path, chunk_path)
+                    except (IOError, OSError):
+                        remove_tmp_file(tmp_path)
+                        raise
+                    stats['new_chunks'] += 1
+                    stats['new_bytes'] += len(data)
+        return chunks
+
+    def iter_files(self, basedir, exclude=()):
+        """ Yield (relpath, abspath, stat) for all files in basedir, skipping the store and excluded names. """
+        store_path = os.path.abspath(self.path)
+        for dirpath, dirnames, filenames in os.walk(basedir):
+            dirnames[:] = sorted(
+                name for name in dirnames
+                if not name.startswith(".eln_") and os.path.join(dirpath, name) != store_path
+                and not any(fnmatch.fnmatch(name, pattern) for pattern in exclude))
+            for name in sorted(filenames):
+                if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                    continue
+                abspath = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(abspath)
+                except OSError:
+                    continue  # Removed while walking.
+                relpath = os.path.relpath(abspath, basedir).replace(os.sep, "/")
+                yield relpath, abspath, stat
+
+    def create_snapshot(self, basedir, exclude=()):
+        """
+        Snapshot all files in basedir. Files with the same size and mtime as in the previous snapshot are not read.
+        Returns (snapshot id, stats dict).
+        """
+        start = time.time()
+        previous = self.list_snapshots()
+        index = self.load_manifest(previous[-1])['files'] if previous else {}
+        stats = dict(files=0, unchanged=0, hashed=0, new_chunks=0, new_bytes=0, errors=0)
+        files = {}
+        for relpath, abspath, stat in self.iter_files(basedir, exclude):
+            stats['files'] += 1
+            entry = index.get(relpath)
+            if (entry and not entry.get('racy') and not entry.get('unreadable') and entry['size'] == stat.st_size
+                    and entry['mtime_ns'] == stat.st_mtime_ns):
+                files[relpath] = entry
+                stats['unchanged'] += 1
+                continue
+            try:
+                chunks = self.store_file(abspath, stats)
+            except (IOError, OSError) as exc:
+                print("ELN snapshot: Could not read %s: %r" % (abspath, exc))
+                stats['errors'] += 1
+                # Listed without content, so a restore with delete_extra keeps the file:
+                files[relpath] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'chunks': [], 'unreadable': True}
+                continue
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'chunks': chunks}
+            if stat.st_mtime > start - RACY_MTIME_WINDOW:
+                entry['racy'] = True
+            files[relpath] = entry
+            stats['hashed'] += 1
+        snapshot_id = time.strftime("%Y%m%d-%H%M%S", time.localtime(start))
+        while previous and snapshot_id <= previous[-1]:
+            snapshot_id = previous[-1] + "b"
+        manifest = {'id': snapshot_id, 'created': start, 'basedir': basedir,
+                    'chunk_size': self.chunk_size, 'files': files}
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        atomic_write(os.path.join(self.snapshots_dir, snapshot_id + ".json"), json.dumps(manifest))
+        stats['seconds'] = time.time() - start
+        return snapshot_id, stats
+
+    def restore(self, snapshot_id, target_basedir, prefix="", delete_extra=False, exclude=()):
+        """
+        Restore files under prefix (e.g. an experiment folder name, or "" for everything) from a snapshot
+        to target_basedir. Files already matching the snapshot (size and mtime) are skipped,
+        as are files that were unreadable when the snapshot was taken (these are left as they are).
+        If delete_extra is true, files under prefix that are not in the snapshot are deleted,
+        except excluded files (which are never in snapshots; use the same exclude as for create_snapshot).
+        All chunks are checked to be present before anything is changed, and chunk contents are verified
+        before a file is replaced; a missing or corrupt chunk raises RuntimeError.
+        Files are only deleted after all files have been restored.
+        Returns stats dict.
+        """
+        manifest = self.load_manifest(snapshot_id)
+        prefix = prefix.strip("/")
+        selected = {relpath: entry for relpath, entry in manifest['files'].items()
+                    if not prefix or relpath == prefix or relpath.startswith(prefix + "/")}
+        stats = dict(files=len(selected), restored=0, unchanged=0, unreadable=0, deleted=0)
+        to_restore = []
+        for relpath, entry in sorted(selected.items()):
+            if entry.get('unreadable'):
+                stats['unreadable'] += 1
+                continue
+            filepath = os.path.join(target_basedir, *relpath.split("/"))
+            try:
+                stat = os.stat(filepath)
+                if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+                    stats['unchanged'] += 1
+                    continue
+            except OSError:
+                pass
+            to_restore.append((filepath, entry))
+        missing = {digest for filepath, entry in to_restore for digest in entry['chunks']
+                   if not os.path.isfile(self.chunk_path(digest))}
+        if missing:
+            raise RuntimeError("Snapshot {} can not be restored: {} chunks are missing from {}, e.g. {}.".format(
+                snapshot_id, len(missing), self.objects_dir, sorted(missing)[0]))
+        for filepath, entry in to_restore:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(filepath, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as out:
+                    for digest in entry['chunks']:
+                        out.write(self.read_chunk(digest))
+                os.utime(tmp_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+                os.replace(tmp_path, filepath)
+            except (RuntimeError, IOError, OSError):
+                remove_tmp_file(tmp_path)
+                raise
+            stats['restored'] += 1
+        if delete_extra:
+            restore_root = os.path.join(target_basedir, *prefix.split("/")) if prefix else target_basedir
+            for relpath, abspath, stat in self.iter_files(restore_root, exclude):
+                relpath = (prefix + "/" + relpath) if prefix else relpath
+                if relpath not in selected:
+                    os.remove(abspath)
+                    stats['deleted'] += 1
+        return stats
+
+
+def get_snapshot_store(settings=None):
+    """
+    Return (store, basedir) for the configured experiments base directory,
+    or (None, None) if 'eln_experiments_basedir' is not configured.
+    """
+    settings = settings or get_settings()
+    basedir = settings.get('eln_experiments_basedir')
+    if not basedir or not os.path.isdir(os.path.expanduser(basedir.strip())):
+        return None, None
+    basedir = os.path.abspath(os.path.expanduser(basedir.strip()))
+    store_path = settings.get('eln_snapshot_store') or os.path.join(basedir, SNAPSHOT_STORE_DIRNAME)
+    store = SnapshotStore(os.path.abspath(os.path.expanduser(store_path)),
+                          chunk_size=settings.get('eln_snapshot_chunk_size', DEFAULT_CHUNK_SIZE))
+    return store, basedir
+
+
+def format_snapshot_stats(snapshot_id, stats):
+    return ("Snapshot {id}: {files} files ({unchanged} unchanged, {hashed} hashed, {errors} errors), "
+            "{new_chunks} new chunks ({mb:.1f} MB) in {seconds:.1f} s").format(
+        id=snapshot_id, mb=stats['new_bytes'] / 1e6, **stats)
+
+
+def take_snapshot(settings=None):
+    """ Take a snapshot of the experiments base directory, printing the result. Returns snapshot id or None. """
+    settings = settings or get_settings()
+    store, basedir = get_snapshot_store(settings)
+    if store is None:
+        sublime.status_message("'eln_experiments_basedir' must be configured to take snapshots.")
+        return None
+    snapshot_id, stats = store.create_snapshot(basedir, exclude=settings.get('eln_snapshot_exclude', []))
+    msg = format_snapshot_stats(snapshot_id, stats)
+    print(msg)
+    sublime.status_message(msg)
+    return snapshot_id
+
+
+def take_daily_snapshot():
+    """ Take a snapshot if 'eln_snapshot_daily' is enabled and there is no snapshot from today. """
+    settings = get_settings()
+    if not settings.get('eln_snapshot_daily', False):
+        return
+    store, basedir = get_snapshot_store(settings)
+    if store is None:
+        return
+    snapshots = store.list_snapshots()
+    if snapshots and snapshots[-1].startswith(time.strftime("%Y%m%d")):
+        return
+    take_snapshot(settings)
+
+
+def plugin_loaded():
+    sublime.set_timeout_async(take_daily_snapshot, 5000)
+
+
+class ElnSnapshotExperimentsCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_snapshot_experiments
+    Take an incremental snapshot of the experiments base directory ('eln_experiments_basedir').
+    """
+
+    def run(self):
+        sublime.status_message("Taking snapshot of experiments...")
+        sublime.set_timeout_async(take_snapshot, 0)
+
+
+class ElnRestoreExperimentSnapshotCommand(sublime_plugin.WindowCommand):
+    """
+    Command string: eln_restore_experiment_snapshot
+    Restore an experiment folder (or the whole base directory) to a previous snapshot.
+    The user selects the snapshot and the experiment from quick panels.
+    A new snapshot is taken before restoring, so the current state can always be recovered.
+    Args:
+        delete_extra: Delete files in the experiment folder that are not in the snapshot.
+    """
+
+    def run(self, delete_extra=False):
+        self.store, self.basedir = get_snapshot_store()
+        if self.store is None:
+            sublime.status_message("'eln_experiments_basedir' must be configured to restore snapshots.")
+            return
+        self.delete_extra = delete_extra
+        self.snapshots = self.store.list_snapshots()[::-1]
+        if not self.snapshots:
+            sublime.status_message("No snapshots found in %s" % self.store.path)
+            return
+        self.window.show_quick_panel(self.snapshots, self.snapshot_selected)
+
+    def snapshot_selected(self, index):
+        if index < 0:
+            return
+        self.snapshot_id = self.snapshots[index]
+        files = self.store.load_manifest(self.snapshot_id)['files']
+        folders = sorted(set(relpath.split("/")[0] for relpath in files if "/" in relpath))
+        self.prefixes = [""] + folders
+        items = ["(Entire experiments base directory)"] + folders
+        sublime.set_timeout(lambda: self.window.show_quick_panel(items, self.prefix_selected), 0)
+
+    def prefix_selected(self, index):
+        if index < 0:
+            return
+        self.prefix = self.prefixes[index]
+        msg = "Restore {} to snapshot {}?{}".format(
+            self.prefix or "all experiments", self.snapshot_id,
+            "\n\nFiles not in the snapshot will be deleted." if self.delete_extra else "")
+        if sublime.ok_cancel_dialog(msg, "Restore"):
+            sublime.set_timeout_async(self.restore, 0)
+
+    def restore(self):
+        if take_snapshot() is None:
+            return
+        try:
+            stats = self.store.restore(self.snapshot_id, self.basedir, prefix=self.prefix,
+                                       delete_extra=self.delete_extra,
+                                       exclude=get_settings().get('eln_snapshot_exclude', []))
+        except (RuntimeError, IOError, OSError, ValueError) as exc:
+            msg = "ERROR restoring {} from snapshot {}: {}".format(self.prefix or "all experiments", self.snapshot_id, exc)
+            print(msg)
+            sublime.set_timeout(lambda: sublime.error_message(msg), 0)
+            return
+        msg = ("Restored {} from snapshot {}: {restored} files restored, {unchanged} unchanged, "
+               "{unreadable} unreadable at snapshot (kept), {deleted} deleted").format(
+            self.prefix or "all experiments", self.snapshot_id, **stats)
+        print(msg)
+        sublime.status_message(msg)
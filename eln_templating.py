@@ -15,14 +15,21 @@ Prior art, alternative Sublime Text templating packages:
 
 from __future__ import print_function, absolute_import
 import os
+import re
+import time
+import socket
+import threading
 from datetime import date, datetime
-from collections import OrderedDict, deque
+from collections import OrderedDict, deque, namedtuple, ChainMap
+from functools import lru_cache
+from bisect import bisect_left
 import string
 import urllib.parse
 import sublime
 import sublime_plugin
 import logging
-from .eln_utils import get_setting, get_settings
+from .eln_utils import get_setting, get_settings, get_state
+from .eln_oligos import iter_well_positions
 logger = logging.getLogger(__name__)
 
 
@@ -32,50 +39,552 @@ def print_status_msg(msg, prefix="ELN-Utils: "):
     sublime.status_message(prefix + msg)
 
 
+EXPID_RESERVATIONS_DIRNAME = '.eln_expid_reservations'
+EXPID_RESERVATION_TIMEOUT = 12*3600  # Reservations older than this (in seconds) are considered stale.
+
+
+class ExperimentIdAllocator(object):
+    """
+    Allocates the next free experiment ID in an experiments base directory.
+
+    Experiment folder names are parsed with `expid_pat`, which must have a named group 'expnum'
+    with the experiment number, e.g. "(?P<expid>RS(?P<expnum>\\d{3,}))".
+    The used experiment numbers are cached, and the folder is only re-scanned when the base dir's mtime changes.
+    New IDs are formatted with `expid_fmt`, e.g. "RS{expnum:03d}".
+
+    To avoid two machines (sharing the same base dir) allocating the same ID, each allocated ID is reserved
+    by atomically creating a file in the `.eln_expid_reservations` folder (which fails if the file exists).
+    Reservations are released when the experiment folder has been created (or the input was cancelled),
+    and ignored when they are older than EXPID_RESERVATION_TIMEOUT.
+    """
+
+    def __init__(self, basedir, expid_pat, expid_fmt):
+        self.basedir = basedir
+        self.regex = re.compile(expid_pat)
+        self.expid_fmt = expid_fmt
+        self.reservations_dir = os.path.join(basedir, EXPID_RESERVATIONS_DIRNAME)
+        self.dir_mtime = None
+        self.used = {}  # expnum -> foldername
+        self.lock = threading.Lock()
+
+    def parse_expnum(self, name):
+        match = self.regex.match(name)
+        return int(match.group('expnum')) if match else None
+
+    def refresh(self, force=False):
+        """ Re-scan the base directory, if it has changed since the last scan (or force is true). """
+        mtime = os.stat(self.basedir).st_mtime
+        if not force and mtime == self.dir_mtime:
+            return
+        used = {}
+        for name in os.listdir(self.basedir):
+            expnum = self.parse_expnum(name)
+            if expnum is not None:
+                used.setdefault(expnum, name)
+        self.used, self.dir_mtime = used, mtime
+
+    def active_reservations(self):
+        """ Return set of reserved experiment numbers, removing stale reservations. """
+        try:
+            names = os.listdir(self.reservations_dir)
+        except OSError:
+            return set()
+        reserved = set()
+        now = time.time()
+        for name in names:
+            expnum = self.parse_expnum(name)
+            if expnum is None:
+                continue
+            path = os.path.join(self.reservations_dir, name)
+            try:
+                if now - os.path.getmtime(path) > EXPID_RESERVATION_TIMEOUT:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            reserved.add(expnum)
+        return reserved
+
+    def reserve(self, expid):
+        """ Atomically reserve expid. Returns False if expid is already reserved (e.g. by another machine). """
+        os.makedirs(self.reservations_dir, exist_ok=True)
+        try:
+            fd = os.open(os.path.join(self.reservations_dir, expid), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fp:
+            fp.write("{} {} {}\n".format(socket.gethostname(), os.getpid(), datetime.now().isoformat()))
+        return True
+
+    def release(self, expid):
+        try:
+            os.remove(os.path.join(self.reservations_dir, expid))
+        except OSError:
+            pass
+
+    def next_expid(self):
+        """ Find and reserve the next free experiment ID (one higher than the highest used or reserved ID). """
+        with self.lock:
+            self.refresh()
+            taken = set(self.used) | self.active_reservations()
+            expnum = max(taken) + 1 if taken else 1
+            for expnum in range(expnum, expnum + 100):
+                expid = self.expid_fmt.format(expnum=expnum)
+                if self.reserve(expid):
+                    return expid
+            raise RuntimeError("Could not reserve a new experiment ID in %s" % self.reservations_dir)
+
+    def folder_using(self, expid):
+        """ Return the name of an existing folder using the experiment ID of expid, or None. """
+        expnum = self.parse_expnum(expid)
+        if expnum is None:
+            return None
+        with self.lock:
+            self.refresh(force=True)  # Don't trust mtime here; network shares may have coarse mtime resolution.
+            return self.used.get(expnum)
+
+
+_expid_allocators = {}
+
+
+def get_expid_allocator(settings=None):
+    """ Return the (cached) experiment ID allocator for the configured experiments base dir, or None. """
+    settings = settings or get_settings()
+    basedir = settings.get('eln_experiments_basedir')
+    expid_pat = settings.get('eln_experiments_expid_pat')
+    expid_fmt = settings.get('eln_experiments_expid_fmt')
+    if not (basedir and expid_pat and expid_fmt):
+        return None
+    basedir = os.path.abspath(os.path.expanduser(basedir.strip()))
+    if not os.path.isdir(basedir):
+        return None
+    key = (basedir, expid_pat, expid_fmt)
+    if key not in _expid_allocators:
+        _expid_allocators[key] = ExperimentIdAllocator(basedir, expid_pat, expid_fmt)
+    return _expid_allocators[key]
+
+
+def warm_expid_allocator():
+    allocator = get_expid_allocator()
+    if allocator is not None:
+        with allocator.lock:
+            allocator.refresh()
+
+
+def plugin_loaded():
+    # Scan the experiments base dir in the background, so the first "New Experiment" prompt is instant.
+    sublime.set_timeout_async(warm_expid_allocator, 0)
+
+
+#
+# Loop templates ('python-loop' subst mode):
+# ------------------------------------------
+# Like 'python-fmt', but with block tags on their own lines for repeating parts of the template, e.g.
+#
+#     | Well | Sample |
+#     {% for well, sample in zip(wells_96, samples) %}
+#     | {well} | {sample[name]} ({loop.index}/{loop.length}) |
+#     {% endfor %}
+#     {% repeat 3 %}
+#     * Replicate {loop.index}:
+#     {% endrepeat %}
+#
+# Iterables can be template variables (including attributes/items, e.g. "plate.wells" or "plates[0]"),
+# or range(...), zip(...), enumerate(...) or reversed(...) of those.
+# Templates are compiled once (and cached). The whole template is rendered before anything is inserted,
+# so a template error leaves the view untouched, and the rendered text is inserted in a single edit.
+
+TEMPLATE_TAG_REGEX = re.compile(
+    r"^[ \t]*\{%\s*(?P<line_tag>.*?)\s*%\}[ \t]*(?:\n|$)|\{%\s*(?P<tag>.*?)\s*%\}", re.MULTILINE)
+TEMPLATE_FOR_REGEX = re.compile(r"^for\s+(?P<targets>\w+(?:\s*,\s*\w+)*)\s+in\s+(?P<expr>.+)$")
+TEMPLATE_CALL_REGEX = re.compile(r"^(?P<func>\w+)\((?P<args>.*)\)$")
+TEMPLATE_FUNCTIONS = {'range': range, 'zip': zip, 'enumerate': enumerate, 'reversed': reversed}
+LoopInfo = namedtuple('LoopInfo', 'index index0 length first last')
+
+
+class LoopTemplate(object):
+    """ Template with {% for %} and {% repeat %} blocks, compiled to a tree of text and loop nodes. """
+
+    def __init__(self, content):
+        self.nodes = self.compile(content)
+
+    @staticmethod
+    def compile(content):
+        """ Return list of nodes, each either a text (str.format string) or (targets, expr, child nodes). """
+        root = []
+        stack = [("", root)]
+        pos = 0
+        for match in TEMPLATE_TAG_REGEX.finditer(content):
+            if match.start() > pos:
+                stack[-1][1].append(content[pos:match.start()])
+            pos = match.end()
+            tag = match.group('line_tag') if match.group('line_tag') is not None else match.group('tag')
+            lineno = content.count("\n", 0, match.start()) + 1
+            keyword = tag.split(" ")[0]
+            if keyword in ("for", "repeat"):
+                if keyword == "for":
+                    for_match = TEMPLATE_FOR_REGEX.match(tag)
+                    if not for_match:
+                        raise ValueError("Invalid for tag on template line %s: %r" % (lineno, tag))
+                    targets = [target.strip() for target in for_match.group('targets').split(",")]
+                    expr = for_match.group('expr').strip()
+                else:
+                    targets, expr = [], "range(%s)" % tag[len("repeat"):].strip()
+                children = []
+                stack[-1][1].append((targets, expr, children))
+                stack.append(("end" + keyword, children))
+            elif keyword in ("endfor", "endrepeat"):
+                if stack[-1][0] != keyword:
+                    raise ValueError("Unexpected %r on template line %s." % (tag, lineno))
+                stack.pop()
+            else:
+                raise ValueError("Unknown template tag on line %s: %r" % (lineno, tag))
+        if len(stack) > 1:
+            raise ValueError("Template block not closed, expected %r." % (stack[-1][0],))
+        if pos < len(content):
+            root.append(content[pos:])
+        return root
+
+    @staticmethod
+    def evaluate(expr, context):
+        """ Evaluate a loop expression: a template variable, an int, or a call to one of TEMPLATE_FUNCTIONS. """
+        expr = expr.strip()
+        if re.match(r"^-?\d+$", expr):
+            return int(expr)
+        call = TEMPLATE_CALL_REGEX.match(expr)
+        if call:
+            if call.group('func') not in TEMPLATE_FUNCTIONS:
+                raise ValueError("Unknown template function %r." % (call.group('func'),))
+            args = [LoopTemplate.evaluate(arg, context) for arg in split_arguments(call.group('args')) if arg.strip()]
+            return TEMPLATE_FUNCTIONS[call.group('func')](*args)
+        return string.Formatter().get_field(expr, (), context)[0]
+
+    def render(self, kwargs, nodes=None):
+        """ Generator yielding the rendered template text in pieces. """
+        context = kwargs if isinstance(kwargs, ChainMap) else ChainMap({}, kwargs)
+        for node in self.nodes if nodes is None else nodes:
+            if isinstance(node, str):
+                yield node.format_map(context)
+                continue
+            targets, expr, children = node
+            items = list(self.evaluate(expr, context))
+            for i, item in enumerate(items):
+                loop_vars = {'loop': LoopInfo(i + 1, i, len(items), i == 0, i == len(items) - 1)}
+                if len(targets) == 1:
+                    loop_vars[targets[0]] = item
+                elif targets:
+                    loop_vars.update(zip(targets, item))
+                for piece in self.render(context.new_child(loop_vars), children):
+                    yield piece
+
+
+@lru_cache(maxsize=16)
+def get_loop_template(content):
+    """ Return compiled LoopTemplate for template content (cached). """
+    return LoopTemplate(content)
+
+
+def split_arguments(args):
+    """ Split a function's argument string on top-level commas, e.g. "range(1, 4), n" -> ["range(1, 4)", " n"]. """
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(args):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(args[start:i])
+            start = i + 1
+    parts.append(args[start:])
+    return parts
+
+
+def default_loop_template_kwargs():
+    """ Variables available in all loop templates, e.g. well positions for 96 and 384 well plates (by row). """
+    return {
+        'wells_96': list(iter_well_positions(96, fill_order="row")),
+        'wells_96_by_column': list(iter_well_positions(96, fill_order="column")),
+        'wells_384': list(iter_well_positions(384, fill_order="row")),
+        'wells_384_by_column': list(iter_well_positions(384, fill_order="column")),
+    }
+
+
+def render_loop_template(template_content, template_kwargs):
+    """ Compile (cached) and render a loop template, returning the rendered text. """
+    template = get_loop_template(template_content)
+    return "".join(template.render(dict(default_loop_template_kwargs(), **template_kwargs)))
+
+
+#
+# User input pipeline:
+# --------------------
+# New projects and experiments are created from a list of (key, description[, initial text]) inputs,
+# prompted for one at a time. While the first input panel is open, suggestions for each key
+# (template kwargs, recently entered values, and values parsed from existing folder names) are fetched
+# in the background and put in a prefix index, which serves completions for the input panels.
+# Each value is checked against the title/folder/filename format strings before the next prompt.
+
+INVALID_FILENAME_CHARS = set('<>:"/\\|?*')
+_userinput_panels = {}  # input panel view id -> CollectUserInputCommand collecting input with that panel
+
+
+def format_fields(fmt):
+    """ Return set of (top-level) field names in format string fmt, e.g. {'expid', 'plate'} for "{expid}-{plate[0]}". """
+    return {re.match(r"\w*", field).group() for literal, field, spec, conversion in string.Formatter().parse(fmt)
+            if field is not None}
+
+
+def format_string_regex(fmt):
+    """
+    Return compiled regex matching strings made with format string fmt, e.g. "{expid} {titledesc}",
+    with a named group for the first occurrence of each simple field (fields like "{plate[0]}" match anything).
+    """
+    regex, seen = ["^"], set()
+    for literal, field, spec, conversion in string.Formatter().parse(fmt):
+        regex.append(re.escape(literal))
+        if field is None:
+            continue
+        if field.isidentifier() and field not in seen:
+            seen.add(field)
+            regex.append("(?P<%s>.+?)" % field)
+        else:
+            regex.append(".+?")
+    regex.append("$")
+    return re.compile("".join(regex))
+
+
+def validate_userinput(key, values, formats):
+    """
+    Check the value of key in values against formats, an ordered dict with e.g. 'title', 'foldername' and 'filename'
+    format strings. Formats with fields that are not in values yet are skipped.
+    Returns an error message, or None if the value is OK.
+    """
+    value = values[key]
+    for name, fmt in formats.items():
+        if not fmt or key not in format_fields(fmt) or not format_fields(fmt) <= values.keys():
+            continue
+        try:
+            result = fmt.format(**values)
+        except (KeyError, IndexError, AttributeError, ValueError) as exc:
+            return "Invalid {} {!r} for {} format {!r}: {}".format(key, value, name, fmt, exc)
+        if name == 'title':
+            values = dict(values, title=result, pagetitle=result)
+        elif name in ('foldername', 'filename') and INVALID_FILENAME_CHARS & set(value):
+            return "{} {!r} can not be used in a {} (contains {})".format(
+                key, value, name, "".join(sorted(INVALID_FILENAME_CHARS & set(value))))
+    return None
+
+
+class SuggestionIndex(object):
+    """
+    Prefix index of suggested values for a user input, given as (value, kind) in order of relevance.
+    Values are kept in a list sorted by lower-cased value, so `lookup(prefix)` is a bisection plus a short scan.
+    """
+
+    def __init__(self, suggestions):
+        self.entries = []
+        seen = set()
+        for rank, (value, kind) in enumerate(suggestions):
+            if value and value not in seen:
+                seen.add(value)
+                self.entries.append((value.lower(), rank, value, kind))
+        self.entries.sort()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, prefix, limit=20):
+        """ Return list of (value, kind) for values starting with prefix (ignoring case), most relevant first. """
+        prefix = prefix.lower()
+        matches = []
+        for i in range(bisect_left(self.entries, (prefix,)), len(self.entries)):
+            lower, rank, value, kind = self.entries[i]
+            if not lower.startswith(prefix):
+                break
+            if lower != prefix:
+                matches.append((rank, value, kind))
+        return [(value, kind) for rank, value, kind in sorted(matches)[:limit]]
+
+
+class ElnUserInputCompletionsListener(sublime_plugin.EventListener):
+    """ Provide completions from the prefetched suggestions in the input panels of CollectUserInputCommand. """
+
+    def on_query_completions(self, view, prefix, locations):
+        command = _userinput_panels.get(view.id())
+        if command is None:
+            return None
+        text = view.substr(sublime.Region(0, locations[0]))
+        start = len(text) - len(prefix)  # Completions replace the prefix (the current word), not the whole text.
+        completions = [["{}\t{}".format(value[start:], kind), value[start:].replace("$", "\\$")]
+                       for value, kind in command.userinput_completions(text)]
+        return completions, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS
+
+
 class CollectUserInputCommand(sublime_plugin.WindowCommand):
     """
     A generic command with a method for collecting a list of user-input.
     Usage:
 
     In `__init__` (*after* calling super), or in `run`,
-    set `self.requested_userinput` to a list of (key, description) tuples.
+    set `self.requested_userinput` to a list of (key, description) or (key, description, initial text) tuples.
+    Optionally call `load_userinput_config(prefix)` to validate input against the '<prefix>_title_fmt',
+    '<prefix>_foldername_fmt' and '<prefix>_filename_fmt' settings and suggest values from '<prefix>_basedir'.
     At the end of your `run` method, invoke `collect_userinput()`.
     Continue your Command logic in a method named `done_collecting_userinput`, overwriting this baseclass' method.
     The requested user inputs will be available as `self.collected_userinput` (ordered dict),
     and `done_collecting_userinput()` is called when all inputs have been collected.
+    If the user cancels an input panel, `userinput_cancelled()` is called instead.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.collected_userinput = OrderedDict()
         self.requested_userinput = deque([])  # list of tuples. Will be converted to a deque.
-        self.current_input = None
+        self.current_input = self.current_desc = None
         self.completed_userinput = []
+        self.userinput_formats = OrderedDict()   # name: format string that values must be valid for.
+        self.userinput_template_kwargs = {}      # Additional values for the formats (and suggestions).
+        self.userinput_basedir = None            # Folder names here are parsed with 'foldername' format for suggestions.
+        self.userinput_suggestions = {}          # key: SuggestionIndex, prefetched by collect_userinput.
+        self.userinput_panel = None
+
+    def load_userinput_config(self, prefix):
+        """ Set formats to validate input against, and where to find suggestions, from the '<prefix>_*' settings. """
+        settings = get_settings()
+        title_fmt = settings.get(prefix + '_title_fmt', '{expid} {titledesc}')
+        self.userinput_formats = OrderedDict([
+            ('title', title_fmt),
+            ('foldername', settings.get(prefix + '_foldername_fmt', (title_fmt or '').split('/')[-1])),
+            ('filename', settings.get(prefix + '_filename_fmt', '{expid}.md')),
+        ])
+        self.userinput_template_kwargs = settings.get(prefix + '_template_kwargs', {}) or {}
+        self.userinput_basedir = settings.get(prefix + '_basedir')
 
-    def collect_userinput(self):
+    def collect_userinput(self, initial_values=None):
+        """
+        Prompt for each of the requested inputs, then call `done_collecting_userinput`.
+        Inputs given in initial_values (dict) are not prompted for.
+        """
         # for key, desc in self.requested_userinput:
         # Nope, for-loop isn't really compatible with SublimeText's input model (which takes a function).
         print("Starting user input collection. Requested inputs =", self.requested_userinput)
-        if isinstance(self.requested_userinput, list):
-            self.requested_userinput = deque(self.requested_userinput)
+        self.collected_userinput = OrderedDict(
+            (key, value.strip() if isinstance(value, str) else value) for key, value in (initial_values or {}).items())
+        self.completed_userinput = list(self.collected_userinput)
+        self.requested_userinput = deque(field for field in self.requested_userinput
+                                         if field[0] not in self.collected_userinput)
+        self.userinput_suggestions = {}
+        keys = [field[0] for field in self.requested_userinput]
+        sublime.set_timeout_async(lambda: self.prefetch_userinput_suggestions(keys), 0)
         self.drive_userinput_chain()  # recursively
 
     def drive_userinput_chain(self, value=None):
         print("Last user input %r = %r" % (self.current_input, value))
         if value is not None:
+            value = value.strip()  # strip leading/trailing whitespace; empty string is OK.
+            values = dict(self.userinput_template_kwargs)
+            values.update(self.collected_userinput)
+            values[self.current_input] = value
+            error = validate_userinput(self.current_input, values, self.userinput_formats) if value else None
+            if error:
+                print_status_msg(error)
+                self.prompt_userinput(self.current_input, self.current_desc, value)
+                return
             self.collected_userinput[self.current_input] = value
             self.completed_userinput.append(self.current_input)
         try:
-            key, desc = self.requested_userinput.popleft()
-            self.current_input = key
-            # self.window.show_input_panel(caption, initial_text, on_done, on_change, on_cancel)
-            print("Prompting for user input %r (%r)" % (desc, key))
-            self.window.show_input_panel(desc, '', self.drive_userinput_chain, None, None)
+            field = self.requested_userinput.popleft()
         except IndexError:
+            self.close_userinput_panel()
             print("\nAll user inputs collected:")
             # print("\n".join(f" - {k}: {v}" for k, v in self.collected_userinput.items()))  # ST is python 3.3
             print("\n".join(" - {}: {}".format(k, v) for k, v in self.collected_userinput.items()))
+            state = get_state()
+            for key in self.completed_userinput:
+                if self.collected_userinput[key]:
+                    state.push_recent('recent_userinput_' + key, self.collected_userinput[key])
             self.done_collecting_userinput()
+            return
+        key, desc = field[:2]
+        self.prompt_userinput(key, desc, field[2] if len(field) > 2 else '')
+
+    def prompt_userinput(self, key, desc, initial=''):
+        self.current_input, self.current_desc = key, desc
+        self.close_userinput_panel()
+        # self.window.show_input_panel(caption, initial_text, on_done, on_change, on_cancel)
+        print("Prompting for user input %r (%r)" % (desc, key))
+        self.userinput_panel = self.window.show_input_panel(
+            desc, initial, self.drive_userinput_chain, self.userinput_changed, self.on_userinput_cancel)
+        if self.userinput_panel is not None:
+            _userinput_panels[self.userinput_panel.id()] = self
+
+    def close_userinput_panel(self):
+        if self.userinput_panel is not None:
+            _userinput_panels.pop(self.userinput_panel.id(), None)
+            self.userinput_panel = None
+
+    def fetch_userinput_suggestions(self, keys):
+        """
+        Yield (key, value, kind) suggestions for the inputs in keys, most relevant first:
+        Template kwargs, recently entered values, and values parsed from folder names in the base dir (newest first).
+        """
+        for key in keys:
+            values = self.userinput_template_kwargs.get(key)
+            for value in (values if isinstance(values, list) else [values]):
+                if isinstance(value, str):
+                    yield key, value, "template"
+        state = get_state()
+        for key in keys:
+            for value in state.get('recent_userinput_' + key, []):
+                yield key, value, "recent"
+        foldername_fmt = self.userinput_formats.get('foldername')
+        basedir = os.path.expanduser(self.userinput_basedir.strip()) if self.userinput_basedir else None
+        if not (foldername_fmt and basedir and os.path.isdir(basedir)):
+            return
+        regex = format_string_regex(foldername_fmt)
+        for name in sorted(os.listdir(basedir), reverse=True):
+            match = regex.match(name)
+            if match:
+                for key, value in match.groupdict().items():
+                    if key in keys:
+                        yield key, value.strip(), "existing"
+
+    def prefetch_userinput_suggestions(self, keys):
+        """ Build the suggestion indexes (called in the background while the first input panel is open). """
+        start = time.time()
+        suggestions = OrderedDict((key, []) for key in keys)
+        try:
+            for key, value, kind in self.fetch_userinput_suggestions(keys):
+                suggestions[key].append((value, kind))
+        except (OSError, ValueError) as exc:
+            print("Could not fetch user input suggestions: %r" % (exc,))
+        self.userinput_suggestions = {key: SuggestionIndex(values) for key, values in suggestions.items()}
+        print("Prefetched user input suggestions in {:.0f} ms: {}".format(1000*(time.time() - start), ", ".join(
+            "{} {}".format(len(index), key) for key, index in self.userinput_suggestions.items())))
+
+    def userinput_completions(self, text):
+        """ Return list of (value, kind) suggestions for the current input, starting with text. """
+        index = self.userinput_suggestions.get(self.current_input)
+        return index.lookup(text) if index is not None else []
+
+    def userinput_changed(self, text):
+        """ Show the completions popup in the input panel while there are suggestions for the text. """
+        panel = self.userinput_panel
+        if panel is None or not text:
+            return
+        if self.userinput_completions(text):
+            panel.run_command("auto_complete", {"disable_auto_insert": True, "next_completion_if_showing": False})
+        else:
+            panel.run_command("hide_auto_complete")
+
+    def on_userinput_cancel(self):
+        self.close_userinput_panel()
+        print("User input cancelled (%r)." % (self.current_input,))
+        self.userinput_cancelled()
+
+    def userinput_cancelled(self):
+        """ Called if the user cancels an input panel; overwrite to clean up. """
+        pass
 
     def done_collecting_userinput(self):
         print(" - Done! But this method should be overwritten by the sub-class.")
@@ -115,6 +624,7 @@ class ElnCreateNewProjectCommand(CollectUserInputCommand):
                 ("projectid", "Project Identifier"),
                 ("titledesc", "Title description"),
             ]
+        self.load_userinput_config('eln_projects')
         self.buffer_text = ""
         self.collect_userinput()  # calls self.done_collecting_userinput() when done.
 
@@ -283,6 +793,12 @@ class ElnCreateNewProjectCommand(CollectUserInputCommand):
             elif template_subst_mode == 'python-%':
                 # "%s" string interpolation: template_vars must be tuple or dict (both will work):
                 template_content = template_content % template_kwargs
+            elif template_subst_mode == 'python-loop':
+                try:
+                    template_content = render_loop_template(template_content, template_kwargs)
+                except (KeyError, IndexError, AttributeError, TypeError, ValueError) as exc:
+                    self.show_error("Error rendering loop template (%r) with template vars" % template_fn, exc=exc)
+                    return
             else:
                 print("Unrecognized template_subst_mode '%s'" % (template_subst_mode,))
 
@@ -323,6 +839,7 @@ class ElnCreateNewProjectCommand(CollectUserInputCommand):
         #         # Consider: Implement specifying experiments_overview_page from server.
         #         print("Using experiment_overview_page from the server is not yet supported.")
 
+        get_state().push_recent('recent_projects', filepath)
         print("ElnCreateNewProjectCommand completed!\n")
         if save_to_file:
             self.window.run_command("save")
@@ -330,7 +847,7 @@ class ElnCreateNewProjectCommand(CollectUserInputCommand):
             self.window.run_command("auto_save", args={"enable": True})
 
 
-class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
+class ElnCreateNewExperimentCommand(CollectUserInputCommand):
     """
     Command string: eln_create_new_experiment
     Create a new experiment:
@@ -342,6 +859,7 @@ class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
     - Done: Move this command to rsenv.eln package.
     - Done: Option to save view buffer to file.
     - Done: Option to enable auto_save
+    - Done: Use the common CollectUserInputCommand input chain.
     This is a window command, since we might not have any views open when it is invoked.
 
     Question: Does Sublime wait for window commands to finish, or are they dispatched to run
@@ -349,43 +867,65 @@ class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
     In other words: *Commands cannot be used as functions*. That makes ST plugin development a bit convoluted.
     It is generally best to avoid any "run_command" calls, until the end of any methods/commands.
 
-    # TODO: Update this to use the common CollectUserInputCommand.
-
     """
 
-    # def __init__(self):
-    #     self.expid = None
-    #     self.titledesc = None
-    #     self.pagetitle = None
-    #     self.bigcomment = None
-    #     self.exp_buffer_text = None
-    #     self.view = None
-    #     sublime_plugin.WindowCommand.__init__(self)
-
     def run(self, expid=None, titledesc=None):
-        self.expid = expid
-        self.titledesc = titledesc
         self.exp_buffer_text = ""
-
-        if self.expid is not None:
-            self.expid_received(self.expid)
-        else:
-            # Start input chain:
-            self.window.show_input_panel('Experiment ID:', '', self.expid_received, None, None)
-
-    def expid_received(self, expid):
-        """ Saves expid input and asks the user for titledesc. """
-        self.expid = expid.strip()  # strip leading/trailing whitespace; empty string is OK.
-        if self.titledesc is not None:
-            self.titledesc_received(self.titledesc)
+        self.reserved_expid = None
+        self.load_userinput_config('eln_experiments')
+        # Inputs given as arguments are not prompted for:
+        initial_values = OrderedDict(
+            (key, value) for key, value in (("expid", expid), ("titledesc", titledesc)) if value is not None)
+        if expid is None:
+            # The base dir may be on a network drive, so the ID is allocated in the background:
+            sublime.status_message("Finding next experiment ID...")
+            sublime.set_timeout_async(lambda: self.allocate_expid(initial_values), 0)
         else:
-            self.window.show_input_panel('Exp title desc:', '', self.titledesc_received, None, None)
+            self.start_userinput(initial_values)
 
-    def titledesc_received(self, titledesc):
-        """ Saves titledesc input and asks the user for bigcomment text. """
-        self.titledesc = titledesc.strip()  # strip leading/trailing whitespace; empty string is OK.
-        # self.window.show_input_panel('Big page comment:', self.expid, self.bigcomment_received, None, None)
-        self.done_collecting_variables()
+    def allocate_expid(self, initial_values):
+        """ Reserve the next free experiment ID (if eln_experiments_expid_pat/fmt are configured), then prompt. """
+        allocator = get_expid_allocator()
+        if allocator is not None:
+            try:
+                self.reserved_expid = allocator.next_expid()
+            except (OSError, RuntimeError) as exc:
+                print("Could not allocate next experiment ID: %r" % (exc,))
+        sublime.set_timeout(lambda: self.start_userinput(initial_values), 0)
+
+    def start_userinput(self, initial_values):
+        # Start input chain, with the next free experiment ID pre-filled:
+        self.requested_userinput = [
+            ("expid", "Experiment ID:", self.reserved_expid or ''),
+            ("titledesc", "Exp title desc:"),
+        ]
+        self.collect_userinput(initial_values=initial_values)
+
+    def release_reserved_expid(self):
+        """ Release the pre-filled experiment ID reservation (if any), in the background. """
+        expid, self.reserved_expid = self.reserved_expid, None
+        if not expid:
+            return
+
+        def release():
+            allocator = get_expid_allocator()
+            if allocator is not None:
+                allocator.release(expid)
+
+        sublime.set_timeout_async(release, 0)
+
+    def userinput_cancelled(self):
+        self.release_reserved_expid()
+
+    def done_collecting_userinput(self):
+        """ Saves expid and titledesc input and creates the experiment. """
+        self.expid = self.collected_userinput.get("expid", "")
+        self.titledesc = self.collected_userinput.get("titledesc", "")
+        try:
+            self.done_collecting_variables()
+        finally:
+            # Released on every path, including aborts and errors; an experiment folder now marks the ID as used.
+            self.release_reserved_expid()
 
     def bigcomment_received(self, bigcomment):
         """ Saves bigcomment input and invokes on_done. """
@@ -462,6 +1002,12 @@ class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
             if os.path.isdir(exp_basedir):
                 foldername = foldername_fmt.format(expid=self.expid, titledesc=self.titledesc).strip()
                 folderpath = os.path.join(exp_basedir, foldername)
+                allocator = get_expid_allocator(settings)
+                existing = allocator.folder_using(self.expid) if allocator is not None and self.expid else None
+                if existing and existing != foldername and not sublime.ok_cancel_dialog(
+                        "Experiment ID {} is already used by folder '{}'.\n\nCreate '{}' anyway?".format(
+                            self.expid, existing, foldername)):
+                    return
                 if os.path.isdir(folderpath):
                     msg = "NOTICE: The folderpath for the new experiment already exists: %s" % folderpath
                 else:
@@ -540,6 +1086,13 @@ class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
             elif template_subst_mode in ('python-$', 'template-string'):
                 template_string_obj = string.Template(template_content)
                 template_content = template_string_obj.safe_substitute(**template_kwargs)
+            elif template_subst_mode == 'python-loop':
+                try:
+                    template_content = render_loop_template(template_content, template_kwargs)
+                except (KeyError, IndexError, AttributeError, TypeError, ValueError) as exc:
+                    print("%s while rendering template %s: %s" % (exc.__class__.__name__, template, exc))
+                    sublime.status_message("ERROR rendering template: %r" % (exc,))
+                    raise exc
             else:
                 print("Unrecognized template_subst_mode '%s'" % (template_subst_mode,))
 
@@ -582,6 +1135,7 @@ class ElnCreateNewExperimentCommand(sublime_plugin.WindowCommand):
         #         # Consider: Implement specifying experiments_overview_page from server.
         #         print("Using experiment_overview_page from the server is not yet supported.")
 
+        get_state().push_recent('recent_experiments', filepath)
         print("ElnCreateNewExperimentCommand completed!\n")
         if save_to_file:
             self.window.run_command("save")
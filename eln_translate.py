@@ -0,0 +1,165 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Translation of DNA/RNA sequences to protein, in one, three or six frames, and ORF finding.
+
+Translation does not look up codons one at a time. Instead, the sequence is encoded with
+bytes.translate (T/U=0, C=1, A=2, G=3, anything else=64), the three codon positions are sliced out
+with a stride of three, combined into one codon index per byte (16*b1 + 4*b2 + b3, which is >= 64 for
+codons with non-bases), and the codon indices are mapped to amino acids with a single bytes.translate
+using a precomputed 256-byte table for the genetic code. All of these operations run in C.
+
+Genetic codes are given as in the NCBI translation tables, as 64 amino acids for the codons in TCAG order.
+
+"""
+
+from __future__ import print_function, absolute_import
+import re
+from collections import OrderedDict
+import sublime
+import sublime_plugin
+import logging
+from .eln_utils import wc_maps
+logger = logging.getLogger(__name__)
+
+
+# NCBI genetic codes (translation tables), https://www.ncbi.nlm.nih.gov/Taxonomy/Utils/wprintgc.cgi
+GENETIC_CODES = {
+    1: "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",   # Standard
+    2: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSS**VVVVAAAADDEEGGGG",   # Vertebrate mitochondrial
+    3: "FFLLSSSSYY**CCWWTTTTPPPPHHQQRRRRIIMMTTTTNNKKSSRRVVVVAAAADDEEGGGG",   # Yeast mitochondrial
+    4: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",   # Mold/protozoan mitochondrial
+    5: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSSSVVVVAAAADDEEGGGG",   # Invertebrate mitochondrial
+    6: "FFLLSSSSYYQQCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",   # Ciliate nuclear
+    11: "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",  # Bacterial and plant plastid
+}
+INVALID_CODON = 64
+CODON_BASE_ORDER = "TCAG"
+# Encode bases as their index in CODON_BASE_ORDER, and multiplied by 4 and 16 for the 2nd and 1st codon position:
+_base_tables = [
+    bytes((CODON_BASE_ORDER.index(chr(i).upper().replace("U", "T")) * factor
+           if chr(i) in "TCAGUtcagu" else INVALID_CODON) for i in range(256))
+    for factor in (16, 4, 1)
+]
+NON_SEQUENCE_CHARS = b" \t\r\n\f\v0123456789-"
+# Complement table for encoded sequences, from the 'dna' base-pairing map (plus U, which is translated as T):
+_complements = dict(wc_maps['dna'], U='A', u='a')
+COMPLEMENT_TABLE = bytes.maketrans("".join(_complements.keys()).encode('ascii'),
+                                   "".join(_complements.values()).encode('ascii'))
+FRAME_LABELS = {1: "+1", 2: "+2", 3: "+3", -1: "-1", -2: "-2", -3: "-3"}
+FRAME_SETS = {1: [1], 3: [1, 2, 3], 6: [1, 2, 3, -1, -2, -3]}  # Number of frames -> frames
+
+_codon_tables = {}
+
+
+def get_codon_table(code=1):
+    """ Return 256-byte translation table mapping codon index (16*b1 + 4*b2 + b3) to amino acid. """
+    if code not in _codon_tables:
+        amino_acids = GENETIC_CODES[code].encode('ascii')
+        _codon_tables[code] = amino_acids + b"X" * (256 - len(amino_acids))
+    return _codon_tables[code]
+
+
+def clean_sequence(seq):
+    """ Return seq encoded as bytes, with whitespace, digits and dashes (e.g. from FASTA or GenBank) removed. """
+    return seq.encode('ascii', 'replace').translate(None, NON_SEQUENCE_CHARS)
+
+
+def translate_encoded(seq, frame=1, code=1):
+    """ Translate a cleaned (encoded) sequence in a forward frame (1, 2 or 3). """
+    seq = seq[frame - 1:]
+    ncodons = len(seq) // 3
+    if ncodons == 0:
+        return ""
+    positions = [seq[i:3*ncodons:3].translate(table) for i, table in enumerate(_base_tables)]
+    # Add the three codon positions byte-wise; each byte is at most 3*64 so there is no carry between bytes:
+    indices = sum(int.from_bytes(position, 'little') for position in positions).to_bytes(ncodons, 'little')
+    return indices.translate(get_codon_table(code)).decode('ascii')
+
+
+def translate_frames(seq, frames=(1, 2, 3, -1, -2, -3), code=1):
+    """
+    Translate seq in the given reading frames (1, 2, 3, or -1, -2, -3 for the reverse complement strand).
+    Stop codons are translated to '*', and codons with non-bases (e.g. N) to 'X'.
+    seq can be a string, or bytes already cleaned with `clean_sequence`.
+    Returns OrderedDict with frame: protein.
+    """
+    if not isinstance(seq, bytes):
+        seq = clean_sequence(seq)
+    rc_seq = seq.translate(COMPLEMENT_TABLE)[::-1] if any(frame < 0 for frame in frames) else None
+    return OrderedDict((frame, translate_encoded(seq if frame > 0 else rc_seq, abs(frame), code))
+                       for frame in frames)
+
+
+def translate(seq, frame=1, code=1):
+    """ Translate seq in the given reading frame, c.f. `translate_frames`. """
+    return translate_frames(seq, (frame,), code)[frame]
+
+
+def find_orfs(seq, min_length=100, code=1, both_strands=True):
+    """
+    Find open reading frames (from ATG/M to stop, or to the end of the sequence) of at least min_length codons.
+    Returns a list of (start, end, frame, protein) tuples, sorted by length (longest first),
+    where start and end are positions in the cleaned sequence (on the forward strand).
+    """
+    seq = clean_sequence(seq)
+    orf_regex = re.compile(r"M[^*]{%d,}(?:\*|$)" % max(min_length - 1, 0))
+    orfs = []
+    frames = (1, 2, 3, -1, -2, -3) if both_strands else (1, 2, 3)
+    for frame, protein in translate_frames(seq, frames, code).items():
+        offset = abs(frame) - 1
+        for match in orf_regex.finditer(protein):
+            start, end = offset + 3*match.start(), offset + 3*match.end()
+            if frame < 0:
+                start, end = len(seq) - end, len(seq) - start
+            orfs.append((start, end, frame, match.group()))
+    orfs.sort(key=lambda orf: orf[0] - orf[1])
+    return orfs
+
+
+class ElnSequenceTranslateCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_sequence_translate
+    Translate the selected sequences to protein.
+
+    Args:
+        frames: Number of frames (1, 3 or 6), or a list of frames, e.g. [1, -1].
+        code: NCBI genetic code (translation table) number, e.g. 1 (standard) or 2 (vertebrate mitochondrial).
+        replace: Replace the selection with the translation (only for single-frame translation).
+            Otherwise, translations are appended to the end of the view.
+        orfs: Find open reading frames instead of translating the full frames.
+        min_orf_length: Minimum ORF length (in codons).
+    """
+
+    def run(self, edit, frames=1, code=1, replace=False, orfs=False, min_orf_length=100):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        if isinstance(frames, int):
+            frames = FRAME_SETS.get(frames, [None])
+        if not frames or any(frame not in FRAME_LABELS for frame in frames):
+            msg = "Invalid frames; use 1, 3 or 6, or a list of frames, e.g. [1, -1]."
+        elif code not in GENETIC_CODES:
+            msg = "Unknown genetic code {!r}; use one of {}.".format(code, sorted(GENETIC_CODES))
+        else:
+            msg = None
+        if msg:
+            print(msg)
+            sublime.status_message(msg)
+            return
+        for selection in self.view.sel():
+            if selection.empty():
+                continue
+            seq = self.view.substr(selection)
+            if orfs:
+                found = find_orfs(seq, min_length=min_orf_length, code=code)
+                text = "\n".join(">ORF {}-{} frame {} ({} aa)\n{}".format(
+                    start + 1, end, FRAME_LABELS[frame], len(protein.rstrip("*")), protein)
+                    for start, end, frame, protein in found) or "No ORFs of at least %s codons found." % min_orf_length
+            elif replace and len(frames) == 1:
+                self.view.replace(edit, selection, translate(seq, frames[0], code))
+                continue
+            else:
+                text = "\n".join("Frame {}: {}".format(FRAME_LABELS[frame], protein)
+                                 for frame, protein in translate_frames(seq, frames, code).items())
+            pos = self.view.size()
+            self.view.insert(edit, pos, "\n" + text)
+            print("Inserted %s chars at pos %s" % (len(text), pos))
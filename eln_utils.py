@@ -28,8 +28,12 @@ a bit easier.
 from __future__ import print_function, absolute_import
 import os
 import glob
+import fnmatch
 import re
+import json
+import threading
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 from collections import OrderedDict, deque
 from itertools import zip_longest
@@ -41,20 +45,31 @@ logger = logging.getLogger(__name__)
 
 
 SETTINGS_NAME = 'eln_utils.sublime-settings'
+STATE_FILENAME = 'eln_utils_state.json'
 snippets = {
     'journal_date_header': "'''Journal, {date:%Y-%m-%d}:'''",
     'journal_daily_start': "'''Journal, {date:%Y-%m-%d}:'''\n* {date:%H:%M} > ",
     'journal_timestamp': "* {date:%H:%M} > ",
 }
 
+# Date/time in journal notes filenames or first lines, e.g. "2019-03-14 10:42", "20190314_104200" or "2019-03-14".
+NOTES_TIMESTAMP_REGEX = re.compile(
+    r"(?P<year>\d{4})-?(?P<month>\d{2})-?(?P<day>\d{2})"
+    r"(?:[ T_-]?(?P<hour>\d{2})[:.-]?(?P<minute>\d{2})(?:[:.-]?(?P<second>\d{2}))?)?"
+)
+
+
+# IUPAC ambiguity codes and their complements, e.g. R (A/G) pairs with Y (C/T), B (not A) with V (not T/U):
+IUPAC_AMBIGUITY_CODES = "RYKMSWBDHVNrykmswbdhvn"
+IUPAC_AMBIGUITY_COMPLEMENTS = "YRMKSWVHDBNyrmkswvhdbn"
 
 wc_maps = {
     # Note: This will also reverse ends, which effectively reverses direction of product strand.
     # 'reverse' keyword is thus purely about the print direction, not which end is 5' vs 3'.
-    'dna': dict(zip("ATGCatgc", "TACGtacg")),
-    'rna': dict(zip("AUGCaugc", "UACGuacg")),
-    'rna-to-dna': dict(zip("AUGCaugc", "TACGtacg")),
-    'dna-to-rna': dict(zip("ATGCatgc", "UACGuacg")),
+    'dna': dict(zip("ATGCatgc" + IUPAC_AMBIGUITY_CODES, "TACGtacg" + IUPAC_AMBIGUITY_COMPLEMENTS)),
+    'rna': dict(zip("AUGCaugc" + IUPAC_AMBIGUITY_CODES, "UACGuacg" + IUPAC_AMBIGUITY_COMPLEMENTS)),
+    'rna-to-dna': dict(zip("AUGCaugc" + IUPAC_AMBIGUITY_CODES, "TACGtacg" + IUPAC_AMBIGUITY_COMPLEMENTS)),
+    'dna-to-rna': dict(zip("ATGCatgc" + IUPAC_AMBIGUITY_CODES, "UACGuacg" + IUPAC_AMBIGUITY_COMPLEMENTS)),
     # 'dna+': dict(zip("ATGCatgc -53'?", "TACGtacg -53'?")),
     # 'rna+': dict(zip("AUGCaugc -53'?", "UACGuacg -53'?")),
     # 'rna-to-dna+': dict(zip("5'-AUGCaugc-3'", "3'-TACGtacg-5'")),
@@ -71,6 +86,23 @@ TERMINI_MARKERS = {"5'", "5ʹ", "3'", "3ʹ"}
 
 TERMINI_MARKERS_REGEX = {r"\d['ʹ]"}
 WHITESPACES_AND_DASHES_REGEX = r"[\-\s]"
+# Sequences in running text and order tables: At least 8 bases, optionally with termini markers and IDT mods.
+# (Base runs are matched with a single repeat, not one alternation per base, which is much faster on long sequences.)
+DEFAULT_SEQUENCE_SPAN_REGEX = (
+    r"(?<![\w/])(?:[53]['ʹ]-?)?(?:/[^/\s]+/)*[ACGTUacgtu]{8}[ACGTUacgtu]*(?:/[^/\s]+/[ACGTUacgtu]*)*"
+    r"(?:-?[53]['ʹ])?(?![\w/])"
+)
+
+
+_wc_translation_tables = {}
+
+
+def get_wc_translation_table(wc_map):
+    """ Return (cached) str.translate table for the named base-pairing map. """
+    table = _wc_translation_tables.get(wc_map)
+    if table is None:
+        table = _wc_translation_tables[wc_map] = str.maketrans(wc_maps[wc_map])
+    return table
 
 
 def compl(seq, wc_map="dna", strict=True, toupper=False):
@@ -78,10 +110,10 @@ def compl(seq, wc_map="dna", strict=True, toupper=False):
     wc = wc_maps[wc_map]
     if toupper:
         seq = seq.upper()
-    if strict:
-        return "".join(wc[b] for b in seq)
-    else:
-        return "".join(wc.get(b, b) for b in seq)
+    if strict and not wc.keys() >= set(seq):
+        raise KeyError(next(b for b in seq if b not in wc))
+    # str.translate passes characters not in the map through as-is, like wc.get(b, b):
+    return seq.translate(get_wc_translation_table(wc_map))
 
 
 def mod_preserving_compl(seq, wc_map="dna", strict=True, toupper=False, mod_regex="IDT"):
@@ -180,8 +212,88 @@ def rna_to_dna(seq):
     return seq.replace('U', 'u').replace('u', 't')
 
 
-def dna_filter(seq):
-    return "".join(b for b in seq.upper() if b in "ATCGU")
+def sequence_stats(seq):
+    """ Return dict with length, base counts (A, T, G, C) and GC content (of the counted bases) for seq. """
+    upper = seq.upper()
+    counts = OrderedDict((b, upper.count(b)) for b in "ATGC")
+    gc = counts['G'] + counts['C']
+    total = sum(counts.values())
+    return {'length': len(seq), 'counts': counts, 'gc': gc, 'total': total,
+            'gc_content': gc / total if total else 0.0}
+
+
+def dna_filter(seq, degenerate=False):
+    """ Return seq in upper case with all non-nucleotide characters removed (keeping IUPAC codes if degenerate). """
+    bases = "ATCGU" + IUPAC_AMBIGUITY_CODES[:11] if degenerate else "ATCGU"
+    return "".join(b for b in seq.upper() if b in bases)
+
+
+#
+# Bitmask-encoded sequences:
+# --------------------------
+# Each base is encoded as a 4-bit mask (A=1, C=2, G=4, T/U=8) in one byte, and IUPAC ambiguity codes
+# are the union of the bases they represent, e.g. R (A/G) = 5, N = 15. Non-base characters are encoded as 0.
+# Two (possibly degenerate) bases are compatible if the bitwise AND of their masks is non-zero.
+
+IUPAC_BITMASKS = {
+    'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8,
+    'R': 5, 'Y': 10, 'K': 12, 'M': 3, 'S': 6, 'W': 9,
+    'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15,
+}
+BITMASK_TRANSLATION_TABLE = bytes(
+    IUPAC_BITMASKS.get(chr(i).upper(), 0) if i < 128 else 0 for i in range(256)
+)
+
+
+def encode_bitmask(seq):
+    """ Encode seq as bytes with one 4-bit base mask per byte. """
+    return seq.encode('ascii', 'replace').translate(BITMASK_TRANSLATION_TABLE)
+
+
+def find_degenerate_matches(pattern, seq, both_strands=False):
+    """
+    Find all positions where pattern matches seq, where both pattern and seq may contain IUPAC ambiguity codes.
+    Returns a sorted list of (start, strand) tuples, strand being 1 (pattern) or -1 (reverse complement of pattern).
+
+    Instead of checking one position at a time (or using a regex alternation for each degenerate position),
+    the encoded sequence is handled as one big integer with one byte per base, and each pattern position is
+    checked against all sequence positions at once:
+    For pattern position j with mask p, the bytes of (seq & p) are non-zero where the sequence is compatible;
+    adding 0x7F to each byte moves "non-zero" into the byte's high bit (bytes are <= 15, so there is no carry).
+    The per-position results are shifted j bytes and AND'ed together, leaving bit 0 set at each match start.
+    """
+    pattern = dna_filter(pattern, degenerate=True)
+    m, n = len(pattern), len(seq)
+    if m == 0 or m > n:
+        return []
+    seq_int = int.from_bytes(encode_bitmask(seq), 'little')
+    high_bits = int.from_bytes(b'\x80' * n, 'little')
+    low_bits = int.from_bytes(b'\x7f' * n, 'little')
+    ones = int.from_bytes(b'\x01' * n, 'little')
+    compatible = {}  # Each distinct pattern mask only needs to be checked against the sequence once.
+
+    def match_starts(pattern):
+        result = ones >> (8 * (m - 1))  # Only positions where the whole pattern fits.
+        for j, mask in enumerate(encode_bitmask(pattern)):
+            if mask not in compatible:
+                compatible[mask] = (((seq_int & (ones * mask)) + low_bits) & high_bits) >> 7
+            result &= compatible[mask] >> (8 * j)
+            if not result:
+                break
+        hits = result.to_bytes(n, 'little')
+        starts = []
+        pos = hits.find(1)
+        while pos != -1:
+            starts.append(pos)
+            pos = hits.find(1, pos + 1)
+        return starts
+
+    matches = [(start, 1) for start in match_starts(pattern)]
+    if both_strands:
+        rc_pattern = rcompl(pattern)
+        matches += [(start, -1) for start in match_starts(rc_pattern)]
+        matches.sort()
+    return matches
 
 
 def get_settings():
@@ -200,6 +312,329 @@ def get_setting(key, default_value=None):
     return settings.get(key, default_value)
 
 
+#
+# Notebook pages:
+# ---------------
+
+NOTEBOOK_BASEDIR_SETTINGS = (("experiments", 'eln_experiments_basedir'), ("projects", 'eln_projects_basedir'))
+
+
+def get_notebook_basedirs(settings=None):
+    """ Return OrderedDict of section ("experiments" or "projects") -> absolute base dir (for those that exist). """
+    settings = settings or get_settings()
+    basedirs = OrderedDict()
+    for section, key in NOTEBOOK_BASEDIR_SETTINGS:
+        basedir = settings.get(key)
+        if basedir:
+            basedir = os.path.abspath(os.path.expanduser(basedir.strip()))
+            if os.path.isdir(basedir):
+                basedirs[section] = basedir
+    return basedirs
+
+
+def find_experiment_files(basedir, pattern):
+    """ Yield all files below basedir with basenames matching pattern (skipping hidden folders). """
+    for dirpath, dirnames, filenames in os.walk(basedir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in fnmatch.filter(filenames, pattern):
+            yield os.path.join(dirpath, filename)
+
+
+def iter_notebook_files(pattern, settings=None):
+    """ Yield (section, basedir, filepath) for all pages matching pattern in the experiments and projects base dirs. """
+    for section, basedir in get_notebook_basedirs(settings).items():
+        for filepath in find_experiment_files(basedir, pattern):
+            yield section, basedir, filepath
+
+
+#
+# Persistent runtime state:
+# -------------------------
+
+def get_cache_dir():
+    """ Return ELN Utils' directory inside Sublime's cache directory, creating it if needed. """
+    cache_dir = os.path.join(sublime.cache_path(), 'ELN_Utils')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def atomic_write(filepath, content, encoding='utf-8'):
+    """
+    Write content to a temporary file next to filepath and then move it in place in a single operation.
+    The temporary file is unique per process and thread, so concurrent writers never share it.
+    """
+    tmp_path = "{}.{}-{}.tmp".format(filepath, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'w', encoding=encoding) as fp:
+            fp.write(content)
+        os.replace(tmp_path, filepath)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class StateStore(object):
+    """
+    Small persistent key-value store for runtime state, e.g. the last selected journal notes file,
+    recently used experiments, and index cursors.
+
+    Unlike `sublime.save_settings`, changes do not rewrite the user's settings file (which triggers
+    settings reloads in every window). Instead, the state is kept in a JSON file in the cache dir:
+    - The file is loaded lazily, the first time a value is requested.
+    - Writes are debounced: Multiple changes within `save_delay` seconds are batched into a single write.
+    - Writes are atomic (temporary file + os.replace), so a crash never leaves a truncated state file.
+    """
+
+    def __init__(self, filepath, save_delay=2.0):
+        self.filepath = filepath
+        self.save_delay = save_delay
+        self._data = None
+        self._lock = threading.RLock()
+        self._timer = None
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                self._data = self.load()
+            return self._data
+
+    def load(self):
+        """ Read state from disk. A missing or corrupt state file just yields an empty state. """
+        try:
+            with open(self.filepath, encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError) as exc:
+            if os.path.exists(self.filepath):
+                print("Could not read ELN state file %s (%r); starting with empty state." % (self.filepath, exc))
+            data = {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+        self.save()
+
+    def push_recent(self, key, value, maxlen=20):
+        """ Move value to the front of the list stored under key, keeping at most maxlen entries. """
+        with self._lock:
+            recent = [v for v in self.data.get(key, []) if v != value]
+            self.data[key] = [value] + recent[:maxlen-1]
+        self.save()
+
+    def increment(self, key, subkey, n=1):
+        """ Add n to the counter stored under subkey in the dict stored under key, e.g. counts per day. """
+        with self._lock:
+            counts = self.data.setdefault(key, {})
+            counts[subkey] = counts.get(subkey, 0) + n
+        self.save()
+
+    def save(self):
+        """ Schedule a write of the state to disk, postponing any write already scheduled. """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Write state to disk immediately (if it has been loaded).
+        The write is done while holding the lock, so a flush from the debounce timer and one from
+        `plugin_unloaded` cannot interleave, and an older state never replaces a newer one.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._data is None:
+                return
+            content = json.dumps(self._data, indent=1, sort_keys=True)
+            try:
+                atomic_write(self.filepath, content)
+            except (IOError, OSError) as exc:
+                print("ERROR: Could not write ELN state file %s: %r" % (self.filepath, exc))
+
+
+_state_store = None
+
+
+def get_state():
+    """ Get the shared ELN Utils runtime state store. """
+    global _state_store
+    if _state_store is None:
+        _state_store = StateStore(os.path.join(get_cache_dir(), STATE_FILENAME))
+    return _state_store
+
+
+class FileSummaryCache(object):
+    """
+    Persistent cache of per-file summaries (e.g. journal entries or statistics), computed by summarize(filepath).
+    Summaries are kept in a JSON file, and a file is only summarized again if its size or mtime has changed.
+    Bump version when the summary format changes, to discard summaries made by older code.
+    """
+
+    def __init__(self, filepath, summarize, version=1):
+        self.filepath = filepath
+        self.summarize = summarize
+        self.version = version
+        self._entries = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        try:
+            with open(self.filepath, encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            data = {}
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return {}
+        return data.get('files', {})
+
+    def update(self, filepaths):
+        """
+        Return (OrderedDict with filepath: summary for all filepaths, number of files summarized).
+        Files no longer in filepaths are dropped from the cache.
+        Files that cannot be read are skipped (and not cached, so they are tried again next time).
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = self.load()
+            entries, summaries, nchanged = {}, OrderedDict(), 0
+            for filepath in filepaths:
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                entry = self._entries.get(filepath)
+                if not entry or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                    try:
+                        summary = self.summarize(filepath)
+                    except (IOError, OSError, UnicodeError) as exc:
+                        print("Could not summarize file %s, skipping it: %r" % (filepath, exc))
+                        continue
+                    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'summary': summary}
+                    nchanged += 1
+                entries[filepath] = entry
+                summaries[filepath] = entry['summary']
+            removed = len(self._entries.keys() - entries.keys())
+            self._entries = entries
+            if nchanged or removed:
+                self.save()
+            return summaries, nchanged
+
+    def update_file(self, filepath):
+        """
+        Summarize a single file again (e.g. after it was saved), keeping the cached summaries of all other files.
+        Returns (summary, previous summary); summary is None if the file no longer exists or cannot be read.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = self.load()
+            previous = self._entries.pop(filepath, None)
+            previous = previous['summary'] if previous else None
+            try:
+                stat = os.stat(filepath)
+                summary = self.summarize(filepath)
+            except (IOError, OSError, UnicodeError) as exc:
+                if not isinstance(exc, FileNotFoundError):
+                    print("Could not summarize file %s, skipping it: %r" % (filepath, exc))
+                summary = None
+            else:
+                self._entries[filepath] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'summary': summary}
+            self.save()
+            return summary, previous
+
+    def save(self):
+        try:
+            atomic_write(self.filepath, json.dumps({'version': self.version, 'files': self._entries}))
+        except (IOError, OSError) as exc:
+            print("ERROR: Could not write cache file %s: %r" % (self.filepath, exc))
+
+
+def parse_notes_timestamp(text):
+    """ Return the first valid date/time found in text (as a datetime object), or None if none is found. """
+    for match in NOTES_TIMESTAMP_REGEX.finditer(text):
+        values = [int(v) for v in match.group('year', 'month', 'day', 'hour', 'minute', 'second') if v is not None]
+        try:
+            return datetime(*values)
+        except ValueError:
+            continue  # E.g. a long number that isn't a date.
+    return None
+
+
+def read_journal_notes_file(filepath):
+    """
+    Read a journal notes file, returning a dict with keys
+    'filepath', 'content', 'mtime', 'size' and 'timestamp', or None if the file could not be read.
+    The timestamp is parsed from the filename or the file's first line, falling back to the file's mtime.
+    """
+    try:
+        stat = os.stat(filepath)
+        with open(filepath, encoding='utf-8') as fp:
+            content = fp.read()
+    except (IOError, OSError, UnicodeDecodeError) as exc:
+        print("Could not read journal notes file %s: %r" % (filepath, exc))
+        return None
+    timestamp = (parse_notes_timestamp(os.path.basename(filepath))
+                 or parse_notes_timestamp(content[:200].split("\n", 1)[0])
+                 or datetime.fromtimestamp(stat.st_mtime))
+    return {'filepath': filepath, 'content': content, 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'timestamp': timestamp}
+
+
+def format_journal_notes(content, date=None, paragraphs_to_bullet=True, add_timestamp=True, add_journal_header=False):
+    """
+    Format journal notes content for insertion in a journal:
+    Optionally convert paragraphs to bullet points, prefix with a timestamp and add a journal date header.
+    If date is None, the current date/time is used.
+    """
+    if date is None:
+        date = datetime.now()
+    timestamp = (snippets["journal_timestamp"].format(date=date) if add_timestamp
+                 else ("* " if paragraphs_to_bullet else ""))
+    if paragraphs_to_bullet:
+        content = "\n".join(timestamp + line for line in content.strip().split("\n\n"))
+    elif add_timestamp:
+        content = timestamp + content
+    if add_journal_header:
+        header = snippets['journal_date_header'].format(date=date)
+        content = "\n".join([header, content])
+    return content
+
+
+def clear_journal_notes_file(entry):
+    """
+    Clear a journal notes file read with `read_journal_notes_file`, leaving just a single blank line.
+    The file is replaced atomically, and is left untouched if it has changed since it was read.
+    Returns True if the file was cleared.
+    """
+    filepath = entry['filepath']
+    try:
+        stat = os.stat(filepath)
+        if (stat.st_mtime, stat.st_size) != (entry['mtime'], entry['size']):
+            print("Journal notes file changed after it was read, not clearing:", filepath)
+            return False
+        atomic_write(filepath, "\n")
+    except (IOError, OSError) as exc:
+        print("ERROR: Could not clear journal notes file %s: %r" % (filepath, exc))
+        return False
+    return True
+
+
+def plugin_unloaded():
+    """ Called by Sublime when the plugin is unloaded; make sure pending state changes are written. """
+    if _state_store is not None:
+        _state_store.flush()
+
+
 #
 # ELN Text commands:
 # ------------------
@@ -209,9 +644,18 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
     """
     Command string: eln_merge_journal_notes
     Will move text from a journal notes file to the current cursor position.
+
+    With `merge_all=True`, *all* notes files matching the current view (using `notes_filename_keys`)
+    are merged in a single operation, ordered by `order_by`, which can be either
+    'timestamp' (parsed from filename or first line, falling back to mtime), 'mtime', or 'name'.
+
+    With `filepaths`, exactly these notes files are merged (as with `merge_all`), without searching
+    `external_journal_dirs`. When the merged text has been inserted, the text command named by
+    `on_merged` (if any) is run with the list of merged `filepaths`; it is not run if the merge fails.
     """
     def run(self, edit, position=None, move=True, add_journal_header=True,
-            paragraphs_to_bullet=True, add_timestamp=True):
+            paragraphs_to_bullet=True, add_timestamp=True, merge_all=False, order_by='timestamp',
+            filepaths=None, on_merged=None):
         """ TextCommand entry point, edit token is provided by Sublime. """
         if position is None:
             position = self.view.sel()[0].begin()
@@ -223,6 +667,17 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
         self.edit_token = edit
         self.paragraphs_to_bullet = paragraphs_to_bullet
         self.add_timestamp = add_timestamp
+        self.order_by = order_by
+        self.on_merged = on_merged
+
+        if filepaths is not None:
+            filepaths = [fp for fp in filepaths if os.path.isfile(fp)]
+            if not filepaths:
+                sublime.status_message("None of the given journal notes files exist.")
+                return
+            print("Merging %s journal notes files..." % len(filepaths))
+            sublime.set_timeout_async(lambda: self.merge_files(filepaths), 0)
+            return
 
         # find files
         settings = sublime.load_settings(SETTINGS_NAME)
@@ -263,6 +718,7 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
             print(view_filename_pat, "did not match view file basename:", os.path.basename(view_filename))
         notes_filename_pat = settings.get('notes_filename_pat')
         notes_filename_keys = settings.get('notes_filename_keys')
+        notes_all_keys = None
         if view_regex_match and notes_filename_pat and notes_filename_keys:
             notes_filename_regex = re.compile(notes_filename_pat)
             notes_regex_matches = [notes_filename_regex.match(fn) for fn in self.filebasenames]
@@ -283,9 +739,22 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
                        if match else 0
                        for match in notes_regex_matches])
                 # Perhaps fall back to the last selected file, if it is present in the list:
-                last_selected = settings.get("last_external_journal")
-                if last_selected in self.filebasenames:
-                    selected_index = self.filebasenames.index(last_selected)
+                last_selected = get_state().get("last_external_journal")
+                if last_selected in self.filepaths:
+                    selected_index = self.filepaths.index(last_selected)
+
+        if merge_all:
+            if not notes_all_keys or not any(notes_all_keys):
+                msg = "No journal notes files matching the current view's {}, aborting merge.".format(
+                    notes_filename_keys)
+                print(msg)
+                sublime.status_message(msg)
+                return
+            filepaths = [fp for fp, is_match in zip(self.filepaths, notes_all_keys) if is_match]
+            print("Merging %s journal notes files..." % len(filepaths))
+            # Read files in a background thread; the insertion is then done on the main thread.
+            sublime.set_timeout_async(lambda: self.merge_files(filepaths), 0)
+            return
 
         # Display quick panel allowing the user to select the file:
         self.view.window().show_quick_panel(self.filebasenames, self.on_file_selected, selected_index=selected_index)
@@ -300,28 +769,17 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
             return
         self.filename = self.filepaths[index]
         print("Selected file:", self.filename)
-        settings = sublime.load_settings(SETTINGS_NAME)
-        settings.set("last_external_journal", self.filename)
-        sublime.save_settings(SETTINGS_NAME)
+        get_state().set("last_external_journal", self.filename)
 
         # read file:
         with open(self.filename, encoding='utf-8') as fp:
             content = fp.read()
         if len(content) == 0:
             print("File does not contain any content:", content)
-        # reformat paragraphs to bullet point:
-        timestamp = (snippets["journal_timestamp"].format(date=datetime.now()) if self.add_timestamp
-                     else ("* " if self.paragraphs_to_bullet else ""))
-        if self.paragraphs_to_bullet:
-            content = "\n".join(timestamp + line for line in content.strip().split("\n\n"))
-        elif self.add_timestamp:
-            content = timestamp + content
-
-        # Add journal header:
-        if self.add_journal_header:
-            header = snippets['journal_date_header'].format(date=datetime.now())
-            # self.view.insert(edit_token, position, header)
-            content = "\n".join([header, content])
+        # reformat paragraphs to bullet point and add journal header:
+        content = format_journal_notes(
+            content, paragraphs_to_bullet=self.paragraphs_to_bullet, add_timestamp=self.add_timestamp,
+            add_journal_header=self.add_journal_header)
 
         # Remove content from origin file (overwrite file so it contains just a single blank line):
         if self.move:
@@ -334,8 +792,51 @@ class ElnMergeJournalNotesCommand(sublime_plugin.TextCommand):
         # ValueError: Edit objects may not be used after the TextCommand's run method has returned
         # print("Inserted %s chars at pos %s" % (len(content), self.position))
         self.view.run_command("eln_insert_text", {"text": content, "position": self.position})
+        get_state().increment("merged_notes_per_day", date.today().isoformat())
         sublime.status_message("Moved notes from {} to current cursor position.".format(self.filename))
 
+    def merge_files(self, filepaths):
+        """
+        Read all filepaths (in parallel), and merge their contents, ordered by `self.order_by`.
+        Runs in Sublime's async thread; the insertion is dispatched to the main thread.
+        """
+        with ThreadPoolExecutor(max_workers=min(16, len(filepaths))) as executor:
+            entries = [entry for entry in executor.map(read_journal_notes_file, filepaths)
+                       if entry is not None and entry['content'].strip()]
+        if not entries:
+            sublime.status_message("No content in the {} matching journal notes files.".format(len(filepaths)))
+            return
+        if self.order_by == 'mtime':
+            entries.sort(key=lambda entry: entry['mtime'])
+        elif self.order_by == 'name':
+            entries.sort(key=lambda entry: os.path.basename(entry['filepath']))
+        else:
+            entries.sort(key=lambda entry: (entry['timestamp'], entry['mtime']))
+
+        parts = []
+        last_date = None
+        for entry in entries:
+            # Entries are timestamped with their own time; a journal header is added for each new date.
+            entry_date = entry['timestamp'] if self.order_by == 'timestamp' else datetime.fromtimestamp(entry['mtime'])
+            parts.append(format_journal_notes(
+                entry['content'], date=entry_date, paragraphs_to_bullet=self.paragraphs_to_bullet,
+                add_timestamp=self.add_timestamp,
+                add_journal_header=self.add_journal_header and entry_date.date() != last_date))
+            last_date = entry_date.date()
+        content = "\n".join(parts)
+        sublime.set_timeout(lambda: self.insert_merged_files(content, entries), 0)
+
+    def insert_merged_files(self, content, entries):
+        """ Insert merged content in a single edit, then clear the source files (if moving). """
+        self.view.run_command("eln_insert_text", {"text": content, "position": self.position})
+        cleared = [entry for entry in entries if clear_journal_notes_file(entry)] if self.move else []
+        get_state().increment("merged_notes_per_day", date.today().isoformat(), len(entries))
+        msg = "Merged notes from {} files ({} cleared) to current cursor position.".format(len(entries), len(cleared))
+        print(msg)
+        sublime.status_message(msg)
+        if self.on_merged:
+            self.view.run_command(self.on_merged, {"filepaths": [entry['filepath'] for entry in entries]})
+
 
 class ElnInsertTextCommand(sublime_plugin.TextCommand):
     """
@@ -374,7 +875,10 @@ class ElnOpenHtmlInBrowserCommand(sublime_plugin.TextCommand):
         if not os.path.isfile(html_path):
             html_path = filepath + '.html'
             if not os.path.isfile(html_path):
-                print("ERROR: Neither {fnroot}.html nor {filepath}.html exists, cannot open file.")
+                msg = ("ERROR: Neither {}.html nor {}.html exists, cannot open file. "
+                       "(Use 'ELN: Live HTML preview' to render the page.)").format(fnroot, filepath)
+                print(msg)
+                sublime.status_message(msg)
                 return
         msg = "Opening in browser: " + html_path
         print(msg)
@@ -417,6 +921,119 @@ class ElnInsertSnippetCommand(sublime_plugin.TextCommand):
 # ---------------------------
 #
 
+def get_mod_regex(mod_regex):
+    """ Return compiled modification regex; mod_regex can be a named pattern (e.g. "IDT"), a pattern, or None. """
+    if mod_regex in MODIFICATION_REGEX_PATTERNS:
+        mod_regex = MODIFICATION_REGEX_PATTERNS[mod_regex]
+    if mod_regex and isinstance(mod_regex, str):
+        mod_regex = re.compile(mod_regex)
+    return mod_regex or None
+
+
+def transform_sequence(text, complement=True, reverse=False, dna_only=False, wc_map="dna",
+                       convert=None, strict=False, toupper=False, remove_whitespace=False, remove_dashes=False,
+                       remove_mods=False, preserve_marks_and_mods=True, mod_regex=None):
+    """
+    Transform a sequence, e.g. complement, reverse-complement, filter or convert it.
+    See `ElnSequenceTransformCommand.run` for a description of the arguments.
+    """
+    mod_regex = get_mod_regex(mod_regex)
+    if remove_whitespace:
+        text = text.replace(" ", "").replace("\t", "")
+    if remove_dashes:
+        text = text.replace("-", "")
+    if remove_mods:
+        text = "".join(get_mod_regex(mod_regex or "IDT").split(text))
+
+    if convert == 'dna-to-rna':
+        text = dna_to_rna(text)
+    elif convert == 'rna-to-dna':
+        text = rna_to_dna(text)
+    if dna_only:
+        text = dna_filter(text)
+
+    if complement and reverse:
+        if preserve_marks_and_mods and mod_regex:
+            text = mod_preserving_rcompl(text, wc_map=wc_map, strict=strict, toupper=toupper, mod_regex=mod_regex)
+        else:
+            text = rcompl(text, wc_map=wc_map, strict=strict, toupper=toupper)
+    elif complement:
+        if preserve_marks_and_mods:
+            text = mod_preserving_compl(
+                text, wc_map=wc_map, strict=strict, toupper=toupper, mod_regex=mod_regex
+            )
+        else:
+            text = compl(text, wc_map=wc_map, strict=strict, toupper=toupper)
+    elif reverse:
+        if preserve_marks_and_mods:
+            text = mod_preserving_reversed(text, mod_regex=mod_regex)
+        else:
+            text = text[::-1]
+    return text
+
+
+def find_fasta_records(text):
+    """
+    Find the sequence part of all FASTA records in text, in a single scan.
+    Returns a list of (start, end) spans; a record's sequence lines end at the next header or blank line.
+    """
+    spans = []
+    pos, size = 0, len(text)
+    start = None  # Start of the current record's sequence lines.
+    in_record = False
+    prev_eol = 0
+    while pos < size:
+        eol = text.find("\n", pos)
+        if eol == -1:
+            eol = size
+        line = text[pos:eol].strip()
+        is_header = line.startswith(">") or line.startswith(";")
+        if is_header or not line:
+            if start is not None:
+                spans.append((start, prev_eol))
+                start = None
+            in_record = is_header
+        elif in_record and start is None:
+            start = pos
+        prev_eol = eol
+        pos = eol + 1
+    if start is not None:
+        spans.append((start, prev_eol))
+    return spans
+
+
+def find_sequence_spans(text, span_regex):
+    """
+    Find all sequences in text matching span_regex, in a single scan.
+    If the regex has a group named 'seq', only that group is used as the sequence span.
+    Returns a list of (start, end) spans.
+    """
+    regex = re.compile(span_regex, re.MULTILINE) if isinstance(span_regex, str) else span_regex
+    group = 'seq' if 'seq' in regex.groupindex else 0
+    return [match.span(group) for match in regex.finditer(text)]
+
+
+def transform_multiline_sequence(text, transform):
+    """ Transform a sequence spanning multiple lines (e.g. FASTA), keeping the line lengths of the original. """
+    lines = text.split("\n")
+    if len(lines) == 1:
+        return transform(text)
+    lines = [line.rstrip("\r") for line in lines]
+    seq = transform("".join(lines))
+    if len(seq) == sum(len(line) for line in lines):
+        lengths = [len(line) for line in lines]
+    else:
+        width = max(len(line) for line in lines)
+        lengths = [width] * (len(seq) // width + 1)
+    out, pos = [], 0
+    for length in lengths:
+        if pos >= len(seq):
+            break
+        out.append(seq[pos:pos+length])
+        pos += length
+    return "\n".join(out)
+
+
 class ElnSequenceTransformCommand(sublime_plugin.TextCommand):
     """
     Command string: eln_sequence_transform
@@ -429,7 +1046,8 @@ class ElnSequenceTransformCommand(sublime_plugin.TextCommand):
 
     def run(self, edit, complement=True, reverse=False, dna_only=False, replace=True, wc_map="dna",
             convert=None, strict=False, toupper=False, remove_whitespace=False, remove_dashes=False,
-            remove_mods=False, preserve_marks_and_mods=True, mod_regex=None):
+            remove_mods=False, preserve_marks_and_mods=True, mod_regex=None,
+            scope="selection", span_regex=None, fasta=False):
         """
         TextCommand entry point, edit token is provided by Sublime.
 
@@ -451,47 +1069,27 @@ class ElnSequenceTransformCommand(sublime_plugin.TextCommand):
             preserve_marks_and_mods: This will try to preserve termini markers (5', 3') and modification.
             mod_regex: Regex pattern for identifying modifications in the sequence.
                 mod_regex can be a named pattern, e.g. "IDT" to use IDT's modification notations.
+            scope: "selection" to transform the selections, or "document" to transform all sequences in the view.
+            span_regex: Regex used to find sequences when scope is "document".
+                Defaults to the 'eln_sequence_span_regex' setting.
+            fasta: If true (and scope is "document"), transform the sequences of all FASTA records in the view.
 
         Note: The WC map will also map (5->3, 3->5), which effectively reverses direction of product strand.
         'reverse' keyword is thus purely about the print direction, not which end is 5' vs 3'.
 
         """
+        transform_kwargs = dict(
+            complement=complement, reverse=reverse, dna_only=dna_only, wc_map=wc_map, convert=convert,
+            strict=strict, toupper=toupper, remove_whitespace=remove_whitespace, remove_dashes=remove_dashes,
+            remove_mods=remove_mods, preserve_marks_and_mods=preserve_marks_and_mods, mod_regex=mod_regex)
+        if scope == "document":
+            self.transform_document(edit, transform_kwargs, replace=replace, span_regex=span_regex, fasta=fasta)
+            return
         selections = self.view.sel()
-        if mod_regex and isinstance(mod_regex, str):
-            mod_regex = re.compile(mod_regex)
         for selection in selections:
             if selection.empty():
                 continue
-            text = self.view.substr(selection)
-
-            if remove_whitespace:
-                text = text.replace(" ", "").replace("\t", "")
-            if remove_dashes:
-                text = text.replace("-", "")
-            if remove_mods:
-                text = "".join(mod_regex.split(text))
-
-            if convert == 'dna-to-rna':
-                text = dna_to_rna(text)
-            elif convert == 'rna-to-dna':
-                text = rna_to_dna(text)
-            if dna_only:
-                text = dna_filter(text)
-
-            if complement and reverse:
-                text = rcompl(text, wc_map=wc_map, strict=strict, toupper=toupper)
-            elif complement:
-                if preserve_marks_and_mods:
-                    text = mod_preserving_compl(
-                        text, wc_map=wc_map, strict=strict, toupper=toupper, mod_regex=mod_regex
-                    )
-                else:
-                    text = compl(text, wc_map=wc_map, strict=strict, toupper=toupper)
-            elif reverse:
-                if preserve_marks_and_mods:
-                    text = mod_preserving_reversed(text, mod_regex=mod_regex)
-                else:
-                    text = text[::-1]
+            text = transform_sequence(self.view.substr(selection), **transform_kwargs)
             if replace:
                 # Replace selection with new sequence
                 self.view.replace(edit, selection, text)
@@ -502,6 +1100,41 @@ class ElnSequenceTransformCommand(sublime_plugin.TextCommand):
                 self.view.insert(edit, pos, text)
             print("Inserted %s chars at pos %s" % (len(text), pos))
 
+    def transform_document(self, edit, transform_kwargs, replace=True, span_regex=None, fasta=False):
+        """
+        Transform all sequences in the view.
+        Sequences are found in a single scan of the buffer, and all replacements are committed in a single edit,
+        by replacing the region spanning the first to the last sequence with the re-assembled text.
+        """
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        if fasta:
+            spans = find_fasta_records(text)
+        else:
+            span_regex = span_regex or get_setting('eln_sequence_span_regex', DEFAULT_SEQUENCE_SPAN_REGEX)
+            spans = find_sequence_spans(text, span_regex)
+        spans = [(start, end) for start, end in spans if end > start]
+        if not spans:
+            sublime.status_message("No sequences found in document.")
+            return
+        transform = lambda seq: transform_sequence(seq, **transform_kwargs)
+        if fasta:
+            transformed = [transform_multiline_sequence(text[start:end], transform) for start, end in spans]
+        else:
+            transformed = [transform(text[start:end]) for start, end in spans]
+        if replace:
+            pieces = []
+            last_end = spans[0][0]
+            for (start, end), seq in zip(spans, transformed):
+                pieces.append(text[last_end:start])
+                pieces.append(seq)
+                last_end = end
+            self.view.replace(edit, sublime.Region(spans[0][0], last_end), "".join(pieces))
+        else:
+            self.view.insert(edit, self.view.size(), "\n" + "\n".join(transformed))
+        msg = "Transformed {} sequences in document.".format(len(spans))
+        print(msg)
+        sublime.status_message(msg)
+
 
 class ElnSequenceStats(sublime_plugin.TextCommand):
     """
@@ -528,10 +1161,48 @@ class ElnSequenceStats(sublime_plugin.TextCommand):
             if dna_only:
                 seq = dna_filter(seq)
             print("\nSeq = %s:" % seq)
-            counts = {k: sum(1 for b in seq if b == k) for k in "ATGC"}
-            gc = sum(counts[k] for k in "GC")
-            tot = sum(counts.values())
-            s = "GC content: {:0.02f} ({}/{})".format(gc/tot, gc, tot)
+            stats = sequence_stats(seq)
+            s = "GC content: {gc_content:0.02f} ({gc}/{total})".format(**stats)
             print("*", s)
             sublime.status_message(s)
         print("-"*80)
+
+
+class ElnSequenceFindPatternCommand(sublime_plugin.TextCommand):
+    """
+    Command string: eln_sequence_find_pattern
+    Find and select all matches of a (possibly degenerate) sequence pattern, e.g. a primer "GGNCCRYW",
+    optionally also matching the pattern's reverse complement.
+    Only the selected text is searched, or, if nothing is selected, the sequences in the view
+    (as found with 'eln_sequence_span_regex'), so IUPAC codes don't match letters in the surrounding prose.
+    If pattern is not given, the user is asked for it.
+    """
+
+    def run(self, edit, pattern=None, both_strands=True, span_regex=None):
+        """ TextCommand entry point, edit token is provided by Sublime. """
+        self.both_strands = both_strands
+        self.spans = [(region.begin(), region.end()) for region in self.view.sel() if not region.empty()]
+        if not self.spans:
+            text = self.view.substr(sublime.Region(0, self.view.size()))
+            span_regex = span_regex or get_setting('eln_sequence_span_regex', DEFAULT_SEQUENCE_SPAN_REGEX)
+            self.spans = find_sequence_spans(text, span_regex)
+        if pattern:
+            self.find(pattern)
+        else:
+            self.view.window().show_input_panel("Sequence pattern (IUPAC codes allowed):", "", self.find, None, None)
+
+    def find(self, pattern):
+        length = len(dna_filter(pattern, degenerate=True))
+        matches = []
+        for start, end in self.spans:
+            text = self.view.substr(sublime.Region(start, end))
+            matches += [(start + offset, strand) for offset, strand
+                        in find_degenerate_matches(pattern, text, both_strands=self.both_strands)]
+        msg = "Found {} matches for {} in {} sequences".format(len(matches), pattern, len(self.spans))
+        print(msg)
+        sublime.status_message(msg)
+        if matches:
+            selections = self.view.sel()
+            selections.clear()
+            selections.add_all([sublime.Region(start, start + length) for start, strand in matches])
+            self.view.show(selections[0])